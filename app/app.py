@@ -1,143 +1,293 @@
+import time
+runStart, runStartedAt = time.perf_counter(), time.time() # Taken first so the first run of the server also times the imports below
+
 import streamlit as st
-import arxiv
 import os
+import uuid
+
+from database import (initDatabases, findExistingPaper, listPapers, countPapers, getPapersByIds, getFacetCounts, getGeneration,
+                      getActiveEmbedModel, rebuildIndex, getRebuilds)
+from repository import FACETS
+from ingestCache import hashBytes
+from ollamaClient import getAvailableModels
+from miscFunctions import paperInfoCard, paperSummaryCard, removeAllPapersDialog
+from jobQueue import initJobQueue, enqueueJob, getJobs, getJobCounts, retryJob
+from harvester import initHarvester, createHarvest, getHarvests, retryHarvest
+from metrics import getStageStats, getModelStats, getThroughput, exportPrometheus, recordSpan
+from config import UPLOADS_DIR, OLLAMA_HOST, MODEL_LIST_TTL
+
+# Set up once per server process and shared by every session, instead of on every rerun
+@st.cache_resource(show_spinner=False)
+def initApp() -> float:
+    ''' Creates and migrates the databases, returns when that was done. Repairing the stores left half written by a
+    crashed process is left to the workers, as only they write to ChromaDB '''
+    initDatabases(repair=False)
+    initJobQueue()
+    initHarvester()
+    return time.time()
 
-from database import initDatabases, storePaper, semanticSearch, getPapersByIds, getAllPapers
-from extractText import extractText, chunkDocument
-from processPaper import generateMetadata, generateEmbedding, getAvailableModels
-from miscFunctions import paperInfoCard, removeAllPapersDialog
+@st.cache_resource(show_spinner=False)
+def getOllamaClient():
+    ''' Gets the Ollama client shared by every session, so its HTTP connections are reused '''
+    import ollama
+    return ollama.Client(host=OLLAMA_HOST)
+
+@st.cache_data(ttl=MODEL_LIST_TTL, show_spinner=False)
+def availableModels() -> list[str]:
+    ''' Gets the installed Ollama models, refreshed every MODEL_LIST_TTL seconds instead of asked for on every rerun '''
+    return getAvailableModels(getOllamaClient())
 
 @st.fragment()
 def uploadPapers():
-    ''' Upload papers page that allows users to upload PDF papers for processing '''
+    ''' Upload papers page that allows users to upload PDF papers to be queued for processing '''
     st.header("Upload Papers")
-    st.warning("Please remain on this page until the processing is complete to avoid errors!")
-    uploadedFiles = st.file_uploader("Upload one or more PDF papers to Analyse", type="pdf", accept_multiple_files=True)
-    
-    if uploadedFiles:
-        with st.status("Processing paper(s)...", expanded=True):
-            for uploadedFile in uploadedFiles:
-                st.write("Copying the uploaded file to the server...")
-
-                tempPath = f"./data/temp/{uploadedFile.name}"
-                os.makedirs("./data/temp", exist_ok=True)
-                with open(tempPath, "wb") as f:
-                    f.write(uploadedFile.getbuffer()) # Copy the uploaded file to the folder
-                
-                st.write(f"Extracting text from *{uploadedFile.name}*...")
-                text = extractText(tempPath)
-                document = chunkDocument(tempPath) # Chunk the document into smaller parts
-                
-                st.write(f"Generating metadata with **{selectedGenModel}**...")
-                metadata = generateMetadata(text, selectedGenModel)
-
-                # st.write(f"Generating embedding with **{selectedEmbedModel}**...") # This is the old text only method
-                # embedding = generateEmbedding(text, selectedEmbedModel)
-
-                st.write("Storing the paper in the database...")
-                # storePaper(metadata, embedding)
-                storePaper(metadata, document)
-
-                st.success(f"**Paper *({uploadedFile.name})* processed successfully!**")
-                st.json(metadata, expanded=False) # Display the metadata generated
-
-                os.remove(tempPath) # Remove the temporary file
-                st.divider()
+    st.info("Papers are processed in the background by the ingest workers (`python app/worker.py`), you can leave this page at any time.")
+    with st.form("upload_form", clear_on_submit=True):
+        uploadedFiles = st.file_uploader("Upload one or more PDF papers to Analyse", type="pdf", accept_multiple_files=True)
+        submitted = st.form_submit_button("Queue Papers", use_container_width=True)
+
+    if submitted and uploadedFiles:
+        os.makedirs(UPLOADS_DIR, exist_ok=True)
+        queued = 0
+        for uploadedFile in uploadedFiles:
+            if findExistingPaper(paperId=hashBytes(uploadedFile.getvalue())):
+                st.info(f"*{uploadedFile.name}* is already in the database, skipping it")
+                continue
+
+            path = os.path.join(UPLOADS_DIR, f"{uuid.uuid4()}_{uploadedFile.name}")
+            with open(path, "wb") as f:
+                f.write(uploadedFile.getbuffer()) # Copy the uploaded file to the folder the workers read from
+
+            enqueueJob("upload", path, uploadedFile.name, {"genModel": selectedGenModel})
+            queued += 1
+        st.success(f"Queued **{queued}** paper(s) for processing!")
+
+    jobStatusPanel()
 
 @st.fragment()
 def scrapePapers():
-    ''' Scrape papers page that allows users to scrape papers from arXiv '''
+    ''' Scrape papers page that allows users to queue papers from arXiv for processing '''
     st.header("arXiv Paper Scraper")
     st.write("Enter a search keyword and the maximum number of papers to fetch from arXiv.")
-    st.write("The papers will be processed and stored in the database for later viewing.")
-    st.warning("Please remain on this page until the processing is complete to avoid errors!")
+    st.write("The papers will be processed in the background and stored in the database for later viewing.")
     keyword = st.text_input("Search keyword:", placeholder="optimization of transformer models...")
-    maxResults = st.number_input("Max results:", 1, 50, 5)
+    maxResults = st.number_input("Max results:", 1, 5000, 5)
     
     if st.button("Fetch Papers", use_container_width=True):
-        with st.status("Fetching papers...", expanded=True):
-            client = arxiv.Client() # Create client
-            search = arxiv.Search(keyword, max_results=maxResults)
-            papers = client.results(search)
-
-            st.write("Processing papers...")
-            for paper in papers:
-                path = paper.download_pdf("data/papers") # Download the paper
-                text = extractText(path)
-
-                st.write(f"Processing **{paper.title}**...")
-                st.write(f"Generating metadata with **{selectedGenModel}**...")
-                metadata = generateMetadata(text, selectedGenModel)
-                # st.write(f"Generating embedding with **{selectedEmbedModel}**...")
-                # embedding = generateEmbedding(text, selectedEmbedModel)
-                st.write("Chunking the document into smaller parts...")
-                documents = chunkDocument(path) # Chunk the document into smaller parts which replaces the above embedding
-
-                metadata["title"] = paper.title # Overwrite the generated title with the real title
-                metadata["authors"] = [a.name for a in paper.authors] # TODO: Need to find a way to make this consistent between scraped and uploaded papers
-                metadata["link"] = "https://arxiv.org/abs/" + paper.get_short_id()
-
-                st.write(f"Storing in the database...")
-                storePaper(metadata, documents)
-                st.success(f"**Paper *({paper.title})* processed successfully!**")
-                st.divider()
+        createHarvest(keyword, maxResults, {"genModel": selectedGenModel})
+        st.success(f"Queued the harvest of up to **{maxResults}** paper(s), they are downloaded and processed by the workers")
+
+    harvestStatusPanel()
+    jobStatusPanel()
+
+@st.fragment(run_every=2)
+def harvestStatusPanel():
+    ''' Polls the harvests and displays how far each one has got through its search results '''
+    for harvest in getHarvests(limit=5):
+        col1, col2 = st.columns([0.8, 0.2], vertical_alignment="center")
+        col1.progress(min(harvest["cursor"] / harvest["maxResults"], 1.0),
+                      f"**{harvest['query']}** - {harvest['status']}: {harvest['cursor']}/{harvest['maxResults']} results, "
+                      f"{harvest['downloaded']} queued, {harvest['skipped']} already stored, {harvest['failed']} failed")
+        if harvest["status"] == "failed":
+            col1.error(harvest["error"])
+            if col2.button("Resume", key=harvest["id"]+"resume", use_container_width=True):
+                retryHarvest(harvest["id"])
+
+@st.fragment(run_every=5)
+def rebuildStatusPanel(selectedEmbedModel: str, activeEmbedModel: str):
+    ''' Offers to rebuild the library's vector index when another embedding model is selected, and shows the progress
+    of the rebuilds the workers are running. Search keeps using the current index until a rebuild is complete '''
+    rebuilds = getRebuilds()
+    for rebuild in rebuilds:
+        st.progress(rebuild["done"] / rebuild["total"] if rebuild["total"] else 1.0,
+                    f"Re-embedding with **{rebuild['model']}** ({rebuild['status']}): {rebuild['done']}/{rebuild['total']} papers")
+    if selectedEmbedModel and selectedEmbedModel != activeEmbedModel and selectedEmbedModel not in [rebuild["model"] for rebuild in rebuilds]:
+        st.caption(f"The library is embedded with **{activeEmbedModel}**")
+        if st.button(f"Rebuild the index with {selectedEmbedModel}", use_container_width=True):
+            rebuildIndex(selectedEmbedModel)
+            st.rerun(scope="fragment")
+
+@st.fragment(run_every=2)
+def jobStatusPanel():
+    ''' Polls the job queue and displays the status of the most recent ingest jobs '''
+    counts = getJobCounts()
+    st.subheader("Processing Queue")
+    cols = st.columns(5)
+    for col, status in zip(cols, ["queued", "running", "done", "skipped", "failed"]):
+        col.metric(status.capitalize(), counts.get(status, 0))
+
+    for job in getJobs(limit=20):
+        if job["status"] == "failed":
+            col1, col2 = st.columns([0.8, 0.2], vertical_alignment="center")
+            col1.error(f"**{job['label']}** failed at *{job['step']}*: {job['error']}")
+            if col2.button("Retry", key=job["id"]+"retry", use_container_width=True):
+                retryJob(job["id"])
+        else:
+            st.write(f"**{job['label']}** - {job['status']} ({job['step']}) {job['progress'] or ''}")
+
+# The library queries are cached per page, the library generation is part of every cache key so any stored, edited
+# or removed paper (also by the ingest workers) invalidates them
+@st.cache_data(max_entries=64, show_spinner=False)
+def libraryPage(generation: int, filters: dict, text: str, sort: str, descending: bool, after: tuple, pageSize: int) -> tuple[list[dict], tuple | None]:
+    ''' Gets one cached page of paper summaries '''
+    return listPapers(filters, text, sort, descending, after, pageSize)
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def libraryCount(generation: int, filters: dict, text: str) -> int:
+    ''' Gets the cached number of papers matching the filters '''
+    return countPapers(filters, text)
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def libraryFacetValues(generation: int, facet: str) -> list[str]:
+    ''' Gets the cached most common values of a facet to filter by '''
+    return [value for value, _ in getFacetCounts(facet, limit=100)]
+
+@st.cache_data(max_entries=256, show_spinner=False)
+def libraryPaper(generation: int, paperId: str) -> dict | None:
+    ''' Gets the cached full metadata of a paper '''
+    papers = getPapersByIds([paperId])
+    return papers[0] if papers else None
 
 @st.fragment()
 def viewAllPapers():
-    ''' View all papers page that displays all papers stored in the database '''
+    ''' View all papers page that displays the papers stored in the database one page at a time '''
     st.header("All Papers")
     col1, col2 = st.columns(2, vertical_alignment="center")
 
     if col1.button("Refresh Papers", use_container_width=True): st.rerun(scope="fragment")
     if col2.button("Clear Database", use_container_width=True): removeAllPapersDialog()
 
-    papers = getAllPapers()
-    
+    generation = getGeneration()
+    with st.expander("Filter and sort"):
+        text = st.text_input("Contains", placeholder="transformer...")
+        col1, col2 = st.columns(2)
+        facet = col1.selectbox("Filter by", FACETS)
+        values = col2.multiselect("Any of", libraryFacetValues(generation, facet))
+        sort = col1.selectbox("Sort by", ["addedAt", "title"], format_func=lambda sort: {"addedAt": "Date added", "title": "Title"}[sort])
+        descending = col2.toggle("Descending", value=sort == "addedAt")
+        pageSize = col1.number_input("Papers per page", 5, 100, 20)
+    filters = {facet: values} if values else {}
+
+    view = (text, str(filters), sort, descending, pageSize)
+    if st.session_state.get("library_view") != view: # Start from the first page whenever the filters or sorting change
+        st.session_state.library_view = view
+        st.session_state.library_cursors = [None] # Cursor of every page visited so far, so Previous can go back
+
+    cursors = st.session_state.library_cursors
+    papers, nextCursor = libraryPage(generation, filters, text, sort, descending, cursors[-1], pageSize)
+    st.caption(f"{libraryCount(generation, filters, text)} paper(s)")
+
     for paper in papers:
-        paperInfoCard(paper)
+        paperSummaryCard(paper, lambda paperId: libraryPaper(generation, paperId))
+
+    col1, col2, col3 = st.columns([0.3, 0.4, 0.3], vertical_alignment="center")
+    if col1.button("Previous", key="library_previous", use_container_width=True, disabled=len(cursors) == 1):
+        cursors.pop()
+        st.rerun(scope="fragment")
+    col2.caption(f"Page {len(cursors)}")
+    if col3.button("Next", key="library_next", use_container_width=True, disabled=nextCursor is None):
+        cursors.append(nextCursor)
+        st.rerun(scope="fragment")
 
 @st.fragment()
 def searchPapers():
     ''' Search papers page that allows users to search for papers in the database TODO: Can probably merge this with the view all papers '''
+    from search import hybridSearch, getCacheStats, AGGREGATIONS # Imported by the first search so the other pages start faster
+
     st.header("Search Papers")
     searchQuery = st.text_input("Enter search query:", placeholder="machine learning...")
+    with st.expander("Search options"):
+        mode = st.radio("Search mode", ["hybrid", "lexical", "vector"], horizontal=True,
+                        help="Lexical matches exact terms (dataset/model names, arXiv IDs), vector matches meaning, hybrid fuses both")
+        col1, col2 = st.columns(2)
+        lexicalWeight = col1.slider("Keyword weight", 0.0, 2.0, 1.0, 0.1, disabled=mode != "hybrid")
+        vectorWeight = col2.slider("Semantic weight", 0.0, 2.0, 1.0, 0.1, disabled=mode != "hybrid")
+        aggregation = col1.selectbox("Combine matching chunks of a paper by", AGGREGATIONS, disabled=mode == "lexical",
+                                     help="max: closest chunk, mean: all matching chunks, topk: the 3 closest chunks")
+        pageSize = col2.number_input("Results per page", 1, 50, 5)
+        stats = getCacheStats()
+        st.caption(f"Cache hits: {stats['results']['hits']}/{stats['results']['hits'] + stats['results']['misses']} searches, "
+                   f"{stats['queryEmbeddings']['hits']}/{stats['queryEmbeddings']['hits'] + stats['queryEmbeddings']['misses']} query embeddings")
+
+    if st.session_state.get("search_query") != searchQuery: # Start from the first page whenever the query changes
+        st.session_state.search_query = searchQuery
+        st.session_state.search_page = 0
 
     if searchQuery:
-        paperIds = semanticSearch(searchQuery)
-        papers = getPapersByIds(paperIds)
+        page = st.session_state.search_page
+        papers = hybridSearch(searchQuery, pageSize, lexicalWeight, vectorWeight, mode, page, aggregation)
         
         for paper in papers:
             paperInfoCard(paper)
 
+        col1, col2, col3 = st.columns([0.3, 0.4, 0.3], vertical_alignment="center")
+        if col1.button("Previous", use_container_width=True, disabled=page == 0):
+            st.session_state.search_page -= 1
+            st.rerun(scope="fragment")
+        col2.caption(f"Page {page + 1}")
+        if col3.button("Next", use_container_width=True, disabled=len(papers) < pageSize):
+            st.session_state.search_page += 1
+            st.rerun(scope="fragment")
+
+@st.fragment()
+def metricsPage():
+    ''' Metrics page that shows the throughput and stage latencies of the ingest and search pipeline '''
+    st.header("Pipeline Metrics")
+    windows = {"Last hour": 3600, "Last day": 86400, "Last week": 7 * 86400, "All time": None}
+    window = st.selectbox("Time window", list(windows), index=1)
+    since = time.time() - windows[window] if windows[window] else 0
+
+    throughput = getThroughput(since)
+    cols = st.columns(4)
+    cols[0].metric("Papers stored", throughput["papers"])
+    cols[1].metric("Papers/hour", f"{throughput['papersPerHour']:.1f}")
+    cols[2].metric("Chunks embedded", throughput["chunks"])
+    cols[3].metric("Chunks/sec", f"{throughput['chunksPerSecond']:.1f}")
+
+    st.subheader("Stage Latency")
+    stages = getStageStats(since)
+    if stages:
+        st.bar_chart(stages, x="stage", y=["p50Seconds", "p95Seconds"], stack=False)
+        st.dataframe(stages, hide_index=True, use_container_width=True)
+    else:
+        st.info("No spans recorded in this window yet")
+
+    st.subheader("Models")
+    st.dataframe(getModelStats(since), hide_index=True, use_container_width=True)
+    st.download_button("Export for Prometheus", exportPrometheus(), "metrics.prom", use_container_width=True)
+
 # Main App
 st.set_page_config(page_title="Research Paper Overview with AI", page_icon="🧐")
 st.title("Research Paper Overview with AI 🧐")
 
 # Init Databases
-initDatabases()
+coldStart = initApp() >= runStartedAt # Only a run that did the setup itself (or waited for it) started before it was done
 
 # Sidebar Navigation
-menu = st.sidebar.selectbox("**Menu**", ["Upload Papers", "Scrape Papers", "View all Papers", "Search Papers"], index=0)
+menu = st.sidebar.selectbox("**Menu**", ["Upload Papers", "Scrape Papers", "View all Papers", "Search Papers", "Metrics"], index=0)
 
 # Select LLM Model to use
+activeEmbedModel = getActiveEmbedModel()
+modelNames, posOfEmdedModel = [], 0
 try:
-    availableModels = getAvailableModels()
-    posOfEmdedModel = availableModels.index("nomic-embed-text:latest") # Find the index of the recommended model for embedding to preselect it
-except:
-    st.error("Error: Make sure Ollama is running and please install nomic-embed-text:latest")
-    posOfEmdedModel = 0
+    modelNames = availableModels()
+    posOfEmdedModel = modelNames.index(activeEmbedModel) # Preselect the model the library is embedded with
+except Exception:
+    st.error(f"Error: Make sure Ollama is running and please install {activeEmbedModel}")
 
 selectedGenModel = st.sidebar.selectbox(
     "**Select LLM Model for generating metadata**",
-    options = availableModels,
+    options = modelNames,
     index = 0
 )
 
 selectedEmbedModel = st.sidebar.selectbox(
     "**Select LLM Model for generating embeddings**\nRecommended: nomic-embed-text:latest",
-    options = availableModels,
+    options = modelNames,
     index = posOfEmdedModel
 )
+with st.sidebar:
+    rebuildStatusPanel(selectedEmbedModel, activeEmbedModel)
 
 if menu == "Upload Papers":
     uploadPapers()
@@ -149,4 +299,10 @@ elif menu == "View all Papers":
     viewAllPapers()
 
 elif menu == "Search Papers":
-    searchPapers()
\ No newline at end of file
+    searchPapers()
+
+elif menu == "Metrics":
+    metricsPage()
+
+# Time the whole script run, the first run of the server process includes the imports and the database setup
+recordSpan("app.coldstart" if coldStart else "app.rerun", time.perf_counter() - runStart, runStartedAt)
\ No newline at end of file
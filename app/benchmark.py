@@ -0,0 +1,317 @@
+''' End-to-end benchmarks of the ingest and search pipeline. Everything runs against a fake Ollama server (see
+fakeOllama.py) and a throwaway data directory, so no models, network or existing library are needed or touched.
+The PDFs in data/papers are parsed, chunked, embedded and stored, then synthetic corpora are grown to each scale to
+measure search and listing latency. Results are written as JSON so runs on different commits can be compared:
+
+    python app/benchmark.py --output before.json
+    python app/benchmark.py --output after.json --scales 1000 10000 100000
+    python app/benchmark.py --compare before.json after.json
+'''
+import argparse
+import glob
+import importlib.util
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# Runs the Streamlit app headless in a fresh process, so its first run pays for the imports and the setup like the
+# first page load of a server does, then reruns it and prints the seconds of every run as JSON
+APP_RUNS = '''
+import json, sys, time
+from streamlit.testing.v1 import AppTest
+app, seconds = AppTest.from_file(sys.argv[1], default_timeout=300), []
+for _ in range(int(sys.argv[2]) + 1):
+    start = time.perf_counter()
+    app.run()
+    seconds.append(time.perf_counter() - start)
+print(json.dumps(seconds))
+'''
+
+def peakMemoryMb(children: bool = False) -> float | None:
+    ''' Gets the peak resident memory of the process so far, or of the largest child process it has waited for.
+    None on Windows, which has no resource module '''
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024**2 if sys.platform == "darwin" else peak / 1024 # Bytes on macOS, kilobytes on Linux
+
+def summarize(seconds: list[float]) -> dict:
+    ''' Summarizes repeated latency measurements in milliseconds '''
+    ms = sorted(s * 1000 for s in seconds)
+    return {
+        "n": len(ms),
+        "meanMs": statistics.fmean(ms),
+        "p50Ms": ms[len(ms) // 2],
+        "p95Ms": ms[min(len(ms) - 1, int(len(ms) * 0.95))],
+    }
+
+def measure(fn, inputs: list) -> dict:
+    ''' Times fn on every input and summarizes the latencies '''
+    seconds = []
+    for value in inputs:
+        start = time.perf_counter()
+        fn(value)
+        seconds.append(time.perf_counter() - start)
+    return summarize(seconds)
+
+def gitCommit() -> str | None:
+    ''' Gets the commit being benchmarked '''
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+class Benchmark:
+    ''' Runs the benchmark stages in order, each one records its timings and the peak memory once it is done
+
+    Args:
+        papersDir: str - Folder with the real PDFs to ingest
+        scales: list[int] - Library sizes (in papers) the search and listing latencies are measured at
+        queries: int - Distinct queries timed at every scale
+        chunksPerPaper: int - Chunks of each synthetic paper
+        dim: int - Size of the fake embeddings
+        llmConcurrency: int - Metadata requests in flight at once
+        appReruns: int - Reruns of the Streamlit app timed after its cold start '''
+    def __init__(self, papersDir: str, scales: list[int], queries: int, chunksPerPaper: int, dim: int, llmConcurrency: int, appReruns: int = 20):
+        self.papersDir = papersDir
+        self.scales = sorted(scales)
+        self.queries = queries
+        self.chunksPerPaper = chunksPerPaper
+        self.dim = dim
+        self.llmConcurrency = llmConcurrency
+        self.appReruns = appReruns
+        self.results = {}
+
+    def record(self, stage: str, child: bool = False, **values):
+        ''' Stores the results of a stage, with the peak memory of the child process it ran in if it did '''
+        self.results[stage] = {**values, "peakMemoryMb": peakMemoryMb(child)}
+        print(f"{stage}: {json.dumps(self.results[stage])}")
+
+    def run(self) -> dict:
+        ''' Runs every stage and returns the results '''
+        if self.appReruns:
+            self.benchApp()
+        pdfs = sorted(glob.glob(os.path.join(self.papersDir, "*.pdf")))
+        if pdfs:
+            pages = self.benchParse(pdfs)
+            documents = self.benchChunk(pdfs, pages)
+            embeddings = self.benchEmbed(documents)
+            metadata = self.benchMetadata(pages)
+            self.benchStore(documents, embeddings, metadata)
+        else:
+            print(f"No PDFs in {self.papersDir}, skipping the ingest stages")
+        for scale in self.scales:
+            self.benchScale(scale)
+        return self.results
+
+    def benchApp(self):
+        ''' Cold start (imports and setup) and rerun latency of the Streamlit app '''
+        if importlib.util.find_spec("streamlit") is None:
+            print("Streamlit is not installed, skipping the app stage")
+            return
+
+        app = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+        run = subprocess.run([sys.executable, "-c", APP_RUNS, app, str(self.appReruns)], capture_output=True, text=True, check=True)
+        seconds = json.loads(run.stdout.strip().splitlines()[-1])
+        self.record("app", child=True, coldStartMs=seconds[0] * 1000, rerun=summarize(seconds[1:]))
+
+    def benchParse(self, pdfs: list[str]) -> list[list[str]]:
+        ''' Text extraction of the real PDFs '''
+        from extractText import extractPages
+
+        start = time.perf_counter()
+        pages = [extractPages(pdf) for pdf in pdfs]
+        seconds = time.perf_counter() - start
+        nPages = sum(len(paperPages) for paperPages in pages)
+        self.record("parse", papers=len(pdfs), pages=nPages, seconds=seconds, pagesPerSecond=nPages / seconds)
+        return pages
+
+    def benchChunk(self, pdfs: list[str], pages: list[list[str]]) -> list[list]:
+        ''' Chunking of the extracted pages '''
+        from extractText import chunkPages
+
+        start = time.perf_counter()
+        documents = [chunkPages(paperPages, pdf) for pdf, paperPages in zip(pdfs, pages)]
+        seconds = time.perf_counter() - start
+        nChunks = sum(len(docs) for docs in documents)
+        self.record("chunk", chunks=nChunks, seconds=seconds, chunksPerSecond=nChunks / seconds)
+        return documents
+
+    def benchEmbed(self, documents: list[list]) -> list[list[list[float]]]:
+        ''' Embedding throughput with an empty cache and again with every chunk cached '''
+        from embeddings import getEmbeddingClient
+        from config import DEFAULT_EMBED_MODEL
+
+        client = getEmbeddingClient(DEFAULT_EMBED_MODEL)
+        texts = [doc.page_content for docs in documents for doc in docs]
+        start = time.perf_counter()
+        client.embed(texts)
+        cold = time.perf_counter() - start
+        start = time.perf_counter()
+        vectors = client.embed(texts)
+        warm = time.perf_counter() - start
+        self.record("embed", chunks=len(texts), seconds=cold, chunksPerSecond=len(texts) / cold, cachedChunksPerSecond=len(texts) / warm)
+
+        embeddings, i = [], 0
+        for docs in documents:
+            embeddings.append(vectors[i:i+len(docs)])
+            i += len(docs)
+        return embeddings
+
+    def benchMetadata(self, pages: list[list[str]]) -> list[dict]:
+        ''' Metadata generation of every paper in one pipelined batch '''
+        from processPaper import generateMetadataBatch
+
+        start = time.perf_counter()
+        metadata = generateMetadataBatch([("".join(paperPages), paperPages) for paperPages in pages], "fake-llm:latest", self.llmConcurrency)
+        seconds = time.perf_counter() - start
+        failed = [result for result in metadata if isinstance(result, Exception)]
+        if failed:
+            raise failed[0]
+        self.record("metadata", papers=len(pages), seconds=seconds, papersPerSecond=len(pages) / seconds)
+        return metadata
+
+    def benchStore(self, documents: list[list], embeddings: list[list[list[float]]], metadata: list[dict]):
+        ''' storePaper write rate with precomputed embeddings '''
+        from database import storePaper
+
+        start = time.perf_counter()
+        for i, (docs, vectors, paperMetadata) in enumerate(zip(documents, embeddings, metadata)):
+            storePaper(paperMetadata, docs, vectors, paperId=f"real-{i}")
+        seconds = time.perf_counter() - start
+        self.record("store", papers=len(documents), seconds=seconds, papersPerSecond=len(documents) / seconds)
+
+    def populate(self, count: int):
+        ''' Grows the library with synthetic papers until it holds `count` of them, written in bulk '''
+        from fakeOllama import fakeEmbedding, fakeMetadata, WORDS
+        from database import repository, storage
+
+        existing = sum(1 for _ in repository.filterPapers({}))
+        rng = random.Random(existing)
+        for batchStart in range(existing, count, 1000):
+            ids = [f"synthetic-{i}" for i in range(batchStart, min(batchStart + 1000, count))]
+            chunks = {paperId: [(page, " ".join(rng.choice(WORDS) for _ in range(150))) for page in range(self.chunksPerPaper)] for paperId in ids}
+            repository.insertPapers([(paperId, fakeMetadata(paperId), None) for paperId in ids], chunks)
+
+            texts = [(paperId, page, text) for paperId in ids for page, text in chunks[paperId]]
+            for i in range(0, len(texts), 5000): # Chroma caps the size of a single add
+                batch = texts[i:i+5000]
+                storage.collection.add(
+                    ids=[f"{paperId}_{page}" for paperId, page, _ in batch],
+                    documents=[text for _, _, text in batch],
+                    embeddings=[fakeEmbedding(text + paperId, self.dim) for paperId, _, text in batch],
+                    metadatas=[{"paperId": paperId, "page": page} for paperId, page, _ in batch],
+                )
+
+    def benchScale(self, scale: int):
+        ''' Search and listing latency with `scale` papers in the library '''
+        from database import semanticSearch, getAllPapers, listPapers
+        from search import hybridSearch
+        from fakeOllama import WORDS
+
+        start = time.perf_counter()
+        self.populate(scale)
+        populateSeconds = time.perf_counter() - start
+
+        rng = random.Random(scale)
+        queries = [f"{' '.join(rng.sample(WORDS, 3))} {scale} {i}" for i in range(self.queries)] # Distinct, so no query is served from a cache
+        self.record(f"scale{scale}",
+            papers=scale,
+            populateSeconds=populateSeconds,
+            semanticSearch=measure(lambda query: semanticSearch(query, 10), queries),
+            lexicalSearch=measure(lambda query: hybridSearch(query, 10, mode="lexical"), queries),
+            hybridSearch=measure(lambda query: hybridSearch(query, 10), [query + " hybrid" for query in queries]),
+            listPapers=measure(lambda _: listPapers(limit=20), range(self.queries)),
+            getAllPapers=measure(lambda _: getAllPapers(), range(3)),
+        )
+
+def flatten(results: dict, prefix: str = "") -> dict[str, float]:
+    ''' Flattens nested results into {"stage.metric": value} '''
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)):
+            flat[prefix + key] = value
+    return flat
+
+def compare(basePath: str, headPath: str, threshold: float) -> bool:
+    ''' Prints the relative change of every metric between two runs, returns whether any got worse by more than the threshold '''
+    with open(basePath) as f:
+        base = json.load(f)
+    with open(headPath) as f:
+        head = json.load(f)
+    print(f"{base.get('commit')} -> {head.get('commit')}")
+
+    regressed = False
+    baseMetrics, headMetrics = flatten(base["results"]), flatten(head["results"])
+    for metric in sorted(baseMetrics.keys() & headMetrics.keys()):
+        old, new = baseMetrics[metric], headMetrics[metric]
+        if old == 0 or metric.endswith((".n", ".papers", ".pages", ".chunks")):
+            continue
+        change = (new - old) / old
+        higherIsBetter = metric.endswith("PerSecond")
+        worse = change < -threshold if higherIsBetter else change > threshold
+        regressed |= worse
+        print(f"{metric:<40} {old:12.2f} {new:12.2f} {change:+8.1%}{'  REGRESSION' if worse else ''}")
+    return regressed
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the ingest and search pipeline against a fake Ollama server")
+    parser.add_argument("--papers-dir", default=os.path.join("data", "papers"), help="Folder of real PDFs to ingest")
+    parser.add_argument("--scales", type=int, nargs="+", default=[1000, 10000, 100000], help="Library sizes to measure search at")
+    parser.add_argument("--queries", type=int, default=20, help="Queries timed at every scale")
+    parser.add_argument("--chunks-per-paper", type=int, default=2, help="Chunks of each synthetic paper")
+    parser.add_argument("--dim", type=int, default=768, help="Size of the fake embeddings")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds the fake Ollama takes per request")
+    parser.add_argument("--embed-latency", type=float, default=0.0, help="Extra seconds the fake Ollama takes per embedded text")
+    parser.add_argument("--llm-concurrency", type=int, default=4, help="Metadata requests in flight at once")
+    parser.add_argument("--app-reruns", type=int, default=20, help="Reruns of the Streamlit app to time, 0 skips the app stage")
+    parser.add_argument("--output", help="File to write the JSON results to (printed otherwise)")
+    parser.add_argument("--compare", nargs=2, metavar=("BASE", "HEAD"), help="Compare two result files instead of running")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Relative change counted as a regression by --compare")
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(1 if compare(*args.compare, args.threshold) else 0)
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from fakeOllama import FakeOllama
+
+    server = FakeOllama(latency=args.latency, embedLatency=args.embed_latency, dim=args.dim).start()
+    with tempfile.TemporaryDirectory() as dataDir:
+        # The app modules read these when they are first imported, so they are set before any of them are
+        os.environ["OLLAMA_HOST"] = server.host
+        os.environ["RESEARCH_DATA_DIR"] = dataDir
+        from database import initDatabases
+        initDatabases()
+
+        benchmark = Benchmark(args.papers_dir, args.scales, args.queries, args.chunks_per_paper, args.dim, args.llm_concurrency, args.app_reruns)
+        results = {
+            "commit": gitCommit(),
+            "timestamp": time.time(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "config": {key: value for key, value in vars(args).items() if key not in ("output", "compare", "threshold")},
+            "results": benchmark.run(),
+            "fakeOllamaRequests": server.requests,
+        }
+    server.stop()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Wrote {args.output}")
+    else:
+        print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
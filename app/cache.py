@@ -0,0 +1,48 @@
+import threading
+import time
+from collections import OrderedDict
+
+class TTLCache:
+    ''' Thread-safe LRU cache whose entries also expire after a time to live, with hit/miss counters
+
+    Args:
+        maxSize: int - Number of entries kept before the least recently used one is evicted
+        ttl: float - Seconds an entry stays valid for '''
+    def __init__(self, maxSize: int, ttl: float):
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        ''' Gets a cached value, returns the default if it is missing or has expired '''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                self._entries.pop(key, None)
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        ''' Caches a value, evicting the least recently used entry if the cache is full '''
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxSize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        ''' Removes every entry '''
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        ''' Gets the hit/miss counters of the cache '''
+        with self._lock:
+            total = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._entries), "hitRate": self.hits / total if total else 0.0}
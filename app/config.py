@@ -0,0 +1,65 @@
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv() # Allow any of the settings below to be overridden with a .env file
+
+# Storage locations (relative to the project root, which is where `streamlit run app/app.py` is launched from)
+DATA_DIR = os.getenv("RESEARCH_DATA_DIR", "data")
+METADATA_DB = os.path.join(DATA_DIR, "metadata.db")
+JOBS_DB = os.path.join(DATA_DIR, "jobs.db")
+CHROMA_DIR = os.path.join(DATA_DIR, "chroma")
+PAPERS_DIR = os.path.join(DATA_DIR, "papers")
+UPLOADS_DIR = os.path.join(DATA_DIR, "uploads")
+INGEST_CACHE_DIR = os.path.join(DATA_DIR, "cache", "ingest")
+INGEST_CACHE_MAX_BYTES = int(os.getenv("INGEST_CACHE_MAX_BYTES", str(2 * 1024**3))) # Least recently used papers are evicted past this size
+SQLITE_POOL_SIZE = int(os.getenv("SQLITE_POOL_SIZE", "4")) # Connections kept open per database
+SQLITE_BUSY_TIMEOUT = int(os.getenv("SQLITE_BUSY_TIMEOUT", "30000")) # Milliseconds a write waits for the lock before giving up
+
+# Ollama
+OLLAMA_HOST = os.getenv("OLLAMA_HOST", "http://localhost:11434")
+DEFAULT_EMBED_MODEL = os.getenv("DEFAULT_EMBED_MODEL", "nomic-embed-text:latest")
+EMBED_CACHE_DB = os.path.join(DATA_DIR, "cache", "embeddings.db")
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "32")) # Chunks sent to /api/embed per request
+EMBED_CONCURRENCY = int(os.getenv("EMBED_CONCURRENCY", "4")) # Embedding requests in flight at once
+METADATA_MAX_CTX = int(os.getenv("METADATA_MAX_CTX", "8192")) # Upper bound on num_ctx for metadata generation, longer papers are split into windows
+OLLAMA_CONCURRENCY = int(os.getenv("OLLAMA_CONCURRENCY", "4")) # Generation requests in flight at once, match this to OLLAMA_NUM_PARALLEL
+OLLAMA_TIMEOUT = float(os.getenv("OLLAMA_TIMEOUT", "600")) # Seconds before a single request is abandoned
+OLLAMA_RETRIES = int(os.getenv("OLLAMA_RETRIES", "3"))
+OLLAMA_BACKOFF = float(os.getenv("OLLAMA_BACKOFF", "2")) # Seconds before the first retry, doubles after every retry
+MODEL_LIST_TTL = float(os.getenv("MODEL_LIST_TTL", "60")) # Seconds the app reuses the list of installed Ollama models
+METADATA_STREAM = os.getenv("METADATA_STREAM", "1") == "1" # Stream metadata generation so the workers can show partial fields
+METADATA_FIELD_RETRIES = int(os.getenv("METADATA_FIELD_RETRIES", "2")) # Requests for just the fields that came back missing or invalid
+
+# Storage coordinator
+STORAGE_BATCH_SIZE = int(os.getenv("STORAGE_BATCH_SIZE", "500")) # Papers per batch in bulk deletes, re-embedding and consistency checks
+
+# Similar papers and topics
+VECTORS_DIR = os.path.join(DATA_DIR, "vectors")
+SIMILARITY_BLOCK_SIZE = int(os.getenv("SIMILARITY_BLOCK_SIZE", "512")) # Papers compared at once in all pairs searches and clustering, memory grows with this times the library size
+TOPIC_COUNT = int(os.getenv("TOPIC_COUNT", "0")) # Topics the library is clustered into, 0 picks sqrt(papers / 2)
+TOPIC_MIN_PAPERS = int(os.getenv("TOPIC_MIN_PAPERS", "20")) # The library is only clustered once it has this many papers
+TOPIC_RECLUSTER_GROWTH = float(os.getenv("TOPIC_RECLUSTER_GROWTH", "0.2")) # Cluster again from scratch once the library changed by this fraction
+
+# Search caches
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", "1024")) # Query embeddings kept in memory
+QUERY_CACHE_TTL = float(os.getenv("QUERY_CACHE_TTL", "86400"))
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "256")) # Search result pages kept in memory
+RESULT_CACHE_TTL = float(os.getenv("RESULT_CACHE_TTL", "600"))
+
+# arXiv harvester
+HARVEST_PAGE_SIZE = int(os.getenv("HARVEST_PAGE_SIZE", "100")) # Results per arXiv API request
+HARVEST_CONCURRENCY = int(os.getenv("HARVEST_CONCURRENCY", "4")) # PDF downloads in flight at once
+HARVEST_RATE = float(os.getenv("HARVEST_RATE", "1")) # PDF downloads started per second across all threads, keep this polite
+HARVEST_MAX_PENDING = int(os.getenv("HARVEST_MAX_PENDING", "50")) # Downloading pauses while this many jobs wait in the queue
+
+# Pipeline metrics
+METRICS_DB = os.path.join(DATA_DIR, "metrics.db")
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+METRICS_RETENTION_DAYS = float(os.getenv("METRICS_RETENTION_DAYS", "30")) # Older spans are dropped on startup
+
+# Background ingest workers
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3")) # Attempts per job step before the job is marked as failed
+JOB_RETRY_DELAY = float(os.getenv("JOB_RETRY_DELAY", "10")) # Seconds before a failed step is retried (doubles each attempt)
+JOB_STALE_AFTER = float(os.getenv("JOB_STALE_AFTER", "1800")) # Seconds before a running step is assumed to belong to a dead worker
+WORKER_POLL_INTERVAL = float(os.getenv("WORKER_POLL_INTERVAL", "1"))
@@ -1,166 +1,177 @@
-import sqlite3
-import chromadb
 import uuid
+import re
 import json
+from typing import TYPE_CHECKING
 
-import chromadb.utils.embedding_functions.ollama_embedding_function as ollama_ef
-from langchain_core.documents import Document
-
-def initDatabases():
-    ''' Initialize the SQLite db for storing metadata and papers '''
-    conn = sqlite3.connect("data/metadata.db")
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS metadata
-                 (id TEXT PRIMARY KEY,
-                  title TEXT,
-                  summary TEXT,
-                  authors TEXT,
-                  link TEXT,
-                  datasets TEXT,
-                  metrics TEXT,
-                  methods TEXT,
-                  applications TEXT,
-                  limitations TEXT,
-                  areasOfImprovement TEXT)''')
-    conn.commit()
-    conn.close()
-
-ollamaEF = ollama_ef.OllamaEmbeddingFunction( # Custom embedding function that uses Ollama
-    url="http://localhost:11434/api/embeddings",
-    model_name="nomic-embed-text:latest",
-)
-chromaClient = chromadb.PersistentClient("./data/chroma")
-collection = chromaClient.get_or_create_collection("papers", embedding_function=ollamaEF)
-
-def storePaper(metadata: dict, documents: list[Document]):
-    ''' Stores the metadata in the SQLite and embeds documents (chunked parts of a paper) into ChromaDB '''
-    paperId = str(uuid.uuid4())
-    
-    # SQLite to store the metadata of paper
-    conn = sqlite3.connect('data/metadata.db')
-    c = conn.cursor()
-    c.execute('''INSERT INTO metadata VALUES (?,?,?,?,?,?,?,?,?,?,?)''', (
-        paperId,
-        metadata.get('title', ''),
-        metadata.get('summary', ''),
-        json.dumps(metadata.get('authors', [])),
-        metadata.get('link', ''),
-        json.dumps(metadata.get('datasets', {})),
-        json.dumps(metadata.get('metrics', {})),
-        json.dumps(metadata.get('methods', {})),
-        json.dumps(metadata.get('applications', [])),
-        json.dumps(metadata.get('limitations', [])),
-        json.dumps(metadata.get('areasOfImprovement', []))
-    ))
-    conn.commit()
-    conn.close()
+from repository import PaperRepository
+from storage import Storage
+from metrics import initMetrics, span
+
+repository = PaperRepository() # Shared by every caller in the process so connections (and their prepared statements) are reused
+storage = Storage(repository) # Owns the writes that touch both SQLite and ChromaDB, opens Chroma when first used
+
+if TYPE_CHECKING: # Only imported for the type hints, langchain is imported by the pages that parse or embed papers
+    from langchain_core.documents import Document
+
+def initDatabases(repair: bool = True):
+    ''' Initialize the SQLite db for storing metadata and papers. Processes that never write to ChromaDB (the app)
+    leave the repair of interrupted writes to the workers '''
+    repository.initSchema()
+    initMetrics()
+    storage.initStorage(repair)
+    if repository.getSetting("chunkIndexBackfill") == "pending":
+        backfillChunkIndex()
+
+def arxivBaseId(shortId: str) -> str:
+    ''' Strips the version from an arXiv short ID (2310.11453v1 -> 2310.11453) so every version maps to the same paper '''
+    return re.sub(r"v\d+$", "", shortId)
+
+def findExistingPaper(paperId: str = None, arxivId: str = None) -> str | None:
+    ''' Finds an already stored paper by its content hash or arXiv ID and returns its ID, or None if it is not stored '''
+    return repository.findExistingPaper(paperId, arxivId)
+
+def storePaper(metadata: dict, documents: list["Document"], embeddings: list[list[float]] = None, paperId: str = None, arxivId: str = None,
+               embedModel: str = None):
+    ''' Stores the metadata in the SQLite and embeds documents (chunked parts of a paper) into ChromaDB.
+    Precomputed embeddings (made with embedModel, the active embedding model by default) can be passed in, otherwise
+    the chunks are embedded with the batched embedding client.
+    Papers should be keyed by the content hash of their PDF so storing the same paper again replaces it '''
+    from embeddings import embedDocuments
+
+    paperId = paperId or str(uuid.uuid4())
+    embedModel = embedModel or storage.activeModel
+    if embeddings is None:
+        embeddings = embedDocuments(documents, embedModel)
     
-    # ChromaDB to store the embeddings of the paper text
-    documentMetadata = [doc.metadata for doc in documents]
-    for i in range(len(documentMetadata)):
-        documentMetadata[i]['paperId'] = paperId # Add the paper ID to the metadata
+    with span("store", paperId, chunks=len(documents)):
+        storage.storePaper(paperId, metadata, documents, embeddings, arxivId, embedModel)
 
-    collection.add(
-        ids=[f"{paperId}_{i}" for i in range(len(documents))],
-        documents=[doc.page_content for doc in documents], # These docs will be embedded with the Embedding Function specified in the collection
-        metadatas=documentMetadata,
-    )
+def searchChunks(query: str, nResults: int = 5, index: tuple[str, str] = None, queryEmbedding: list[float] = None) -> list[dict]:
+    ''' Searches for the chunks closest to the given query and returns their paper ID, distance, page and text, closest first.
+    Callers that search the same query several times can pass the index (model, collection) and the query embedding
+    made with its model, so the query is only embedded once '''
+    from embeddings import embedQuery
 
-def semanticSearch(query: str, nResults: int = 5) -> list[str]:
-    ''' Searches for papers similar to the given query and returns their IDs '''
     try:
-        results = collection.query(
-            query_texts=query,
-            n_results=nResults
-        )
-        return [metad['paperId'] for metad in results['metadatas'][0]]
+        model, collection = index or storage.activeIndex()
+        with span("search.vector", model=model, chars=len(query)) as info:
+            results = storage.getCollection(collection).query(
+                query_embeddings=[queryEmbedding or embedQuery(query, model)], # Embedded with the model of the index it searches
+                n_results=nResults
+            )
+            info["chunks"] = len(results["ids"][0])
+        return [{"paperId": metad['paperId'], "distance": distance, "page": metad.get('page', 0), "text": document}
+                for metad, distance, document in zip(results['metadatas'][0], results['distances'][0], results['documents'][0])]
     except Exception as e:
         raise Exception(f"Search failed: {str(e)}")
 
+def semanticSearch(query: str, nResults: int = 5) -> list[str]:
+    ''' Searches for papers similar to the given query and returns their IDs '''
+    return [chunk['paperId'] for chunk in searchChunks(query, nResults)]
+
+def backfillChunkIndex(batchSize: int = 1000):
+    ''' Copies the chunk texts of papers stored before the keyword index existed from ChromaDB into the index '''
+    chunks, offset = {}, 0
+    while True:
+        batch = storage.collection.get(include=["documents", "metadatas"], limit=batchSize, offset=offset)
+        if not batch["ids"]:
+            break
+        for chunkId, document, chunkMetadata in zip(batch["ids"], batch["documents"], batch["metadatas"]):
+            chunkIndex = int(chunkId.rsplit("_", 1)[1])
+            chunks.setdefault(chunkMetadata["paperId"], []).append((chunkIndex, chunkMetadata.get("page", 0), document))
+        offset += batchSize
+
+    stored = set(repository.filterPapers({})) # Skip vectors whose paper is no longer in SQLite
+    repository.replaceChunks({paperId: [(page, text) for _, page, text in sorted(paperChunks)]
+                              for paperId, paperChunks in chunks.items() if paperId in stored})
+    repository.setSetting("chunkIndexBackfill", "done")
+
+def getSimilarPapers(paperId: str, n: int = 5) -> list[dict]:
+    ''' Gets the papers most similar to a stored paper (by the mean of their chunk embeddings) with their cosine
+    similarity, most similar first '''
+    similar = dict(storage.vectors.similar(storage.activeIndex()[1], paperId, n))
+    return [{**paper, "similarity": similar[paper["id"]]} for paper in repository.getPapersByIds(list(similar))]
+
+def getPaperTopic(paperId: str) -> dict | None:
+    ''' Gets the topic of a paper with its number of papers and the title of the paper closest to its centre, or None
+    if the library has not been clustered yet '''
+    topic = storage.vectors.getTopic(storage.activeIndex()[1], paperId)
+    if topic and topic["exemplarId"]:
+        exemplar = repository.getPapersByIds([topic["exemplarId"]])
+        topic["exemplarTitle"] = exemplar[0]["title"] if exemplar else None
+    return topic
+
 def getPapersByIds(paperIds: list[str]) -> list[dict]:
-    ''' Gets the papers with the given IDs from the SQLite database '''
-    conn = sqlite3.connect('data/metadata.db')
-    c = conn.cursor()
-    placeholders = ','.join(['?']*len(paperIds))
-    c.execute(f"SELECT * FROM metadata WHERE id IN ({placeholders})", paperIds)
-
-    papers = []
-    for row in c.fetchall():
-        papers.append({
-            "id": row[0],
-            "title": row[1],
-            "summary": row[2],
-            "authors": json.loads(row[3]),
-            "link": row[4],
-            "datasets": json.loads(row[5]),
-            "metrics": json.loads(row[6]),
-            "methods": json.loads(row[7]),
-            "applications": json.loads(row[8]),
-            "limitations": json.loads(row[9]),
-            "areasOfImprovement": json.loads(row[10])
-        })
-    return papers
+    ''' Gets the papers with the given IDs from the SQLite database, in the same order as the IDs '''
+    return repository.getPapersByIds(paperIds)
 
 def getAllPapers() -> list[dict]:
     ''' Gets all papers stored in the SQLite database '''
-    conn = sqlite3.connect('data/metadata.db')
-    c = conn.cursor()
-    c.execute("SELECT * FROM metadata")
-
-    papers = []
-    for row in c.fetchall():
-        papers.append({
-            "id": row[0],
-            "title": row[1],
-            "summary": row[2],
-            "authors": json.loads(row[3]),
-            "link": row[4],
-            "datasets": json.loads(row[5]),
-            "metrics": json.loads(row[6]),
-            "methods": json.loads(row[7]),
-            "applications": json.loads(row[8]),
-            "limitations": json.loads(row[9]),
-            "areasOfImprovement": json.loads(row[10])
-        })
-    return papers
-
-def removePaper(paperId: str):
-    ''' Removes a given paper from the SQLite and ChromaDB databases '''
-    conn = sqlite3.connect('data/metadata.db')
-    c = conn.cursor()
-    c.execute("DELETE FROM metadata WHERE id=?", (paperId,))
-    conn.commit()
-    conn.close()
-
-    collection.delete(where={"paperId": paperId}) # Remove all documents associated with the paper
-
-def removeAllPapers():
-    ''' Removes all papers from the SQLite and ChromaDB databases '''
-    conn = sqlite3.connect('data/metadata.db')
-    c = conn.cursor()
-    c.execute("DELETE FROM metadata")
-    conn.commit()
-    conn.close()
-
-    chromaClient.delete_collection("papers") # Remove the entire collection
-    chromaClient.get_or_create_collection("papers", embedding_function=ollamaEF) # Recreate the collection
+    return repository.getAllPapers()
+
+def removePaper(paperId: str) -> str:
+    ''' Queues the removal of a given paper from the SQLite and ChromaDB databases for the store worker, returns the
+    ID of the job '''
+    from jobQueue import enqueueJob
+
+    papers = repository.getPapersByIds([paperId])
+    return enqueueJob("delete", json.dumps([paperId]), f"Remove {papers[0]['title'] if papers else paperId}", {})
+
+def removePapersWhere(filters: dict[str, list[str]]) -> int:
+    ''' Queues the removal of every paper matching the facet filters from both databases, returns how many will be removed '''
+    from jobQueue import enqueueJob
+
+    paperIds = repository.filterPapers(filters)
+    if paperIds:
+        enqueueJob("delete", json.dumps(paperIds), f"Remove {len(paperIds)} paper(s)", {})
+    return len(paperIds)
+
+def removeAllPapers() -> str:
+    ''' Queues the removal of all papers from the SQLite and ChromaDB databases for the store worker, returns the ID
+    of the job '''
+    from jobQueue import enqueueJob
+
+    return enqueueJob("reset", "", "Remove every paper", {})
 
 def updatePaper(paperId: str, metadata: dict):
     ''' Updates the metadata of specfic paper in the SQLite database '''
-    conn = sqlite3.connect('data/metadata.db')
-    c = conn.cursor()
-    c.execute('''UPDATE metadata SET title=?, summary=?, authors=?, link=?, datasets=?, metrics=?, methods=?, applications=?, limitations=?, areasOfImprovement=? WHERE id=?''', (
-        metadata.get('title', ''),
-        metadata.get('summary', ''),
-        json.dumps(metadata.get('authors', [])),
-        metadata.get('link', ''),
-        json.dumps(metadata.get('datasets', {})),
-        json.dumps(metadata.get('metrics', {})),
-        json.dumps(metadata.get('methods', {})),
-        json.dumps(metadata.get('applications', [])),
-        json.dumps(metadata.get('limitations', [])),
-        json.dumps(metadata.get('areasOfImprovement', [])),
-        paperId
-    ))
-    conn.commit()
-    conn.close()
\ No newline at end of file
+    repository.updatePapers({paperId: metadata})
+    repository.bumpGeneration()
+
+def filterPapers(filters: dict[str, list[str]], limit: int = -1, offset: int = 0) -> list[str]:
+    ''' Gets the IDs of the papers matching every facet filter, e.g. {"datasets": ["ImageNet"], "authors": [...]} '''
+    return repository.filterPapers(filters, limit, offset)
+
+def getFacetCounts(facet: str, filters: dict[str, list[str]] = None, limit: int = 20) -> list[tuple[str, int]]:
+    ''' Gets the most common values of a facet (e.g. "datasets") with the number of papers that have each one '''
+    return repository.getFacetCounts(facet, filters, limit)
+
+def updatePapers(updates: dict[str, dict]):
+    ''' Updates the metadata of several papers (paperId -> metadata) in a single transaction '''
+    repository.updatePapers(updates)
+    repository.bumpGeneration()
+
+def listPapers(filters: dict[str, list[str]] = None, text: str = None, sort: str = "addedAt", descending: bool = True,
+               after: tuple = None, limit: int = 20) -> tuple[list[dict], tuple | None]:
+    ''' Gets one keyset paginated page of paper summaries (id, title, link, addedAt) and the cursor of the next page '''
+    return repository.listPapers(filters, text, sort, descending, after, limit)
+
+def countPapers(filters: dict[str, list[str]] = None, text: str = None) -> int:
+    ''' Counts the papers matching the facet filters and text '''
+    return repository.countPapers(filters, text)
+
+def getActiveEmbedModel() -> str:
+    ''' Gets the embedding model that search uses and new papers are embedded with '''
+    return storage.activeModel
+
+def rebuildIndex(embedModel: str) -> int:
+    ''' Queues a rebuild of the vector index with another embedding model, search switches to it once it is complete '''
+    return storage.requestRebuild(embedModel)
+
+def getRebuilds() -> list[dict]:
+    ''' Gets the progress of the index rebuilds that have not finished yet '''
+    return storage.getRebuilds()
+
+def getGeneration() -> int:
+    ''' Gets the library generation, which changes whenever a paper is stored, edited or removed '''
+    return repository.getGeneration()
@@ -0,0 +1,130 @@
+import sqlite3
+import hashlib
+import threading
+import time
+import os
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING
+
+import httpx
+import ollama
+
+from cache import TTLCache
+from metrics import span
+from config import OLLAMA_HOST, EMBED_CACHE_DB, EMBED_BATCH_SIZE, EMBED_CONCURRENCY, QUERY_CACHE_SIZE, QUERY_CACHE_TTL
+
+if TYPE_CHECKING: # Only imported for the type hints
+    from langchain_core.documents import Document
+
+class EmbeddingClient:
+    ''' Embeds texts with an Ollama model using the batch /api/embed endpoint. Batches are sent concurrently over a
+    single pooled HTTP session and every vector is cached on disk by (model, sha256 of the text), so a chunk is
+    only ever embedded once per model
+
+    Args:
+        model: str - Name of the Ollama embedding model
+        batchSize: int - Number of texts sent per request
+        concurrency: int - Maximum number of requests in flight at once '''
+    def __init__(self, model: str, batchSize: int = EMBED_BATCH_SIZE, concurrency: int = EMBED_CONCURRENCY, cachePath: str = EMBED_CACHE_DB):
+        self.model = model
+        self.batchSize = batchSize
+        self.concurrency = concurrency
+        self.client = ollama.Client(host=OLLAMA_HOST, limits=httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency))
+        self.stats = {"chunks": 0, "cached": 0, "duplicates": 0, "seconds": 0.0, "chunksPerSecond": 0.0}
+
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(cachePath), exist_ok=True)
+        self._cache = sqlite3.connect(cachePath, timeout=30, check_same_thread=False)
+        self._cache.execute("PRAGMA journal_mode=WAL")
+        self._cache.execute('''CREATE TABLE IF NOT EXISTS embeddings
+                               (model TEXT,
+                                sha TEXT,
+                                vector BLOB,
+                                PRIMARY KEY (model, sha)) WITHOUT ROWID''')
+        self._cache.commit()
+
+    def _getCached(self, shas: list[str]) -> dict:
+        ''' Gets the cached vectors for the given text hashes '''
+        found = {}
+        with self._lock:
+            for i in range(0, len(shas), 500): # Stay under SQLite's limit on the number of parameters
+                batch = shas[i:i+500]
+                placeholders = ','.join(['?']*len(batch))
+                rows = self._cache.execute(f"SELECT sha, vector FROM embeddings WHERE model=? AND sha IN ({placeholders})", (self.model, *batch))
+                for sha, vector in rows:
+                    found[sha] = array('f', vector).tolist()
+        return found
+
+    def _putCached(self, vectors: dict):
+        ''' Caches the vectors of the given text hashes '''
+        with self._lock:
+            self._cache.executemany("INSERT OR REPLACE INTO embeddings VALUES (?,?,?)",
+                                    [(self.model, sha, array('f', vector).tobytes()) for sha, vector in vectors.items()])
+            self._cache.commit()
+
+    def _embedBatch(self, texts: list[str]) -> list[list[float]]:
+        ''' Embeds one batch of texts with a single request '''
+        return [list(vector) for vector in self.client.embed(model=self.model, input=texts).embeddings]
+
+    def embed(self, texts: list[str]) -> list[list[float]]:
+        ''' Embeds the given texts, only the ones that have not been embedded with this model before are sent to Ollama '''
+        try:
+            with span("embed", model=self.model, chunks=len(texts), chars=sum(len(text) for text in texts)):
+                return self._embed(texts)
+        except Exception as e:
+            raise Exception(f"Embedding generation failed: {str(e)}")
+
+    def _embed(self, texts: list[str]) -> list[list[float]]:
+        ''' Embeds the given texts through the cache '''
+        start = time.perf_counter()
+        shas = [hashlib.sha256(text.encode()).hexdigest() for text in texts]
+        vectors = self._getCached(list(set(shas)))
+
+        missing = list({sha: text for sha, text in zip(shas, texts) if sha not in vectors}.items())
+        batches = [missing[i:i+self.batchSize] for i in range(0, len(missing), self.batchSize)]
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            results = executor.map(lambda batch: self._embedBatch([text for _, text in batch]), batches)
+            for batch, batchVectors in zip(batches, results):
+                newVectors = {sha: vector for (sha, _), vector in zip(batch, batchVectors)}
+                self._putCached(newVectors)
+                vectors.update(newVectors)
+
+        seconds = time.perf_counter() - start
+        with self._lock:
+            self.stats["chunks"] += len(texts)
+            self.stats["cached"] += len(set(shas)) - len(missing) # Unique texts found in the cache
+            self.stats["duplicates"] += len(texts) - len(set(shas)) # Repeats of a text earlier in the same call, embedded once
+            self.stats["seconds"] += seconds
+            self.stats["chunksPerSecond"] = self.stats["chunks"] / self.stats["seconds"] if self.stats["seconds"] else 0.0
+        return [vectors[sha] for sha in shas]
+
+_clients = {}
+_clientsLock = threading.Lock()
+
+def getEmbeddingClient(model: str) -> EmbeddingClient:
+    ''' Gets the shared embedding client of a model so its HTTP session and cache connection are reused '''
+    with _clientsLock:
+        if model not in _clients:
+            _clients[model] = EmbeddingClient(model)
+        return _clients[model]
+
+def embedDocuments(documents: list["Document"], model: str) -> list[list[float]]:
+    ''' Embeds the documents (chunked parts of a paper) with the given model '''
+    return getEmbeddingClient(model).embed([doc.page_content for doc in documents])
+
+queryCache = TTLCache(QUERY_CACHE_SIZE, QUERY_CACHE_TTL)
+
+def normalizeQuery(query: str) -> str:
+    ''' Normalizes a search query so trivially different queries (case, spacing) share their cache entries '''
+    return " ".join(query.lower().split())
+
+def embedQuery(query: str, model: str) -> list[float]:
+    ''' Embeds a search query, repeated queries are served from an in-memory LRU/TTL cache keyed by (model, normalized query).
+    The normalized query is only the key, the query is embedded as it was written '''
+    key = (model, normalizeQuery(query))
+    vector = queryCache.get(key)
+    if vector is None:
+        vector = getEmbeddingClient(model)._embedBatch([query])[0] # Bypass the on-disk chunk cache, queries do not belong there
+        queryCache.put(key, vector)
+    return vector
@@ -1,29 +1,46 @@
 import fitz
 from langchain_core.documents import Document
-from langchain_community.document_loaders import PyPDFLoader
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 
-def extractText(pdfPath: str) -> str:
-    ''' Extracts text from a PDF file TODO: Maybe upgrade to read each page 
+from metrics import span
+
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 100
+
+def extractPages(pdfPath: str) -> list[str]:
+    ''' Extracts the text of each page of a PDF file in a single pass TODO: Maybe upgrade to read each page
     separately as an image in order to gather context from graphs and images '''
     try:
-        text = ""
-        with fitz.open(pdfPath) as doc:
-            for page in doc:
-                text += page.get_text()
-        return text
+        with span("extract") as info, fitz.open(pdfPath) as doc:
+            pages = [page.get_text() for page in doc]
+            info.update(pages=len(pages), chars=sum(len(page) for page in pages))
+            return pages
     except Exception as e:
         raise Exception(f"Failed to extract text: {str(e)}")
-    
+
+def extractText(pdfPath: str) -> str:
+    ''' Extracts text from a PDF file '''
+    return "".join(extractPages(pdfPath))
+
+def chunkPages(pages: list[str], source: str) -> list[Document]:
+    ''' Chunks already extracted pages into smaller parts for processing, keeping the page number of each chunk '''
+    try:
+        with span("chunk", pages=len(pages), chars=sum(len(page) for page in pages)) as info:
+            document = [Document(page_content=text, metadata={"source": source, "page": i, "total_pages": len(pages)}) for i, text in enumerate(pages)]
+            text_splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
+
+            chunked_documents = text_splitter.split_documents(document)
+            info["chunks"] = len(chunked_documents)
+            return chunked_documents
+    except Exception as e:
+        raise Exception(f"Failed to chunk document: {str(e)}")
+
 def chunkDocument(filePath: str) -> list[Document]:
     ''' Chunks the document into smaller parts for processing. This fixes semantic
     search issues with large documents that were embedded as a whole '''
-    try:
-        loader = PyPDFLoader(filePath)
-        document = loader.load()
-        text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=100)
+    return chunkPages(extractPages(filePath), filePath)
 
-        chunked_documents = text_splitter.split_documents(document)
-        return chunked_documents
-    except Exception as e:
-        raise Exception(f"Failed to chunk document: {str(e)}")
\ No newline at end of file
+def parsePaper(pdfPath: str) -> tuple[str, list[Document]]:
+    ''' Parses a PDF once and returns both the full text (for metadata generation) and its chunks (for embedding) '''
+    pages = extractPages(pdfPath)
+    return "".join(pages), chunkPages(pages, pdfPath)
@@ -0,0 +1,179 @@
+''' Local stand-in for the Ollama API used by the benchmarks, so the pipeline can be measured without a GPU or the
+network. Embeddings are deterministic unit vectors derived from the text, generations are schema-valid Metadata JSON
+derived from the prompt, and every request can be slowed down to mimic a real model (or made to fail, for the tests):
+
+    python app/fakeOllama.py --port 11435 --latency 0.5
+'''
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+WORDS = ["graph", "neural", "network", "transformer", "attention", "dataset", "benchmark", "accuracy", "latency", "robust",
+         "retrieval", "language", "model", "vision", "training", "inference", "sparse", "quantized", "federated", "causal"]
+
+def fakeEmbedding(text: str, dim: int) -> list[float]:
+    ''' Deterministic unit vector of a text, the same text always gets the same vector '''
+    rng = random.Random(hashlib.sha256(text.encode()).digest())
+    vector = [rng.gauss(0, 1) for _ in range(dim)]
+    norm = sum(x * x for x in vector) ** 0.5
+    return [x / norm for x in vector]
+
+def fakeMetadata(prompt: str) -> dict:
+    ''' Deterministic metadata for a prompt that validates against processPaper.Metadata '''
+    rng = random.Random(hashlib.sha256(prompt.encode()).digest())
+    phrase = lambda n: " ".join(rng.choice(WORDS) for _ in range(n))
+    return {
+        "title": phrase(6).title(),
+        "summary": ". ".join(phrase(12).capitalize() for _ in range(4)) + ".",
+        **{field: [phrase(3) for _ in range(rng.randint(1, 4))]
+           for field in ["datasets", "metrics", "methods", "applications", "limitations", "areasOfImprovement"]},
+    }
+
+class FakeOllama:
+    ''' Fake Ollama server running on a background thread
+
+    Args:
+        latency: float - Seconds every request takes on top of its work
+        embedLatency: float - Extra seconds per embedded text
+        dim: int - Size of the embeddings
+        contextLength: int - Context length reported for every model
+        failures: int - Number of POST requests answered with failStatus before the server starts answering normally '''
+    def __init__(self, port: int = 0, latency: float = 0.0, embedLatency: float = 0.0, dim: int = 768, contextLength: int = 8192,
+                 failures: int = 0, failStatus: int = 503):
+        self.latency = latency
+        self.embedLatency = embedLatency
+        self.dim = dim
+        self.contextLength = contextLength
+        self.failures = failures
+        self.failStatus = failStatus
+        self.requests = {"embed": 0, "generate": 0, "show": 0, "tags": 0}
+        self.inFlight, self.maxInFlight = 0, 0 # POST requests being served right now and the most there ever were at once
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def host(self) -> str:
+        ''' Gets the URL to point OLLAMA_HOST at '''
+        return f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def start(self) -> "FakeOllama":
+        ''' Starts serving in the background '''
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        ''' Stops the server '''
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _handler(self):
+        ''' Builds the request handler class bound to this server '''
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args): # Keep the benchmark output clean
+                pass
+
+            def _send(self, body: dict | list, stream: bool = False):
+                if stream: # Ollama streams newline delimited JSON objects
+                    data = "".join(json.dumps(chunk) + "\n" for chunk in body).encode()
+                    contentType = "application/x-ndjson"
+                else:
+                    data, contentType = json.dumps(body).encode(), "application/json"
+                try:
+                    self.send_response(200)
+                    self.send_header("Content-Type", contentType)
+                    self.send_header("Content-Length", str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data)
+                except (BrokenPipeError, ConnectionResetError): # The client gave up on the request (timed out)
+                    pass
+
+            def do_GET(self):
+                if self.path == "/api/tags":
+                    fake.requests["tags"] += 1
+                    self._send({"models": [{"name": name, "model": name, "size": 0} for name in ("fake-llm:latest", "fake-embed:latest")]})
+                else:
+                    self.send_error(404)
+
+            def do_HEAD(self):
+                self.send_response(200)
+                self.end_headers()
+
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                kind = {"/api/embed": "embed", "/api/embeddings": "embed", "/api/generate": "generate", "/api/show": "show"}.get(self.path)
+                with fake._lock:
+                    if kind:
+                        fake.requests[kind] += 1
+                    fake.inFlight += 1
+                    fake.maxInFlight = max(fake.maxInFlight, fake.inFlight)
+                    fail, fake.failures = fake.failures > 0, max(fake.failures - 1, 0)
+                try:
+                    time.sleep(fake.latency)
+                    if fail:
+                        self.send_error(fake.failStatus)
+                    else:
+                        self._answer(request)
+                finally:
+                    with fake._lock:
+                        fake.inFlight -= 1
+
+            def _answer(self, request: dict):
+                now = datetime.now(timezone.utc).isoformat()
+                if self.path in ("/api/embed", "/api/embeddings"):
+                    texts = request.get("input", request.get("prompt", ""))
+                    texts = [texts] if isinstance(texts, str) else texts
+                    time.sleep(fake.embedLatency * len(texts))
+                    vectors = [fakeEmbedding(text, fake.dim) for text in texts]
+                    if self.path == "/api/embeddings": # Legacy single text endpoint
+                        self._send({"embedding": vectors[0]})
+                    else:
+                        self._send({"model": request.get("model"), "embeddings": vectors})
+
+                elif self.path == "/api/generate":
+                    prompt = request.get("prompt", "")
+                    response = json.dumps(fakeMetadata(prompt))
+                    done = {"model": request.get("model"), "created_at": now, "done": True, "done_reason": "stop",
+                            "prompt_eval_count": len(prompt) // 4, "eval_count": len(response) // 4}
+                    if request.get("stream"):
+                        pieces = [response[i:i+16] for i in range(0, len(response), 16)]
+                        self._send([{"model": request.get("model"), "created_at": now, "response": piece, "done": False} for piece in pieces]
+                                   + [{**done, "response": ""}], stream=True)
+                    else:
+                        self._send({**done, "response": response})
+
+                elif self.path == "/api/show":
+                    self._send({"modelfile": "", "parameters": "", "template": "", "details": {"family": "fake"},
+                                "model_info": {"fake.context_length": fake.contextLength}})
+
+                else:
+                    self.send_error(404)
+
+        return Handler
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Ollama server with deterministic embeddings and metadata")
+    parser.add_argument("--port", type=int, default=11435)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds every request takes")
+    parser.add_argument("--embed-latency", type=float, default=0.0, help="Extra seconds per embedded text")
+    parser.add_argument("--dim", type=int, default=768, help="Size of the embeddings")
+    args = parser.parse_args()
+
+    server = FakeOllama(args.port, args.latency, args.embed_latency, args.dim).start()
+    print(f"Fake Ollama listening on {server.host}, press Ctrl+C to stop")
+    try:
+        server._thread.join()
+    except KeyboardInterrupt:
+        server.stop()
+
+if __name__ == "__main__":
+    main()
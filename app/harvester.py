@@ -0,0 +1,261 @@
+''' arXiv harvester that pages through every result of a search, downloads the PDFs concurrently under a global
+rate limit and feeds them to the ingest queue as they arrive, so downloading overlaps with the LLM steps. Progress is
+kept in the job database, an interrupted harvest resumes from its cursor instead of starting over. Harvests are run
+by the worker pool (python app/worker.py), or directly:
+
+    python app/harvester.py "graph neural networks" --max-results 500 --gen-model llama3.2:latest
+'''
+import argparse
+import json
+import os
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import TYPE_CHECKING
+
+import httpx
+
+if TYPE_CHECKING: # Only imported for the type hints
+    import arxiv
+
+from jobQueue import pool, initJobQueue, enqueueJob, getJobCounts
+from config import (PAPERS_DIR, HARVEST_PAGE_SIZE, HARVEST_CONCURRENCY, HARVEST_RATE, HARVEST_MAX_PENDING,
+                    JOB_STALE_AFTER, WORKER_POLL_INTERVAL)
+
+def initHarvester():
+    ''' Creates the tables that keep the cursor and progress of each harvest '''
+    with pool.transaction() as conn:
+        conn.execute('''CREATE TABLE IF NOT EXISTS harvests
+                        (id TEXT PRIMARY KEY,
+                         query TEXT,
+                         maxResults INTEGER,
+                         options TEXT,
+                         status TEXT,
+                         cursor INTEGER DEFAULT 0,
+                         downloaded INTEGER DEFAULT 0,
+                         skipped INTEGER DEFAULT 0,
+                         failed INTEGER DEFAULT 0,
+                         error TEXT,
+                         workerId TEXT,
+                         createdAt REAL,
+                         updatedAt REAL)''')
+        conn.execute('''CREATE TABLE IF NOT EXISTS harvest_items
+                        (harvestId TEXT,
+                         arxivId TEXT,
+                         status TEXT,
+                         detail TEXT,
+                         PRIMARY KEY (harvestId, arxivId)) WITHOUT ROWID''')
+
+def createHarvest(query: str, maxResults: int, options: dict) -> str:
+    ''' Queues a new harvest of the given arXiv search and returns its ID, the options are passed on to its ingest jobs '''
+    harvestId, now = str(uuid.uuid4()), time.time()
+    with pool.transaction() as conn:
+        conn.execute("INSERT INTO harvests (id, query, maxResults, options, status, createdAt, updatedAt) VALUES (?,?,?,?,?,?,?)",
+                     (harvestId, query, maxResults, json.dumps(options), "queued", now, now))
+    return harvestId
+
+def getHarvests(limit: int = 10) -> list[dict]:
+    ''' Gets the most recent harvests for displaying their progress '''
+    with pool.connection() as conn:
+        rows = conn.execute("SELECT * FROM harvests ORDER BY createdAt DESC LIMIT ?", (limit,)).fetchall()
+    return [dict(row) for row in rows]
+
+def claimHarvest(workerId: str, staleAfter: float = JOB_STALE_AFTER) -> dict | None:
+    ''' Atomically claims the oldest queued harvest, or a running one whose worker has stopped updating it '''
+    with pool.transaction() as conn:
+        row = conn.execute('''SELECT * FROM harvests WHERE status='queued' OR (status='running' AND updatedAt<?)
+                              ORDER BY createdAt LIMIT 1''', (time.time() - staleAfter,)).fetchone()
+        if row is None:
+            return None
+
+        conn.execute("UPDATE harvests SET status='running', workerId=?, updatedAt=? WHERE id=?", (workerId, time.time(), row["id"]))
+    harvest = dict(row)
+    harvest["options"] = json.loads(harvest["options"])
+    return harvest
+
+def releaseWorkerHarvests(workerPrefix: str):
+    ''' Requeues the running harvests of the workers whose IDs start with the given prefix, they resume from their cursor '''
+    with pool.transaction() as conn:
+        conn.execute("UPDATE harvests SET status='queued', workerId=NULL WHERE status='running' AND workerId LIKE ?", (workerPrefix + "%",))
+
+class RateLimiter:
+    ''' Spaces out requests made from any number of threads so that at most `rate` of them start per second '''
+    def __init__(self, rate: float):
+        self.interval = 1 / rate
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        ''' Blocks until the caller is allowed to start its request '''
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        time.sleep(start - now)
+
+def pdfPath(shortId: str) -> str:
+    ''' Gets where the PDF of an arXiv paper is kept, old style IDs (hep-th/9901001) contain a slash '''
+    return os.path.join(PAPERS_DIR, shortId.replace("/", "_") + ".pdf")
+
+def downloadPdf(http: httpx.Client, limiter: RateLimiter, url: str, path: str):
+    ''' Downloads a PDF to a temporary file that is only moved into place once complete, so an interrupted download
+    never leaves a truncated PDF behind that a resumed harvest would mistake for a finished one '''
+    limiter.wait()
+    partial = path + ".part"
+    with http.stream("GET", url) as response:
+        response.raise_for_status()
+        with open(partial, "wb") as f:
+            for data in response.iter_bytes():
+                f.write(data)
+    os.replace(partial, path)
+
+def harvestPaper(result: "arxiv.Result", options: dict, http: httpx.Client, limiter: RateLimiter) -> tuple[str, str]:
+    ''' Downloads one search result (unless it is stored or its PDF is already on disk) and queues it for ingestion,
+    returns its (status, detail) '''
+    from database import findExistingPaper, arxivBaseId
+
+    shortId = result.get_short_id()
+    if findExistingPaper(arxivId=arxivBaseId(shortId)):
+        return "skipped", "Already in the database"
+
+    path = pdfPath(shortId)
+    cached = os.path.exists(path) and os.path.getsize(path) > 0
+    if not cached:
+        downloadPdf(http, limiter, result.pdf_url, path)
+
+    download = { # Same artifact as worker.downloadStep, so the job goes straight to parsing
+        "path": path,
+        "overrides": {
+            "title": result.title,
+            "authors": [a.name for a in result.authors],
+            "link": "https://arxiv.org/abs/" + shortId,
+        }
+    }
+    enqueueJob("arxiv", shortId, result.title, options, {"download": download})
+    return "downloaded", "PDF already on disk" if cached else ""
+
+def runHarvest(harvest: dict, concurrency: int = HARVEST_CONCURRENCY, rate: float = HARVEST_RATE, maxPending: int = HARVEST_MAX_PENDING,
+               client: "arxiv.Client" = None):
+    ''' Runs a harvest from its cursor. Results are paged from the arXiv API HARVEST_PAGE_SIZE at a time (or by the given client) and downloaded
+    by a thread pool, at most `concurrency` at once and `rate` per second. The cursor only moves past a result once it
+    and every result before it are finished, so a resumed harvest never misses one, and the results that were already
+    finished past the cursor are recognised by their harvest_items row and skipped '''
+    harvestId = harvest["id"]
+    with pool.connection() as conn:
+        finished = {row["arxivId"] for row in conn.execute("SELECT arxivId FROM harvest_items WHERE harvestId=?", (harvestId,))}
+
+    os.makedirs(PAPERS_DIR, exist_ok=True)
+    import arxiv # Only the harvest workers need it, not the app pages that create or show harvests
+
+    client = client or arxiv.Client(page_size=HARVEST_PAGE_SIZE, delay_seconds=3, num_retries=5) # arXiv asks for 3 seconds between API calls
+    search = arxiv.Search(query=harvest["query"], max_results=harvest["maxResults"])
+    limiter = RateLimiter(rate)
+    cursor, done = harvest["cursor"], set()
+
+    def advance(index: int):
+        ''' Marks a result as finished and moves the cursor past every finished result at its front '''
+        nonlocal cursor
+        done.add(index)
+        while cursor in done:
+            done.remove(cursor)
+            cursor += 1
+
+    def record(index: int, shortId: str, status: str, detail: str):
+        ''' Stores the outcome of one result along with the cursor '''
+        advance(index)
+        with pool.transaction() as conn: # The status is one of the counter columns: downloaded, skipped or failed
+            conn.execute("INSERT OR REPLACE INTO harvest_items VALUES (?,?,?,?)", (harvestId, shortId, status, detail))
+            conn.execute(f"UPDATE harvests SET cursor=?, {status}={status}+1, updatedAt=? WHERE id=?", (cursor, time.time(), harvestId))
+
+    def heartbeat():
+        ''' Keeps the harvest from looking abandoned while it waits '''
+        with pool.transaction() as conn:
+            conn.execute("UPDATE harvests SET updatedAt=? WHERE id=?", (time.time(), harvestId))
+
+    def collect(futures: dict, block: bool):
+        ''' Records the downloads that have finished '''
+        completed, _ = wait(futures, timeout=None if block else 0, return_when=FIRST_COMPLETED)
+        for future in completed:
+            index, shortId = futures.pop(future)
+            try:
+                record(index, shortId, *future.result())
+            except Exception as e:
+                record(index, shortId, "failed", str(e))
+
+    try:
+        with httpx.Client(timeout=120, follow_redirects=True, headers={"User-Agent": "research-paper-overview harvester"}) as http, \
+             ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = {}
+            for index, result in enumerate(client.results(search, offset=cursor), start=cursor):
+                shortId = result.get_short_id()
+                if shortId in finished:
+                    advance(index) # Finished before the harvest was interrupted, only the cursor has to catch up
+                    continue
+
+                while getJobCounts().get("queued", 0) >= maxPending: # Let the ingest workers catch up before downloading more
+                    collect(futures, block=False)
+                    heartbeat()
+                    time.sleep(WORKER_POLL_INTERVAL)
+                while len(futures) >= concurrency * 2: # Keep a few results ready so the download threads are never idle
+                    collect(futures, block=True)
+                futures[executor.submit(harvestPaper, result, harvest["options"], http, limiter)] = (index, shortId)
+
+            while futures:
+                collect(futures, block=True)
+
+        with pool.transaction() as conn:
+            conn.execute("UPDATE harvests SET status='done', cursor=?, workerId=NULL, updatedAt=? WHERE id=?", (cursor, time.time(), harvestId))
+    except Exception as e:
+        with pool.transaction() as conn: # Keeps its cursor, so retrying the harvest resumes where it failed
+            conn.execute("UPDATE harvests SET status='failed', error=?, workerId=NULL, updatedAt=? WHERE id=?", (str(e), time.time(), harvestId))
+        raise
+
+def runHarvestWorker(workerId: str, concurrency: int = HARVEST_CONCURRENCY):
+    ''' Worker loop that keeps claiming and running queued harvests '''
+    while True:
+        harvest = claimHarvest(workerId)
+        if harvest is None:
+            time.sleep(WORKER_POLL_INTERVAL)
+            continue
+        try:
+            runHarvest(harvest, concurrency)
+        except Exception:
+            traceback.print_exc()
+
+def retryHarvest(harvestId: str):
+    ''' Requeues a failed harvest, it resumes from its cursor '''
+    with pool.transaction() as conn:
+        conn.execute("UPDATE harvests SET status='queued', error=NULL, updatedAt=? WHERE id=? AND status='failed'", (time.time(), harvestId))
+
+def main():
+    parser = argparse.ArgumentParser(description="Harvest the papers of an arXiv search into the ingest queue")
+    parser.add_argument("query", nargs="?", help="arXiv search query")
+    parser.add_argument("--max-results", type=int, default=100)
+    parser.add_argument("--resume", help="ID of an interrupted or failed harvest to resume instead")
+    parser.add_argument("--concurrency", type=int, default=HARVEST_CONCURRENCY, help="PDF downloads in flight at once")
+    parser.add_argument("--gen-model", help="Ollama model the ingest workers generate metadata with")
+    args = parser.parse_args()
+    if not args.resume and not (args.query and args.gen_model):
+        parser.error("a query and --gen-model, or --resume, are required")
+
+    initJobQueue()
+    initHarvester()
+    harvestId = args.resume or createHarvest(args.query, args.max_results, {"genModel": args.gen_model})
+
+    workerId = f"harvester-{os.getpid()}"
+    with pool.transaction() as conn:
+        conn.execute("UPDATE harvests SET status='running', workerId=?, updatedAt=? WHERE id=?", (workerId, time.time(), harvestId))
+        row = conn.execute("SELECT * FROM harvests WHERE id=?", (harvestId,)).fetchone()
+    harvest = {**dict(row), "options": json.loads(row["options"])}
+
+    print(f"Harvesting '{harvest['query']}' ({harvestId}) from result {harvest['cursor']}, start the ingest workers to process the papers")
+    try:
+        runHarvest(harvest, args.concurrency)
+    except KeyboardInterrupt:
+        releaseWorkerHarvests(workerId)
+        print(f"Stopped, resume with: python app/harvester.py --resume {harvestId}")
+
+if __name__ == "__main__":
+    main()
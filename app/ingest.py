@@ -0,0 +1,265 @@
+''' Headless bulk ingest for backfilling large collections of papers without the Streamlit app:
+
+    python app/ingest.py "papers/**/*.pdf" --gen-model llama3.2:latest --parse-workers 8 --llm-concurrency 4
+    python app/ingest.py --manifest papers.txt --gen-model llama3.2:latest
+    python app/ingest.py --arxiv 2310.11453 2402.17764 --gen-model llama3.2:latest
+
+PDFs are parsed by a process pool while the metadata of the previous batch is generated, every paper's outcome is
+checkpointed so a rerun skips the papers that are done, and failed papers are retried before the run ends. Do not run
+it alongside worker.py, both write to ChromaDB which is only safe from a single process
+'''
+import argparse
+import glob
+import json
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from jobQueue import pool
+from ingestCache import hashFile, getCached, putCached
+from metrics import paperContext
+from config import PAPERS_DIR, METADATA_MAX_CTX, OLLAMA_CONCURRENCY, HARVEST_CONCURRENCY, HARVEST_RATE
+
+ARXIV_ID = re.compile(r"^(\d{4}\.\d{4,5}|[a-z\-]+(\.[A-Z]{2})?/\d{7})(v\d+)?$") # New (2310.11453) and old (hep-th/9901001) style IDs
+
+def initCheckpoint():
+    ''' Creates the table that keeps the outcome of every ingested source, so an interrupted run can be resumed '''
+    with pool.transaction() as conn:
+        conn.execute('''CREATE TABLE IF NOT EXISTS ingest_checkpoint
+                        (source TEXT PRIMARY KEY,
+                         status TEXT,
+                         paperId TEXT,
+                         attempts INTEGER DEFAULT 0,
+                         error TEXT,
+                         updatedAt REAL)''')
+
+def getCheckpoint(sources: list[str]) -> dict[str, str]:
+    ''' Gets the status of the sources that were ingested before '''
+    with pool.connection() as conn:
+        rows = conn.execute("SELECT source, status FROM ingest_checkpoint WHERE source IN (SELECT value FROM json_each(?))", (json.dumps(sources),))
+        return {row["source"]: row["status"] for row in rows}
+
+def checkpoint(source: str, status: str, paperId: str = None, error: str = None):
+    ''' Records the outcome of a source: done, skipped (already stored) or failed '''
+    with pool.transaction() as conn:
+        conn.execute('''INSERT INTO ingest_checkpoint (source, status, paperId, attempts, error, updatedAt) VALUES (?,?,?,1,?,?)
+                        ON CONFLICT(source) DO UPDATE SET status=excluded.status, paperId=excluded.paperId, attempts=attempts+1,
+                        error=excluded.error, updatedAt=excluded.updatedAt''', (source, status, paperId, error, time.time()))
+
+def resolveSources(patterns: list[str], manifest: str = None, arxivIds: list[str] = None) -> list[str]:
+    ''' Expands the glob patterns, manifest lines (PDF paths or arXiv IDs) and arXiv IDs into one ordered list of sources '''
+    sources = []
+    for pattern in patterns:
+        sources += sorted(glob.glob(pattern, recursive=True))
+    if manifest:
+        with open(manifest) as f:
+            sources += [line.strip() for line in f if line.strip() and not line.startswith("#")]
+    sources += arxivIds or []
+    return list(dict.fromkeys(sources)) # Drop duplicates but keep the order
+
+def parseFile(path: str) -> dict:
+    ''' Hashes, parses and chunks one PDF, run in the process pool. The pages and chunks are cached like in the worker '''
+    from extractText import extractPages, chunkPages, CHUNK_SIZE, CHUNK_OVERLAP
+
+    start = time.perf_counter()
+    paperHash = hashFile(path)
+    with paperContext(paperHash):
+        pages = getCached(paperHash, "pages")
+        if pages is None:
+            pages = extractPages(path)
+            putCached(paperHash, "pages", pages)
+        key = f"{CHUNK_SIZE}/{CHUNK_OVERLAP}"
+        chunks = getCached(paperHash, "chunks", key)
+        if chunks is None:
+            chunks = [{"page_content": doc.page_content, "metadata": doc.metadata} for doc in chunkPages(pages, path)]
+            putCached(paperHash, "chunks", chunks, key)
+    return {"hash": paperHash, "pages": pages, "chunks": chunks, "seconds": time.perf_counter() - start}
+
+def downloadArxiv(arxivIds: list[str], concurrency: int = HARVEST_CONCURRENCY) -> dict[str, dict]:
+    ''' Downloads the PDFs of arXiv papers (one API request for all of them, the PDFs concurrently under the harvester's
+    rate limit) and returns {arXiv ID without version: {path, overrides}} '''
+    import arxiv
+    import httpx
+    from harvester import RateLimiter, pdfPath, downloadPdf
+    from database import arxivBaseId
+
+    os.makedirs(PAPERS_DIR, exist_ok=True)
+    results = arxiv.Client().results(arxiv.Search(id_list=arxivIds, max_results=len(arxivIds)))
+    limiter = RateLimiter(HARVEST_RATE)
+    downloads = {}
+    with httpx.Client(timeout=120, follow_redirects=True) as http, ThreadPoolExecutor(max_workers=concurrency) as executor:
+        def fetch(result) -> tuple[str, dict]:
+            path = pdfPath(result.get_short_id())
+            if not os.path.exists(path):
+                downloadPdf(http, limiter, result.pdf_url, path)
+            return arxivBaseId(result.get_short_id()), {"path": path, "overrides": {
+                "title": result.title,
+                "authors": [a.name for a in result.authors],
+                "link": "https://arxiv.org/abs/" + result.get_short_id(),
+            }}
+        for arxivId, download in executor.map(fetch, list(results)):
+            downloads[arxivId] = download
+    return downloads
+
+class BulkIngest:
+    ''' Runs the ingest pipeline over batches of sources. The next batch is parsed by the process pool while the
+    metadata of the current batch is generated, so the CPU and LLM stages overlap
+
+    Args:
+        genModel: str - Ollama model the metadata is generated with
+        parseWorkers: int - Processes parsing PDFs at once
+        llmConcurrency: int - Metadata requests in flight at once
+        batchSize: int - Papers per batch '''
+    def __init__(self, genModel: str, parseWorkers: int, llmConcurrency: int, batchSize: int):
+        self.genModel = genModel
+        self.parseWorkers = parseWorkers
+        self.llmConcurrency = llmConcurrency
+        self.batchSize = batchSize
+        self.stats = {"papers": 0, "skipped": 0, "failed": 0, "chunks": 0}
+        self.timings = {"download": 0.0, "parse": 0.0, "metadata": 0.0, "embed": 0.0, "store": 0.0} # Wall clock seconds per stage, parse is CPU seconds summed over the pool
+
+    def _prepare(self, batch: list[str], executor: ProcessPoolExecutor) -> list:
+        ''' Downloads the arXiv sources of a batch and submits all of its PDFs to the parse pool '''
+        from database import arxivBaseId
+
+        start = time.perf_counter()
+        arxivIds = [source for source in batch if ARXIV_ID.match(source) and not os.path.exists(source)]
+        downloads = {}
+        if arxivIds:
+            try:
+                downloads = downloadArxiv(arxivIds)
+            except Exception as e:
+                for arxivId in arxivIds:
+                    self._fail(arxivId, f"Download failed: {str(e)}")
+        self.timings["download"] += time.perf_counter() - start
+
+        prepared = []
+        for source in batch:
+            download = downloads.get(arxivBaseId(source)) if source in arxivIds else None
+            if source in arxivIds and download is None:
+                if downloads: # The API answered but did not know this ID
+                    self._fail(source, "Not found on arXiv")
+                continue
+            path = download["path"] if download else source
+            prepared.append((source, download, executor.submit(parseFile, path)))
+        return prepared
+
+    def _fail(self, source: str, error: str):
+        ''' Records a failed source '''
+        self.stats["failed"] += 1
+        checkpoint(source, "failed", error=error)
+        print(f"Failed: {source}: {error}")
+
+    def _ingest(self, prepared: list):
+        ''' Generates the metadata of a parsed batch in one pipelined request batch, then embeds and stores each paper '''
+        from langchain_core.documents import Document
+        from processPaper import generateMetadataBatch
+        from embeddings import embedDocuments
+        from database import storePaper, findExistingPaper, arxivBaseId, getActiveEmbedModel
+
+        parsed = []
+        for source, download, future in prepared:
+            try:
+                paper = future.result()
+            except Exception as e:
+                self._fail(source, str(e))
+                continue
+            self.timings["parse"] += paper["seconds"]
+            if findExistingPaper(paperId=paper["hash"], arxivId=arxivBaseId(source) if download else None):
+                self.stats["skipped"] += 1
+                checkpoint(source, "skipped", paper["hash"])
+                continue
+            parsed.append((source, download, paper))
+
+        start = time.perf_counter()
+        key = f"{self.genModel}/{METADATA_MAX_CTX}"
+        metadata = [getCached(paper["hash"], "metadata", key) for _, _, paper in parsed]
+        missing = [i for i, cached in enumerate(metadata) if cached is None]
+        generated = generateMetadataBatch([("".join(parsed[i][2]["pages"]), parsed[i][2]["pages"]) for i in missing], self.genModel, self.llmConcurrency)
+        for i, result in zip(missing, generated):
+            metadata[i] = result
+            if not isinstance(result, Exception):
+                putCached(parsed[i][2]["hash"], "metadata", result, key)
+        self.timings["metadata"] += time.perf_counter() - start
+
+        embedModel = getActiveEmbedModel()
+        for (source, download, paper), paperMetadata in zip(parsed, metadata):
+            if isinstance(paperMetadata, Exception):
+                self._fail(source, str(paperMetadata))
+                continue
+            try:
+                paperMetadata.update(download["overrides"] if download else {})
+                documents = [Document(**chunk) for chunk in paper["chunks"]]
+                start = time.perf_counter()
+                with paperContext(paper["hash"]):
+                    embeddings = embedDocuments(documents, embedModel)
+                self.timings["embed"] += time.perf_counter() - start
+
+                start = time.perf_counter()
+                storePaper(paperMetadata, documents, embeddings, paperId=paper["hash"], arxivId=arxivBaseId(source) if download else None,
+                           embedModel=embedModel)
+                self.timings["store"] += time.perf_counter() - start
+            except Exception as e:
+                self._fail(source, str(e))
+                continue
+            self.stats["papers"] += 1
+            self.stats["chunks"] += len(documents)
+            checkpoint(source, "done", paper["hash"])
+        print(f"Ingested {self.stats['papers']} paper(s), skipped {self.stats['skipped']}, {self.stats['failed']} failure(s) so far")
+
+    def run(self, sources: list[str]):
+        ''' Ingests the sources batch by batch, parsing the next batch while the current one is with the LLM '''
+        batches = [sources[i:i+self.batchSize] for i in range(0, len(sources), self.batchSize)]
+        with ProcessPoolExecutor(max_workers=self.parseWorkers) as executor:
+            prepared = self._prepare(batches[0], executor) if batches else []
+            for i in range(len(batches)):
+                upcoming = self._prepare(batches[i + 1], executor) if i + 1 < len(batches) else []
+                self._ingest(prepared)
+                prepared = upcoming
+
+    def report(self, seconds: float) -> str:
+        ''' Formats the throughput and per stage timings of the run '''
+        lines = [
+            f"Ingested {self.stats['papers']} paper(s) ({self.stats['chunks']} chunks) in {seconds:.1f}s, "
+            f"skipped {self.stats['skipped']} already stored, {self.stats['failed']} failed attempt(s)",
+            f"Throughput: {self.stats['papers'] / seconds * 60 if seconds else 0:.1f} papers/min, "
+            f"{self.stats['chunks'] / self.timings['embed'] if self.timings['embed'] else 0:.1f} chunks/sec embedded",
+        ]
+        lines += [f"  {stage:<9} {stageSeconds:9.1f}s" for stage, stageSeconds in self.timings.items()]
+        return "\n".join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk ingest PDFs and arXiv papers without the Streamlit app")
+    parser.add_argument("patterns", nargs="*", help="Glob patterns of PDFs, e.g. 'papers/**/*.pdf'")
+    parser.add_argument("--manifest", help="File with one PDF path or arXiv ID per line")
+    parser.add_argument("--arxiv", nargs="+", default=[], help="arXiv IDs to ingest")
+    parser.add_argument("--gen-model", required=True, help="Ollama model the metadata is generated with")
+    parser.add_argument("--parse-workers", type=int, default=os.cpu_count() or 2, help="Processes parsing PDFs at once")
+    parser.add_argument("--llm-concurrency", type=int, default=OLLAMA_CONCURRENCY, help="Metadata requests in flight at once")
+    parser.add_argument("--batch-size", type=int, default=32, help="Papers per batch")
+    parser.add_argument("--retries", type=int, default=2, help="Times the failed papers are retried at the end of the run")
+    parser.add_argument("--restart", action="store_true", help="Ignore the checkpoint and ingest every source again")
+    args = parser.parse_args()
+
+    from database import initDatabases
+
+    initDatabases()
+    initCheckpoint()
+    sources = resolveSources(args.patterns, args.manifest, args.arxiv)
+    if not sources:
+        parser.error("no sources to ingest")
+
+    ingest = BulkIngest(args.gen_model, args.parse_workers, args.llm_concurrency, args.batch_size)
+    start = time.perf_counter()
+    for attempt in range(args.retries + 1):
+        checkpointed = {} if args.restart and attempt == 0 else getCheckpoint(sources)
+        pending = [source for source in sources if checkpointed.get(source) not in ("done", "skipped")]
+        if not pending:
+            break
+        print(f"{'Ingesting' if attempt == 0 else 'Retrying'} {len(pending)} of {len(sources)} source(s)")
+        ingest.run(pending)
+    print(ingest.report(time.perf_counter() - start))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+import hashlib
+import json
+import os
+import shutil
+
+from config import INGEST_CACHE_DIR, INGEST_CACHE_MAX_BYTES
+
+# On-disk cache of the ingest pipeline outputs, one folder per paper (keyed by the hash of the PDF bytes) with one
+# file per stage. Each stage file is also keyed by whatever its output depends on (e.g. the model used) so only
+# the stages whose inputs changed have to run again when a paper is re-ingested
+
+def hashBytes(data: bytes) -> str:
+    ''' Gets the content hash used as the ID of a paper '''
+    return hashlib.sha256(data).hexdigest()
+
+def hashFile(path: str) -> str:
+    ''' Gets the content hash of a PDF file without loading it all into memory '''
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+def _entryPath(paperHash: str, stage: str, key: str) -> str:
+    ''' Gets the path of the cache file of a stage '''
+    keyHash = hashlib.sha256(key.encode()).hexdigest()[:16]
+    return os.path.join(INGEST_CACHE_DIR, paperHash, f"{stage}-{keyHash}.json")
+
+def getCached(paperHash: str, stage: str, key: str = ""):
+    ''' Gets the cached output of a stage for a paper, returns None if it has not been cached '''
+    path = _entryPath(paperHash, stage, key)
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            value = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+    os.utime(os.path.dirname(path)) # Mark the paper as recently used so it is evicted last
+    return value
+
+def putCached(paperHash: str, stage: str, value, key: str = ""):
+    ''' Caches the output of a stage for a paper and evicts the least recently used papers if the cache is full '''
+    path = _entryPath(paperHash, stage, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tempPath = f"{path}.{os.getpid()}.tmp"
+    with open(tempPath, "w", encoding="utf-8") as f:
+        json.dump(value, f)
+    os.replace(tempPath, path) # Atomic so a reader in another worker never sees a half written file
+    evictCache()
+
+def _dirSize(path: str) -> int:
+    ''' Gets the total size of the files in a cache folder '''
+    return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+
+def evictCache(maxBytes: int = INGEST_CACHE_MAX_BYTES):
+    ''' Removes the least recently used papers from the cache until it fits within the size limit '''
+    if not os.path.isdir(INGEST_CACHE_DIR):
+        return
+
+    entries = [(entry.stat().st_mtime, _dirSize(entry.path), entry.path) for entry in os.scandir(INGEST_CACHE_DIR) if entry.is_dir()]
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= maxBytes:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+
+def clearCache():
+    ''' Removes everything from the ingest cache '''
+    shutil.rmtree(INGEST_CACHE_DIR, ignore_errors=True)
@@ -0,0 +1,169 @@
+import uuid
+import json
+import time
+
+from repository import ConnectionPool
+from config import JOBS_DB, JOB_MAX_ATTEMPTS, JOB_RETRY_DELAY, JOB_STALE_AFTER
+
+# Ordered pipeline steps for each kind of job. Every step stores its output as an artifact, so a failed
+# step can be retried on its own without redoing the steps before it. Removals are jobs of a single step so they
+# reach ChromaDB through the store lane like every other write (the source of a delete is a JSON list of paper IDs)
+JOB_STEPS = {
+    "upload": ["parse", "chunk", "metadata", "embed", "store"],
+    "arxiv": ["download", "parse", "chunk", "metadata", "embed", "store"],
+    "delete": ["delete"],
+    "reset": ["reset"],
+}
+
+# Worker lanes, the CPU heavy steps are kept apart from the LLM/network bound ones so they overlap across papers.
+# Metadata generation is pipelined by a single async worker and Chroma's persistent client is not safe to write to
+# from several processes, so both get a lane of their own. Every ChromaDB write goes through the store lane for that
+# reason, the removals queued from the app and the index rebuilds included
+STEP_LANES = {
+    "cpu": ["parse", "chunk"],
+    "llm": ["download", "embed"],
+    "metadata": ["metadata"],
+    "store": ["store", "delete", "reset"],
+}
+
+pool = ConnectionPool(JOBS_DB, size=2)
+
+def initJobQueue():
+    ''' Initialize the SQLite db used as a persistent job queue for ingesting papers '''
+    with pool.transaction() as conn:
+        conn.execute('''CREATE TABLE IF NOT EXISTS jobs
+                        (id TEXT PRIMARY KEY,
+                         kind TEXT,
+                         source TEXT,
+                         label TEXT,
+                         options TEXT,
+                         status TEXT,
+                         step TEXT,
+                         attempts INTEGER DEFAULT 0,
+                         error TEXT,
+                         progress TEXT,
+                         workerId TEXT,
+                         availableAt REAL,
+                         createdAt REAL,
+                         updatedAt REAL)''')
+        conn.execute('''CREATE TABLE IF NOT EXISTS job_artifacts
+                        (jobId TEXT,
+                         step TEXT,
+                         data TEXT,
+                         PRIMARY KEY (jobId, step))''')
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_claim ON jobs (status, step, availableAt)")
+
+def enqueueJob(kind: str, source: str, label: str, options: dict, artifacts: dict = None) -> str:
+    ''' Adds a new job to the queue and returns its ID. The source is a PDF path for uploads or an arXiv ID '''
+    return enqueueJobs(kind, [(source, label)], options, [artifacts] if artifacts else None)[0]
+
+def enqueueJobs(kind: str, sources: list[tuple[str, str]], options: dict, artifacts: list[dict] = None) -> list[str]:
+    ''' Adds several ingest jobs (source, label) to the queue in one transaction and returns their IDs. The outputs of
+    steps that were already done elsewhere (e.g. {"download": ...} from the harvester) can be passed in per job, the
+    job then starts at its first step without one, or is added as done if it has them all '''
+    if kind not in JOB_STEPS:
+        raise Exception(f"Unknown job kind: {kind}")
+
+    now = time.time()
+    artifacts = artifacts or [{}] * len(sources)
+    jobs = []
+    for i, ((source, label), done) in enumerate(zip(sources, artifacts)):
+        step = next((step for step in JOB_STEPS[kind] if step not in done), None) # None when every step was already done elsewhere
+        jobs.append((str(uuid.uuid4()), kind, source, label, json.dumps(options), "queued" if step else "done", step or JOB_STEPS[kind][-1],
+                     now, now + i * 1e-6, now)) # Offset createdAt so the jobs keep their order
+    with pool.transaction() as conn:
+        conn.executemany('''INSERT INTO jobs (id, kind, source, label, options, status, step, availableAt, createdAt, updatedAt)
+                            VALUES (?,?,?,?,?,?,?,?,?,?)''', jobs)
+        conn.executemany("INSERT INTO job_artifacts VALUES (?,?,?)",
+                         [(job[0], step, json.dumps(data)) for job, done in zip(jobs, artifacts) for step, data in done.items()])
+    return [job[0] for job in jobs]
+
+def claimJob(workerId: str, steps: list[str]) -> dict | None:
+    ''' Atomically claims the oldest queued job waiting on one of the given steps, returns None if there is nothing to do '''
+    with pool.transaction() as conn: # The write lock is taken first so two workers can never claim the same job
+        row = conn.execute('''SELECT * FROM jobs WHERE status='queued' AND step IN (SELECT value FROM json_each(?)) AND availableAt<=?
+                              ORDER BY createdAt LIMIT 1''', (json.dumps(steps), time.time())).fetchone()
+        if row is None:
+            return None
+
+        conn.execute("UPDATE jobs SET status='running', workerId=?, updatedAt=? WHERE id=?", (workerId, time.time(), row["id"]))
+    job = dict(row)
+    job["options"] = json.loads(job["options"])
+    return job
+
+def completeStep(jobId: str, step: str, artifact):
+    ''' Stores the output of a finished step and moves the job on to its next step '''
+    with pool.transaction() as conn:
+        kind = conn.execute("SELECT kind FROM jobs WHERE id=?", (jobId,)).fetchone()["kind"]
+        steps = JOB_STEPS[kind]
+        nextStep = steps[steps.index(step) + 1] if step != steps[-1] else None
+
+        conn.execute("INSERT OR REPLACE INTO job_artifacts VALUES (?,?,?)", (jobId, step, json.dumps(artifact)))
+        if nextStep is None:
+            conn.execute("UPDATE jobs SET status='done', step=?, attempts=0, error=NULL, workerId=NULL, updatedAt=? WHERE id=?", (step, time.time(), jobId))
+        else:
+            conn.execute("UPDATE jobs SET status='queued', step=?, attempts=0, error=NULL, workerId=NULL, updatedAt=? WHERE id=?", (nextStep, time.time(), jobId))
+
+def failStep(jobId: str, error: str):
+    ''' Records a failed attempt at the current step, the step is requeued with a backoff until it runs out of attempts '''
+    with pool.transaction() as conn:
+        attempts = conn.execute("SELECT attempts FROM jobs WHERE id=?", (jobId,)).fetchone()["attempts"] + 1
+        now = time.time()
+        if attempts < JOB_MAX_ATTEMPTS:
+            conn.execute('''UPDATE jobs SET status='queued', attempts=?, error=?, workerId=NULL, availableAt=?, updatedAt=? WHERE id=?''',
+                         (attempts, error, now + JOB_RETRY_DELAY * 2**(attempts - 1), now, jobId))
+        else:
+            conn.execute("UPDATE jobs SET status='failed', attempts=?, error=?, workerId=NULL, updatedAt=? WHERE id=?", (attempts, error, now, jobId))
+
+def finishJob(jobId: str, status: str, message: str):
+    ''' Ends a job early with the given status (e.g. when there is nothing left to do for it) '''
+    with pool.transaction() as conn:
+        conn.execute("UPDATE jobs SET status=?, progress=?, workerId=NULL, updatedAt=? WHERE id=?", (status, message, time.time(), jobId))
+
+def setProgress(jobId: str, message: str):
+    ''' Updates the human readable progress message of a job that is shown in the UI '''
+    with pool.transaction() as conn:
+        conn.execute("UPDATE jobs SET progress=?, updatedAt=? WHERE id=?", (message, time.time(), jobId))
+
+def getArtifacts(jobId: str) -> dict:
+    ''' Gets the outputs of all finished steps of a job, keyed by step name '''
+    with pool.connection() as conn:
+        rows = conn.execute("SELECT step, data FROM job_artifacts WHERE jobId=?", (jobId,)).fetchall()
+    return {row["step"]: json.loads(row["data"]) for row in rows}
+
+def getJobs(limit: int = 100) -> list[dict]:
+    ''' Gets the most recent jobs in the queue for displaying their status '''
+    with pool.connection() as conn:
+        rows = conn.execute("SELECT * FROM jobs ORDER BY createdAt DESC LIMIT ?", (limit,)).fetchall()
+    return [dict(row) for row in rows]
+
+def getJobCounts() -> dict:
+    ''' Gets the number of jobs in each status '''
+    with pool.connection() as conn:
+        rows = conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+    return {row[0]: row[1] for row in rows}
+
+def retryJob(jobId: str):
+    ''' Requeues a failed job at the step that failed, keeping the output of the steps that already succeeded '''
+    with pool.transaction() as conn:
+        conn.execute("UPDATE jobs SET status='queued', attempts=0, error=NULL, availableAt=?, updatedAt=? WHERE id=? AND status='failed'",
+                     (time.time(), time.time(), jobId))
+
+def requeueStaleJobs(staleAfter: float = JOB_STALE_AFTER) -> int:
+    ''' Requeues steps that were claimed by a worker that has since died, returns the number of requeued jobs '''
+    with pool.transaction() as conn:
+        cursor = conn.execute("UPDATE jobs SET status='queued', workerId=NULL, availableAt=? WHERE status='running' AND updatedAt<?",
+                              (time.time(), time.time() - staleAfter))
+        return cursor.rowcount
+
+def releaseWorkerJobs(workerPrefix: str):
+    ''' Requeues the running steps of the workers whose IDs start with the given prefix (e.g. when the pool is stopped) '''
+    with pool.transaction() as conn:
+        conn.execute("UPDATE jobs SET status='queued', workerId=NULL, availableAt=? WHERE status='running' AND workerId LIKE ?",
+                     (time.time(), workerPrefix + "%"))
+
+def clearFinishedJobs():
+    ''' Removes all finished jobs and their artifacts from the queue '''
+    with pool.transaction() as conn:
+        conn.execute("DELETE FROM job_artifacts WHERE jobId IN (SELECT id FROM jobs WHERE status IN ('done', 'skipped'))")
+        conn.execute("DELETE FROM jobs WHERE status IN ('done', 'skipped')")
@@ -0,0 +1,177 @@
+''' Timing spans around every stage of the ingest and search pipeline. Each span keeps the paper it worked on, the
+sizes it handled (pages, chars, chunks, Ollama token counts) and how long it took, in a local metrics database that
+the Metrics page reads and that can be exported for Prometheus:
+
+    python app/metrics.py              # Print the metrics in the Prometheus text format
+    python app/metrics.py --serve 9464 # Serve them on http://localhost:9464/metrics
+'''
+import argparse
+import contextvars
+import time
+from contextlib import contextmanager
+
+from repository import ConnectionPool
+from config import METRICS_DB, METRICS_ENABLED, METRICS_RETENTION_DAYS
+
+SIZE_FIELDS = ["pages", "chars", "chunks", "promptTokens", "evalTokens"]
+
+pool = ConnectionPool(METRICS_DB, size=2)
+currentPaper = contextvars.ContextVar("currentPaper", default=None) # Paper the spans of the current job/task belong to
+
+def initMetrics():
+    ''' Creates the spans table and drops the spans older than the retention period '''
+    with pool.transaction() as conn:
+        conn.execute('''CREATE TABLE IF NOT EXISTS spans
+                        (id INTEGER PRIMARY KEY,
+                         stage TEXT,
+                         paperId TEXT,
+                         model TEXT,
+                         seconds REAL,
+                         pages INTEGER,
+                         chars INTEGER,
+                         chunks INTEGER,
+                         promptTokens INTEGER,
+                         evalTokens INTEGER,
+                         error TEXT,
+                         startedAt REAL)''')
+        conn.execute("CREATE INDEX IF NOT EXISTS spans_stage ON spans (stage, startedAt)")
+        conn.execute("DELETE FROM spans WHERE startedAt<?", (time.time() - METRICS_RETENTION_DAYS * 86400,))
+
+@contextmanager
+def paperContext(paperId: str):
+    ''' Attributes the spans recorded inside the block (also in asyncio tasks started from it) to a paper '''
+    token = currentPaper.set(paperId)
+    try:
+        yield
+    finally:
+        currentPaper.reset(token)
+
+def recordSpan(stage: str, seconds: float, startedAt: float, paperId: str = None, model: str = None, error: str = None, **sizes):
+    ''' Stores a finished span '''
+    if not METRICS_ENABLED:
+        return
+    try:
+        with pool.transaction() as conn:
+            conn.execute(f"INSERT INTO spans (stage, paperId, model, seconds, {', '.join(SIZE_FIELDS)}, error, startedAt) VALUES (?,?,?,?,?,?,?,?,?,?,?)",
+                         (stage, paperId or currentPaper.get(), model, seconds, *[sizes.get(field) for field in SIZE_FIELDS], error, startedAt))
+    except Exception as e: # Losing a measurement must never fail the stage that was measured
+        print(f"Failed to record the {stage} span: {str(e)}")
+
+@contextmanager
+def span(stage: str, paperId: str = None, model: str = None, **sizes):
+    ''' Times the block as a stage. Yields a dictionary of the sizes, so sizes only known at the end (e.g. the number of
+    chunks produced) can be filled in by the block. Spans of blocks that raise keep the error '''
+    info = {"paperId": paperId, "model": model, **sizes}
+    startedAt, start, error = time.time(), time.perf_counter(), None
+    try:
+        yield info
+    except Exception as e:
+        error = str(e)
+        raise
+    finally:
+        recordSpan(stage, time.perf_counter() - start, startedAt, error=error, **info)
+
+def _percentile(values: list[float], q: float) -> float:
+    ''' Gets a percentile of sorted values '''
+    return values[min(len(values) - 1, int(len(values) * q))] if values else 0.0
+
+def getStageStats(since: float = 0) -> list[dict]:
+    ''' Gets the number of runs, failures and the mean/p50/p95 latency of every stage since the given time '''
+    with pool.connection() as conn:
+        rows = conn.execute("SELECT stage, seconds, error FROM spans WHERE startedAt>=? ORDER BY stage, seconds", (since,)).fetchall()
+    stages = {}
+    for row in rows:
+        stages.setdefault(row["stage"], []).append(row)
+    return [{
+        "stage": stage,
+        "runs": len(spans),
+        "failures": sum(1 for s in spans if s["error"]),
+        "meanSeconds": sum(s["seconds"] for s in spans) / len(spans),
+        "p50Seconds": _percentile([s["seconds"] for s in spans], 0.5),
+        "p95Seconds": _percentile([s["seconds"] for s in spans], 0.95),
+        "totalSeconds": sum(s["seconds"] for s in spans),
+    } for stage, spans in stages.items()]
+
+def getModelStats(since: float = 0) -> list[dict]:
+    ''' Gets the request count, token counts and generation speed of every model since the given time '''
+    with pool.connection() as conn:
+        rows = conn.execute('''SELECT model, COUNT(*) AS requests, SUM(promptTokens) AS promptTokens, SUM(evalTokens) AS evalTokens,
+                                      SUM(seconds) AS seconds FROM spans
+                               WHERE stage='llm.generate' AND error IS NULL AND startedAt>=? GROUP BY model''', (since,)).fetchall()
+    return [{**dict(row), "tokensPerSecond": (row["evalTokens"] or 0) / row["seconds"] if row["seconds"] else 0.0} for row in rows]
+
+def getThroughput(since: float = 0) -> dict:
+    ''' Gets how many papers were stored and chunks embedded since the given time, and the rates they went at '''
+    with pool.connection() as conn:
+        row = conn.execute('''SELECT SUM(stage='store' AND error IS NULL) AS papers, MIN(startedAt) AS first, MAX(startedAt + seconds) AS last,
+                                     SUM(CASE WHEN stage='embed' THEN chunks END) AS chunks, SUM(CASE WHEN stage='embed' THEN seconds END) AS embedSeconds
+                              FROM spans WHERE startedAt>=?''', (since,)).fetchone()
+    hours = ((row["last"] or 0) - (row["first"] or 0)) / 3600
+    return {
+        "papers": row["papers"] or 0,
+        "papersPerHour": (row["papers"] or 0) / hours if hours else 0.0,
+        "chunks": row["chunks"] or 0,
+        "chunksPerSecond": (row["chunks"] or 0) / row["embedSeconds"] if row["embedSeconds"] else 0.0,
+    }
+
+def exportPrometheus() -> str:
+    ''' Formats the metrics in the Prometheus text exposition format '''
+    stages = getStageStats()
+    lines = ["# HELP research_stage_seconds Duration of the pipeline stages", "# TYPE research_stage_seconds summary"]
+    for stats in stages:
+        label = f'stage="{stats["stage"]}"'
+        lines += [
+            f'research_stage_seconds{{{label},quantile="0.5"}} {stats["p50Seconds"]}',
+            f'research_stage_seconds{{{label},quantile="0.95"}} {stats["p95Seconds"]}',
+            f'research_stage_seconds_sum{{{label}}} {stats["totalSeconds"]}',
+            f'research_stage_seconds_count{{{label}}} {stats["runs"]}',
+        ]
+    lines += ["# HELP research_stage_failures_total Pipeline stages that raised", "# TYPE research_stage_failures_total counter"]
+    lines += [f'research_stage_failures_total{{stage="{stats["stage"]}"}} {stats["failures"]}' for stats in stages]
+    lines += ["# HELP research_llm_tokens_total Tokens processed by Ollama", "# TYPE research_llm_tokens_total counter"]
+    for stats in getModelStats():
+        lines += [
+            f'research_llm_tokens_total{{model="{stats["model"]}",kind="prompt"}} {stats["promptTokens"] or 0}',
+            f'research_llm_tokens_total{{model="{stats["model"]}",kind="eval"}} {stats["evalTokens"] or 0}',
+        ]
+    throughput = getThroughput()
+    lines += [
+        "# HELP research_papers_stored_total Papers stored", "# TYPE research_papers_stored_total counter",
+        f"research_papers_stored_total {throughput['papers']}",
+        "# HELP research_chunks_embedded_total Chunks embedded", "# TYPE research_chunks_embedded_total counter",
+        f"research_chunks_embedded_total {throughput['chunks']}",
+    ]
+    return "\n".join(lines) + "\n"
+
+def serveMetrics(port: int):
+    ''' Serves the Prometheus metrics over HTTP for scraping '''
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            data = exportPrometheus().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    HTTPServer(("", port), Handler).serve_forever()
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the pipeline metrics in the Prometheus text format")
+    parser.add_argument("--serve", type=int, metavar="PORT", help="Serve the metrics over HTTP instead of printing them")
+    args = parser.parse_args()
+
+    initMetrics()
+    if args.serve:
+        print(f"Serving metrics on http://localhost:{args.serve}/metrics")
+        serveMetrics(args.serve)
+    else:
+        print(exportPrometheus(), end="")
+
+if __name__ == "__main__":
+    main()
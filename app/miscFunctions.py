@@ -1,6 +1,21 @@
+from datetime import datetime
+from typing import Callable
+
 import streamlit as st
 
-from database import removePaper, removeAllPapers, updatePaper
+from database import removePaper, removeAllPapers, updatePaper, getSimilarPapers, getPaperTopic, getGeneration
+
+# The topic and similar papers of a paper are cached per library generation, which changes whenever a paper is stored,
+# edited or removed and when the library is clustered again
+@st.cache_data(max_entries=256, show_spinner=False)
+def cachedPaperTopic(generation: int, paperId: str) -> dict | None:
+    ''' Gets the cached topic of a paper '''
+    return getPaperTopic(paperId)
+
+@st.cache_data(max_entries=256, show_spinner=False)
+def cachedSimilarPapers(generation: int, paperId: str) -> list[dict]:
+    ''' Gets the cached most similar papers of a paper '''
+    return getSimilarPapers(paperId)
 
 @st.dialog("Delete Paper")
 def removePaperDialog(paperId: str):
@@ -12,8 +27,8 @@ def removePaperDialog(paperId: str):
 
     if col1.button("Yes", use_container_width=True):
         removePaper(paperId)
+        st.toast("The paper will be removed once the workers get to it")
         st.rerun()
-        st.success("Paper deleted successfully!")
     elif col2.button("No", use_container_width=True):
         st.rerun()
 
@@ -27,7 +42,7 @@ def removeAllPapersDialog():
 
     if col1.button("Yes", use_container_width=True):
         removeAllPapers()
-        st.success("All papers deleted successfully!")
+        st.toast("Every paper will be removed once the workers get to it")
         st.rerun()
     elif col2.button("No", use_container_width=True):
         st.rerun()
@@ -85,25 +100,59 @@ def editPaperDialog():
 def paperInfoCard(paper: dict):
     ''' Helper function to display a card that contains all paper details and also allows Updating and Deletion '''
     with st.expander(f"**{paper['title']}**"):
-            col1, col2 = st.columns(2, vertical_alignment="center")
-            if col1.button("Update Paper Details", key=paper["id"]+"update", use_container_width=True):
-                st.session_state.editing_paper = paper
-                st.session_state.show_edit_dialog = True
-
-                editPaperDialog()
-            if col2.button("Delete Paper from Database", key=paper["id"]+"delete", use_container_width=True):
-                removePaperDialog(paper["id"])
-
-            st.subheader(f"**{paper['title']}**")
-            st.caption(f"**Authors**: {', '.join(paper['authors'])}")
-            st.write(paper["summary"])
-            st.write(f"**Link**: [{paper['link']}]({paper['link']})")
-            
-            # Display other metadata TODO: Make more readable with numbered lists
-            # st.write(f"**Datasets**:  \n{['  \n' + str(i+1) + s for i, s in enumerate(paper['datasets'])]}")
-            st.write(f"**Datasets**:  \n{', '.join(paper['datasets'])}")
-            st.write(f"**Metrics**:  \n{', '.join(paper['metrics'])}")
-            st.write(f"**Methods**:  \n{', '.join(paper['methods'])}")
-            st.write(f"**Applications**:  \n{', '.join(paper['applications'])}")
-            st.write(f"**Limitations**:  \n{', '.join(paper['limitations'])}")
-            st.write(f"**Areas of Improvement**:  \n{', '.join(paper['areasOfImprovement'])}")
\ No newline at end of file
+            paperDetails(paper)
+
+def paperSummaryCard(summary: dict, loadPaper: Callable[[str], dict]):
+    ''' Helper function to display a library card from the summary of a paper. Streamlit renders the contents of
+    collapsed expanders too, so the full metadata is only loaded (with loadPaper) once the details are switched on '''
+    with st.expander(f"**{summary['title']}**"):
+            if summary["addedAt"]:
+                st.caption(f"**Added**: {datetime.fromtimestamp(summary['addedAt']):%Y-%m-%d %H:%M}")
+            if st.toggle("Show details", key=summary["id"]+"details"):
+                paper = loadPaper(summary["id"])
+                if paper:
+                    paperDetails(paper)
+                else:
+                    st.info("This paper has been removed")
+
+def paperDetails(paper: dict):
+    ''' Helper function to display all paper details with the Update and Delete actions '''
+    col1, col2 = st.columns(2, vertical_alignment="center")
+    if col1.button("Update Paper Details", key=paper["id"]+"update", use_container_width=True):
+        st.session_state.editing_paper = paper
+        st.session_state.show_edit_dialog = True
+
+        editPaperDialog()
+    if col2.button("Delete Paper from Database", key=paper["id"]+"delete", use_container_width=True):
+        removePaperDialog(paper["id"])
+
+    if "score" in paper: # Search results also come with their relevance and best matching chunk
+        st.caption(f"**Relevance**: {paper['score']:.4f}")
+        if paper.get("snippet"):
+            st.caption(f"> {paper['snippet']}")
+
+    st.subheader(f"**{paper['title']}**")
+    st.caption(f"**Authors**: {', '.join(paper['authors'])}")
+    st.write(paper["summary"])
+    st.write(f"**Link**: [{paper['link']}]({paper['link']})")
+    
+    # Display other metadata TODO: Make more readable with numbered lists
+    # st.write(f"**Datasets**:  \n{['  \n' + str(i+1) + s for i, s in enumerate(paper['datasets'])]}")
+    st.write(f"**Datasets**:  \n{', '.join(paper['datasets'])}")
+    st.write(f"**Metrics**:  \n{', '.join(paper['metrics'])}")
+    st.write(f"**Methods**:  \n{', '.join(paper['methods'])}")
+    st.write(f"**Applications**:  \n{', '.join(paper['applications'])}")
+    st.write(f"**Limitations**:  \n{', '.join(paper['limitations'])}")
+    st.write(f"**Areas of Improvement**:  \n{', '.join(paper['areasOfImprovement'])}")
+
+    if st.toggle("Show topic and similar papers", key=paper["id"]+"similar"): # Collapsed cards are rendered too, so they are only looked up on demand
+        generation = getGeneration()
+        topic = cachedPaperTopic(generation, paper["id"])
+        if topic:
+            around = f", around *{topic['exemplarTitle']}*" if topic.get("exemplarTitle") and topic["exemplarId"] != paper["id"] else ""
+            st.caption(f"**Topic** {topic['topic'] + 1}: {topic['size']} paper(s){around}")
+        similarPapers = cachedSimilarPapers(generation, paper["id"])
+        if similarPapers:
+            st.write("**Similar Papers**:  \n" + "  \n".join(f"{similar['similarity']:.2f} · {similar['title']}" for similar in similarPapers))
+        elif not topic:
+            st.caption("No similar papers yet")
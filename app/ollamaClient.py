@@ -0,0 +1,85 @@
+import asyncio
+import random
+from typing import AsyncIterator
+
+import httpx
+import ollama
+
+from config import OLLAMA_HOST, OLLAMA_CONCURRENCY, OLLAMA_TIMEOUT, OLLAMA_RETRIES, OLLAMA_BACKOFF
+
+def getAvailableModels(client: ollama.Client = None) -> list[str]:
+    ''' Gets the list of available model names from the Ollama API '''
+    try:
+        return [model.model for model in (client or ollama).list().models]
+    except Exception as e:
+        raise Exception(f"Error getting available models (Make sure Ollama is running): {str(e)}")
+
+class AsyncOllama:
+    ''' Asyncio client for the Ollama generate/embed API that keeps up to `concurrency` requests in flight at once
+    (Ollama serves them in parallel up to OLLAMA_NUM_PARALLEL). Requests that time out, fail to connect or get a
+    5xx/429 response are retried with exponential backoff and jitter
+
+    Args:
+        concurrency: int - Maximum number of requests in flight at once
+        timeout: float - Seconds before a single request is abandoned
+        retries: int - Number of retries after the first attempt
+        backoff: float - Seconds to wait before the first retry, doubled for every retry after that '''
+    def __init__(self, host: str = OLLAMA_HOST, concurrency: int = OLLAMA_CONCURRENCY, timeout: float = OLLAMA_TIMEOUT,
+                 retries: int = OLLAMA_RETRIES, backoff: float = OLLAMA_BACKOFF):
+        self.client = ollama.AsyncClient(host=host, timeout=timeout,
+                                         limits=httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency))
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+
+    @staticmethod
+    def _isRetryable(error: Exception) -> bool:
+        ''' Checks whether a failed request is worth retrying '''
+        if isinstance(error, ollama.ResponseError):
+            return error.status_code >= 500 or error.status_code == 429
+        return isinstance(error, (httpx.TransportError, asyncio.TimeoutError))
+
+    async def _request(self, method, **kwargs):
+        ''' Runs a request under the concurrency limit, retrying it with backoff if it fails for a transient reason '''
+        for attempt in range(self.retries + 1):
+            try:
+                async with self.semaphore:
+                    return await asyncio.wait_for(method(**kwargs), timeout=self.timeout)
+            except Exception as e:
+                if attempt == self.retries or not self._isRetryable(e):
+                    raise
+                await asyncio.sleep(self.backoff * 2**attempt * (1 + random.random() / 2))
+
+    async def generate(self, **kwargs) -> ollama.GenerateResponse:
+        ''' Generates a completion, takes the same arguments as ollama.generate '''
+        return await self._request(self.client.generate, **kwargs)
+
+    async def generateStream(self, **kwargs) -> AsyncIterator[ollama.GenerateResponse]:
+        ''' Generates a completion and yields its chunks as they arrive, takes the same arguments as ollama.generate. The
+        concurrency slot is held until the stream ends and only a request that fails before its first chunk is retried '''
+        for attempt in range(self.retries + 1):
+            started = False
+            try:
+                async with self.semaphore:
+                    stream = await asyncio.wait_for(self.client.generate(stream=True, **kwargs), timeout=self.timeout)
+                    while True:
+                        try:
+                            chunk = await asyncio.wait_for(anext(stream), timeout=self.timeout) # A stalled stream counts as a timeout
+                        except StopAsyncIteration:
+                            return
+                        started = True
+                        yield chunk
+            except Exception as e:
+                if started or attempt == self.retries or not self._isRetryable(e):
+                    raise
+                await asyncio.sleep(self.backoff * 2**attempt * (1 + random.random() / 2))
+
+    async def embed(self, model: str, input: list[str]) -> list[list[float]]:
+        ''' Embeds a batch of texts with the /api/embed endpoint '''
+        response = await self._request(self.client.embed, model=model, input=input)
+        return [list(vector) for vector in response.embeddings]
+
+    async def show(self, model: str) -> ollama.ShowResponse:
+        ''' Gets the details of a model '''
+        return await self._request(self.client.show, model=model)
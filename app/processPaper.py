@@ -1,8 +1,16 @@
-import ollama
 import pydantic
 import json
+import time
+import asyncio
+from typing import Callable
 
-from langchain_core.documents import Document
+from ollamaClient import AsyncOllama, getAvailableModels
+from metrics import span
+from config import METADATA_MAX_CTX, OLLAMA_CONCURRENCY, METADATA_FIELD_RETRIES
+
+CHARS_PER_TOKEN = 4 # Rough average for English text
+PROMPT_RESERVE_TOKENS = 1536 # Tokens kept free in the context for the instructions, the schema and the generated output
+PARTIAL_INTERVAL = 0.5 # Seconds between parses of a streamed response
 
 # Epic Ollama moment - The docstring is actually included when the class is serialized to JSON, so it provides extra context for mr LLM
 class Metadata(pydantic.BaseModel):
@@ -29,47 +37,241 @@ class Metadata(pydantic.BaseModel):
     limitations: list[str]
     areasOfImprovement: list[str]
 
-def getAvailableModels() -> list[str]:
-    ''' Gets the list of available model names from the Ollama API '''
+SYSTEM_PROMPT = "You are a research assistant that has been tasked with generating structured metadata for a research paper. Retry if the output is incomplete or inaccurate or failed."
+LIST_FIELDS = ["datasets", "metrics", "methods", "applications", "limitations", "areasOfImprovement"]
+
+_contextLengths = {}
+
+async def getContextLength(modelName: str, client: AsyncOllama) -> int:
+    ''' Gets the context window to use for a model, this is the model's own context length capped by METADATA_MAX_CTX '''
+    if modelName not in _contextLengths:
+        try:
+            modelInfo = (await client.show(modelName)).modelinfo or {}
+            contextLength = next((value for key, value in modelInfo.items() if key.endswith(".context_length")), METADATA_MAX_CTX)
+        except Exception:
+            contextLength = METADATA_MAX_CTX
+        _contextLengths[modelName] = min(int(contextLength), METADATA_MAX_CTX)
+    return _contextLengths[modelName]
+
+def estimateTokens(text: str) -> int:
+    ''' Roughly estimates the number of tokens in a piece of text without running the tokenizer '''
+    return len(text) // CHARS_PER_TOKEN + 1
+
+def splitIntoWindows(pages: list[str], windowChars: int) -> list[str]:
+    ''' Packs consecutive pages into windows of at most windowChars characters, pages that are too long on their own are split '''
+    windows, current = [], ""
+    for page in pages:
+        for start in range(0, max(len(page), 1), windowChars):
+            piece = page[start:start+windowChars]
+            if current and len(current) + len(piece) > windowChars:
+                windows.append(current)
+                current = ""
+            current += piece
+    if current.strip():
+        windows.append(current)
+    return windows
+
+def parsePartialJson(text: str) -> dict:
+    ''' Parses the JSON object generated so far by closing its open strings, lists and objects. A trailing value that
+    cannot be completed yet (e.g. a key still being written) is dropped, so the result holds every field seen so far,
+    with the string or list being generated cut off where the stream is. Returns {} if nothing can be parsed '''
+    stack, inString, escaped = [], False, False
+    safePoints = [] # (prefix length, closing brackets) right before every comma, where the JSON is complete so far
+    for i, char in enumerate(text):
+        if inString:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                inString = False
+        elif char == '"':
+            inString = True
+        elif char in "{[":
+            stack.append("}" if char == "{" else "]")
+        elif char in "}]" and stack:
+            stack.pop()
+        elif char == ",":
+            safePoints.append((i, "".join(reversed(stack))))
+
+    tail = text[:-1] if escaped else text
+    candidates = [tail + ('"' if inString else "") + "".join(reversed(stack))]
+    candidates += [text[:end] + closing for end, closing in reversed(safePoints)]
+    for candidate in candidates:
+        try:
+            parsed = json.loads(candidate)
+            return parsed if isinstance(parsed, dict) else {}
+        except json.JSONDecodeError:
+            continue
+    return {}
+
+def parseGenerated(text: str) -> dict:
+    ''' Parses a finished response. If the JSON is cut off or malformed the fields before the break are salvaged, except
+    the last one, which may have been cut short while it was being written '''
     try:
-        return [model.model for model in ollama.list().models]
-    except Exception as e:
-        raise Exception(f"Error getting available models (Make sure Ollama is running): {str(e)}")
+        parsed = json.loads(text)
+        return parsed if isinstance(parsed, dict) else {}
+    except json.JSONDecodeError:
+        salvaged = parsePartialJson(text)
+        if salvaged:
+            salvaged.pop(list(salvaged)[-1])
+        return salvaged
+
+_fieldAdapters = {}
+
+def validateFields(data: dict, model: type[pydantic.BaseModel] = Metadata) -> tuple[dict, list[str]]:
+    ''' Validates generated data field by field, returns the valid fields and the names of the missing or invalid ones '''
+    valid, missing = {}, []
+    for name, field in model.model_fields.items():
+        if field.annotation not in _fieldAdapters:
+            _fieldAdapters[field.annotation] = pydantic.TypeAdapter(field.annotation)
+        try:
+            valid[name] = _fieldAdapters[field.annotation].validate_python(data[name])
+        except (KeyError, pydantic.ValidationError):
+            missing.append(name)
+    return valid, missing
+
+async def _request(client: AsyncOllama, prompt: str, schema: dict, modelName: str, numCtx: int, stats: list = None, window: int = 0,
+                   onPartial: Callable[[int, dict], None] = None) -> str:
+    ''' Runs a single structured generation, records its latency and token counts and returns the generated JSON text.
+    With onPartial the response is streamed and the fields parsed so far are passed to it as they arrive '''
+    start = time.perf_counter()
+    with span("llm.generate", model=modelName, chars=len(prompt)) as info:
+        request = {
+            "model": modelName,
+            "format": schema, # Format the response as the JSON schema of the Metadata model
+            "options": {"num_ctx": numCtx, "temperature": 0}, # Context size that follows the model and lower temp
+            "system": SYSTEM_PROMPT,
+            "prompt": prompt,
+        }
+        if onPartial is None:
+            response = await client.generate(**request)
+            text = response.response
+        else:
+            text, lastParse, response = "", 0.0, None
+            async for response in client.generateStream(**request):
+                text += response.response
+                if time.perf_counter() - lastParse >= PARTIAL_INTERVAL: # Parsing is linear in the text, so not on every token
+                    onPartial(window, parsePartialJson(text))
+                    lastParse = time.perf_counter()
+            if response is None: # Raised so the step is retried, instead of failing on the missing token counts
+                raise Exception(f"{modelName} returned an empty stream")
+        info.update(promptTokens=response.prompt_eval_count, evalTokens=response.eval_count)
+    if stats is not None:
+        stats.append({
+            "window": window,
+            "chars": len(prompt),
+            "seconds": time.perf_counter() - start,
+            "promptTokens": response.prompt_eval_count,
+            "evalTokens": response.eval_count,
+        })
+    return text
+
+def _fieldsModel(fields: list[str]) -> type[pydantic.BaseModel]:
+    ''' Builds a model with only some of the fields of the Metadata model, keeping its docstring for the context '''
+    return pydantic.create_model("Metadata", __doc__=Metadata.__doc__, **{name: (Metadata.model_fields[name].annotation, ...) for name in fields})
+
+async def _generate(client: AsyncOllama, prompt: str, modelName: str, numCtx: int, stats: list = None, window: int = 0,
+                    onPartial: Callable[[int, dict], None] = None, model: type[pydantic.BaseModel] = Metadata) -> dict:
+    ''' Runs a structured generation and validates it against the model (all of the Metadata fields by default). When
+    the JSON is cut off or malformed, or some fields are missing or invalid, the valid fields are kept and only the
+    others are asked for again with a schema of just those fields, instead of regenerating everything '''
+    text = await _request(client, prompt, model.model_json_schema(), modelName, numCtx, stats, window, onPartial)
+    metadata, missing = validateFields(parseGenerated(text), model)
+    for _ in range(METADATA_FIELD_RETRIES):
+        if not missing:
+            break
+        missingModel = _fieldsModel(missing)
+        retryPrompt = f"""{prompt}
 
-def generateMetadata(text: str, modelName: str) -> dict:
-    ''' Generates metadata from the given text using the specified model and returns it as a dictionary (JSON)'''
+                PROMPT: Only generate the following fields in JSON format: {", ".join(missing)}"""
+        text = await _request(client, retryPrompt, missingModel.model_json_schema(), modelName, numCtx, stats, window,
+                              (lambda window, partial: onPartial(window, {**metadata, **partial})) if onPartial else None)
+        fixed, missing = validateFields(parseGenerated(text), missingModel)
+        metadata.update(fixed)
+    if missing:
+        raise Exception(f"The model did not generate valid values for: {', '.join(missing)}")
+    if onPartial:
+        onPartial(window, metadata)
+    return {name: metadata[name] for name in model.model_fields} # Keep the field order of the model
+
+def mergeMetadata(partials: list[dict]) -> dict:
+    ''' Merges the partial metadata of each window of a paper, list fields are combined and deduplicated in order '''
+    merged = {
+        "title": next((p.get("title", "").strip() for p in partials if p.get("title", "").strip()), ""),
+        "summary": " ".join(p.get("summary", "").strip() for p in partials if p.get("summary", "").strip()),
+    }
+    for field in LIST_FIELDS:
+        seen, values = set(), []
+        for partial in partials:
+            for value in partial.get(field, []):
+                key = " ".join(value.lower().split())
+                if key and key not in seen:
+                    seen.add(key)
+                    values.append(value.strip())
+        merged[field] = values
+    return merged
+
+async def generateMetadataAsync(text: str, modelName: str, pages: list[str] = None, stats: list = None, client: AsyncOllama = None,
+                                onPartial: Callable[[int, dict], None] = None) -> dict:
+    ''' Generates metadata from the given text using the specified model and returns it as a dictionary (JSON).
+    Papers that do not fit in the model's context are split into windows (map), each window is extracted concurrently
+    and the partial results are merged and deduplicated (reduce) instead of letting Ollama silently truncate the paper.
+    Windows that fail are left out of the merge, the paper only fails if every window does.
+    With onPartial the responses are streamed and onPartial(window, fields) gets the fields generated so far '''
     try:
-        response = ollama.generate(
-            model = modelName,
-            format=Metadata.model_json_schema(), # Format the response as a JSON schema from the Metadata model
-            options={"num_ctx": 4096, "temperature": 0}, # Increase the context size and lower temp
-            system="You are a research assistant that has been tasked with generating structured metadata for a research paper. Retry if the output is incomplete or inaccurate or failed.",
-            prompt=f"""
-                PROMPT: Generate metadata for the following research paper in JSON format. 
-                Use exact extracts/sections/titles/names where possible. 
-                Validate the output for accuracy and completeness.
-
-                CONTENT: {text}..."""
-        )
-        return json.loads(response.response)
+        with span("metadata", model=modelName, chars=len(text), pages=len(pages or [])):
+            client = client or AsyncOllama()
+            numCtx = await getContextLength(modelName, client)
+            windowChars = (numCtx - PROMPT_RESERVE_TOKENS) * CHARS_PER_TOKEN
+            if estimateTokens(text) <= numCtx - PROMPT_RESERVE_TOKENS:
+                return await _generate(client, f"""
+                    PROMPT: Generate metadata for the following research paper in JSON format. 
+                    Use exact extracts/sections/titles/names where possible. 
+                    Validate the output for accuracy and completeness.
+
+                    CONTENT: {text}...""", modelName, numCtx, stats, onPartial=onPartial)
+
+            # Long document mode, the windows are only limited by the client's concurrency
+            windows = splitIntoWindows(pages or [text], windowChars)
+            results = await asyncio.gather(*[_generate(client, f"""
+                    PROMPT: The following is part {i + 1} of {len(windows)} of a research paper. Generate metadata in JSON format 
+                    using only the information found in this part, leave fields empty if this part does not mention them. 
+                    Use exact extracts/sections/titles/names where possible.
+
+                    CONTENT: {window}...""", modelName, numCtx, stats, i, onPartial) for i, window in enumerate(windows)], return_exceptions=True)
+            partials = [result for result in results if not isinstance(result, BaseException)]
+            errors = [result for result in results if isinstance(result, BaseException)]
+            if not partials:
+                raise errors[0]
+            if errors: # A part that failed only loses what was in it, the rest of the paper is kept
+                print(f"Metadata of {len(errors)} of {len(windows)} parts failed, merging the others: {str(errors[0])}")
+
+            metadata = mergeMetadata(partials)
+            summaryPrompt = f"""
+                    PROMPT: Combine the following partial summaries of one research paper into a single concise summary in JSON format.
+
+                    TITLE: {metadata["title"]}
+                    CONTENT: {metadata["summary"]}"""
+            if estimateTokens(summaryPrompt) <= numCtx - PROMPT_RESERVE_TOKENS:
+                metadata["summary"] = (await _generate(client, summaryPrompt, modelName, numCtx, stats, len(windows), model=_fieldsModel(["summary"])))["summary"]
+            return metadata
     except Exception as e:
         raise Exception(f"Metadata generation failed: {str(e)}")
 
-def generateEmbedding(text: str, modelName: str) -> list[list[float]]:
-    ''' Generates a vector embedding for the given text using the specified model '''
-    try:
-        response = ollama.embed(model=modelName, input=text)
-        return response.embeddings
-    except Exception as e:
-        raise Exception(f"Embedding generation failed: {str(e)}")
-    
-def generateEmbedding(docs: list[Document], metadata: list[dict], model: str) -> list[list[float]]:
-    ''' Generates embeddings for the given documents using the specified model '''
-    try:
-        response = ollama.embed(model=model, input=[doc.page_content for doc in docs])
-        return response.embeddings
-    except Exception as e:
-        raise Exception(f"Embedding generation failed: {str(e)}")
+def generateMetadata(text: str, modelName: str, pages: list[str] = None, stats: list = None, onPartial: Callable[[int, dict], None] = None) -> dict:
+    ''' Generates metadata from the given text using the specified model and returns it as a dictionary (JSON) '''
+    return asyncio.run(generateMetadataAsync(text, modelName, pages, stats, onPartial=onPartial))
+
+async def generateMetadataBatchAsync(papers: list[tuple[str, list[str]]], modelName: str, concurrency: int = OLLAMA_CONCURRENCY) -> list[dict | Exception]:
+    ''' Generates the metadata of several papers (text, pages) at once, keeping up to `concurrency` requests in flight
+    across all of them. A paper that fails gets its exception returned in its place so the rest of the batch survives '''
+    client = AsyncOllama(concurrency=concurrency)
+    return await asyncio.gather(*[generateMetadataAsync(text, modelName, pages, client=client) for text, pages in papers], return_exceptions=True)
+
+def generateMetadataBatch(papers: list[tuple[str, list[str]]], modelName: str, concurrency: int = OLLAMA_CONCURRENCY) -> list[dict | Exception]:
+    ''' Synchronous version of generateMetadataBatchAsync '''
+    return asyncio.run(generateMetadataBatchAsync(papers, modelName, concurrency))
 
 if __name__ == "__main__": # Test the functions
     import arxiv
@@ -82,9 +284,10 @@ if __name__ == "__main__": # Test the functions
     paper = client.results(search).__next__() # Get the paper
 
     path = paper.download_pdf("data/papers") # Download the paper
-    text = extractText.extractText(path) # Extract text from the paper
-    documents = extractText.chunkDocument(path) # Chunk the document into smaller parts
+    pages = extractText.extractPages(path) # Extract the text of each page once
+    text, documents = "".join(pages), extractText.chunkPages(pages, path) # Chunk the document into smaller parts
 
     # print(text)
-    print(generateMetadata(text, "deepseek-r1:7b"))
-    # print(generateEmbedding(text, "nomic-embed-text:latest"))
\ No newline at end of file
+    stats = []
+    print(generateMetadata(text, "deepseek-r1:7b", pages, stats))
+    print(stats)
\ No newline at end of file
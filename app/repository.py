@@ -0,0 +1,438 @@
+import sqlite3
+import queue
+import json
+import contextlib
+import os
+import time
+import re
+
+from config import METADATA_DB, SQLITE_POOL_SIZE, SQLITE_BUSY_TIMEOUT
+
+class ConnectionPool:
+    ''' Thread-safe pool of SQLite connections to one database file. Every connection runs in WAL mode so readers
+    never block the writer (and vice versa), and in autocommit mode so transactions are always explicit
+
+    Args:
+        path: str - Path of the SQLite database file
+        size: int - Number of connections kept open '''
+    def __init__(self, path: str, size: int = SQLITE_POOL_SIZE):
+        self.path = path
+        self.size = size
+        self._open()
+
+    def _open(self):
+        ''' Fills the pool with fresh connections owned by the current process '''
+        self._pid = os.getpid()
+        self._pool = queue.LifoQueue(maxsize=self.size) # LIFO so the warmest connection (and its statement cache) is reused first
+        for _ in range(self.size):
+            self._pool.put(self._connect())
+
+    def _connect(self) -> sqlite3.Connection:
+        ''' Opens a connection with the pragmas tuned for a read heavy, concurrently written database '''
+        conn = sqlite3.connect(self.path, timeout=SQLITE_BUSY_TIMEOUT / 1000, isolation_level=None, check_same_thread=False, cached_statements=256)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL") # Safe with WAL, only the last transactions can be lost on power failure
+        conn.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT}")
+        conn.execute("PRAGMA foreign_keys=ON")
+        conn.execute("PRAGMA cache_size=-16000") # 16MB page cache
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA mmap_size=268435456") # 256MB
+        return conn
+
+    @contextlib.contextmanager
+    def connection(self):
+        ''' Borrows a connection from the pool for the duration of the with block '''
+        if os.getpid() != self._pid: # SQLite connections must never be used by a forked worker process
+            self._open()
+        conn = self._pool.get()
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction: # Never hand back a connection with a transaction left open
+                conn.rollback()
+            self._pool.put(conn)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        ''' Runs the with block in a single write transaction that is rolled back if anything in it fails '''
+        with self.connection() as conn:
+            conn.execute("BEGIN IMMEDIATE") # Take the write lock up front instead of failing to upgrade a read lock later
+            try:
+                yield conn
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+
+    def close(self):
+        ''' Closes every connection in the pool '''
+        while not self._pool.empty():
+            self._pool.get().close()
+
+# Multi valued metadata fields, each one is stored in its own indexed join table (paper_<facet>) instead of a JSON blob
+FACETS = ["authors", "datasets", "metrics", "methods", "applications", "limitations", "areasOfImprovement"]
+
+# Statements are kept as constants so every call reuses the prepared statement cached on the connection.
+# Lists of IDs are passed as one JSON array parameter (json_each) so the statement text never depends on the list length
+UPSERT_PAPER = '''INSERT INTO papers (id, title, summary, link, arxivId, addedAt) VALUES (?,?,?,?,?,?)
+                  ON CONFLICT(id) DO UPDATE SET title=excluded.title, summary=excluded.summary, link=excluded.link,
+                  arxivId=COALESCE(excluded.arxivId, papers.arxivId)'''
+UPDATE_PAPER = "UPDATE papers SET title=?, summary=?, link=? WHERE id=?"
+INSERT_FACETS = {facet: f"INSERT INTO paper_{facet} (paperId, position, value) VALUES (?,?,?)" for facet in FACETS}
+DELETE_FACETS = {facet: f"DELETE FROM paper_{facet} WHERE paperId IN (SELECT value FROM json_each(?))" for facet in FACETS}
+SELECT_PAPERS_BY_IDS = "SELECT * FROM papers WHERE id IN (SELECT value FROM json_each(?))"
+SELECT_ALL_PAPERS = "SELECT * FROM papers ORDER BY addedAt"
+SELECT_FACETS_BY_IDS = " UNION ALL ".join(f"SELECT paperId, '{facet}', position, value FROM paper_{facet} WHERE paperId IN (SELECT value FROM json_each(?1))" for facet in FACETS)
+SELECT_ALL_FACETS = " UNION ALL ".join(f"SELECT paperId, '{facet}', position, value FROM paper_{facet}" for facet in FACETS)
+SELECT_EXISTING_PAPER = "SELECT id FROM papers WHERE id=? OR (arxivId IS NOT NULL AND arxivId=?) LIMIT 1"
+DELETE_PAPERS = "DELETE FROM papers WHERE id IN (SELECT value FROM json_each(?))" # Facets are removed by ON DELETE CASCADE
+DELETE_ALL_PAPERS = "DELETE FROM papers"
+
+# Library listing, keyset paginated over the (title COLLATE NOCASE, id) and (addedAt, id) indexes
+LIST_COLUMNS = "id, title, link, addedAt" # Summary columns only, the facets are loaded when a paper is opened
+LIST_SORTS = {"title": "title COLLATE NOCASE", "addedAt": "addedAt"}
+
+# Full text (FTS5) indexes, the rowids of papers_fts match the rowids of papers and the rowids of chunks_fts match chunks.id
+# so entries can be found again without scanning the index
+FTS_FIELDS = ["title", "summary", *FACETS]
+FTS_WEIGHTS = ", ".join(["10.0", "3.0", "4.0", "6.0", "4.0", "5.0", "2.0", "1.0", "1.0"]) # bm25 column weights, matches FTS_FIELDS
+INSERT_PAPERS_FTS = f"INSERT INTO papers_fts (rowid, {', '.join(FTS_FIELDS)}) SELECT rowid, {', '.join(['?']*len(FTS_FIELDS))} FROM papers WHERE id=?"
+DELETE_PAPERS_FTS = "DELETE FROM papers_fts WHERE rowid IN (SELECT rowid FROM papers WHERE id IN (SELECT value FROM json_each(?)))"
+INSERT_CHUNK = "INSERT INTO chunks (id, paperId, chunkIndex, page) VALUES (?,?,?,?)"
+INSERT_CHUNK_FTS = "INSERT INTO chunks_fts (rowid, content) VALUES (?,?)"
+DELETE_CHUNKS_FTS = "DELETE FROM chunks_fts WHERE rowid IN (SELECT id FROM chunks WHERE paperId IN (SELECT value FROM json_each(?)))"
+DELETE_CHUNKS = "DELETE FROM chunks WHERE paperId IN (SELECT value FROM json_each(?))"
+SELECT_CHUNKS = '''SELECT chunks.paperId, chunks.chunkIndex, chunks.page, chunks_fts.content FROM chunks JOIN chunks_fts ON chunks_fts.rowid = chunks.id
+                   WHERE chunks.paperId IN (SELECT value FROM json_each(?)) ORDER BY chunks.paperId, chunks.chunkIndex'''
+COUNT_CHUNKS = '''SELECT papers.id, COUNT(chunks.id) AS chunks FROM papers LEFT JOIN chunks ON chunks.paperId = papers.id
+                  WHERE papers.id IN (SELECT value FROM json_each(?)) GROUP BY papers.id'''
+SEARCH_PAPERS_FTS = f'''SELECT papers.id, bm25(papers_fts, {FTS_WEIGHTS}) AS score FROM papers_fts JOIN papers ON papers.rowid = papers_fts.rowid
+                       WHERE papers_fts MATCH ? ORDER BY score LIMIT ?'''
+SEARCH_CHUNKS_FTS = '''SELECT paperId, MIN(score) AS score, snippet FROM
+                           (SELECT chunks.paperId, bm25(chunks_fts) AS score, snippet(chunks_fts, 0, '**', '**', '...', 24) AS snippet
+                            FROM chunks_fts JOIN chunks ON chunks.id = chunks_fts.rowid WHERE chunks_fts MATCH ? ORDER BY score LIMIT ?)
+                       GROUP BY paperId ORDER BY score'''
+
+def _asList(value) -> list[str]:
+    ''' Normalizes a metadata field into a list of strings (older rows stored empty fields as {}) '''
+    if isinstance(value, dict):
+        value = list(value.values())
+    elif isinstance(value, str):
+        value = [value]
+    return [str(v).strip() for v in value or [] if str(v).strip()]
+
+def _writeFacets(conn: sqlite3.Connection, papers: dict[str, dict]):
+    ''' Replaces the facet values of the given papers (paperId -> metadata) '''
+    paperIds = json.dumps(list(papers))
+    for facet in FACETS:
+        conn.execute(DELETE_FACETS[facet], (paperIds,))
+        conn.executemany(INSERT_FACETS[facet], [(paperId, position, value) for paperId, metadata in papers.items()
+                                                for position, value in enumerate(_asList(metadata.get(facet, [])))])
+
+def _writePapersFts(conn: sqlite3.Connection, papers: dict[str, dict]):
+    ''' Replaces the full text index entries of the given papers (paperId -> metadata) '''
+    conn.execute(DELETE_PAPERS_FTS, (json.dumps(list(papers)),))
+    conn.executemany(INSERT_PAPERS_FTS, [(metadata.get('title', ''), metadata.get('summary', ''),
+                                          *["; ".join(_asList(metadata.get(facet, []))) for facet in FACETS], paperId)
+                                         for paperId, metadata in papers.items()])
+
+def _writeChunks(conn: sqlite3.Connection, chunks: dict[str, list[tuple[int, str]]]):
+    ''' Replaces the indexed chunk texts of the given papers (paperId -> [(page, text), ...]) '''
+    paperIds = json.dumps(list(chunks))
+    conn.execute(DELETE_CHUNKS_FTS, (paperIds,))
+    conn.execute(DELETE_CHUNKS, (paperIds,))
+    nextId = conn.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM chunks").fetchone()[0] # Safe as the write lock is held
+    rows = []
+    for paperId, paperChunks in chunks.items():
+        for chunkIndex, (page, text) in enumerate(paperChunks):
+            rows.append((nextId, paperId, chunkIndex, page, text))
+            nextId += 1
+    conn.executemany(INSERT_CHUNK, [row[:4] for row in rows])
+    conn.executemany(INSERT_CHUNK_FTS, [(row[0], row[4]) for row in rows])
+
+def ftsQuery(query: str, operator: str = "OR") -> str:
+    ''' Turns free text into a safe FTS5 query, every word becomes a phrase of its tokens (so 2310.11453 or GPT-4
+    match as written) and the phrases are OR-ed together so BM25 ranks papers by how many of them they contain
+    (AND-ed instead when filtering) '''
+    phrases = []
+    for term in query.split():
+        tokens = re.findall(r"\w+", term)
+        if tokens:
+            phrases.append('"' + " ".join(tokens) + '"')
+    return f" {operator} ".join(phrases)
+
+def _assemblePapers(paperRows, facetRows) -> list[dict]:
+    ''' Builds paper dictionaries from the rows of the papers table and the rows of the facet tables '''
+    papers = {}
+    for row in paperRows:
+        papers[row["id"]] = {
+            "id": row["id"],
+            "title": row["title"],
+            "summary": row["summary"],
+            "link": row["link"],
+            "arxivId": row["arxivId"],
+            "addedAt": row["addedAt"],
+            **{facet: [] for facet in FACETS},
+        }
+    for paperId, facet, position, value in sorted(facetRows, key=lambda row: (row[0], row[1], row[2])):
+        if paperId in papers:
+            papers[paperId][facet].append(value)
+    return list(papers.values())
+
+def _checkFacet(facet: str):
+    ''' Makes sure a facet name is valid before it is used as part of a table name '''
+    if facet not in FACETS:
+        raise Exception(f"Unknown facet: {facet}")
+
+def _facetFilterSql(filters: dict[str, list[str]], text: str = None) -> tuple[str, list]:
+    ''' Builds the WHERE clause (and its parameters) that keeps the papers matching every facet filter, where a
+    paper matches a filter if it has any of the filter's values, and containing every word of the text '''
+    clauses, params = [], []
+    match = ftsQuery(text or "", "AND")
+    if match:
+        clauses.append("rowid IN (SELECT rowid FROM papers_fts WHERE papers_fts MATCH ?)")
+        params.append(match)
+    for facet, values in (filters or {}).items():
+        _checkFacet(facet)
+        if values:
+            clauses.append(f"id IN (SELECT paperId FROM paper_{facet} WHERE value IN (SELECT value FROM json_each(?)))")
+            params.append(json.dumps(values))
+    return (" AND ".join(clauses) or "1"), params
+
+class PaperRepository:
+    ''' Data access for the paper metadata stored in SQLite, backed by a shared connection pool '''
+    def __init__(self, path: str = METADATA_DB):
+        self.pool = ConnectionPool(path)
+
+    def initSchema(self):
+        ''' Creates the tables and migrates an existing database to the latest schema version '''
+        with self.pool.transaction() as conn:
+            self._migrate(conn)
+
+    def _migrate(self, conn: sqlite3.Connection):
+        ''' Brings an existing metadata database up to the latest schema version (tracked with PRAGMA user_version) '''
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version < 1: # v1: Papers are keyed by the hash of their PDF and keep their arXiv ID for deduplication
+            conn.execute('''CREATE TABLE IF NOT EXISTS metadata
+                            (id TEXT PRIMARY KEY,
+                             title TEXT,
+                             summary TEXT,
+                             authors TEXT,
+                             link TEXT,
+                             datasets TEXT,
+                             metrics TEXT,
+                             methods TEXT,
+                             applications TEXT,
+                             limitations TEXT,
+                             areasOfImprovement TEXT)''')
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(metadata)")]
+            if "arxivId" not in columns:
+                conn.execute("ALTER TABLE metadata ADD COLUMN arxivId TEXT")
+            conn.execute("CREATE INDEX IF NOT EXISTS metadata_arxivId ON metadata (arxivId)")
+            conn.execute("PRAGMA user_version = 1")
+
+        if version < 2: # v2: Normalized schema, the JSON list columns are moved into indexed per-facet tables
+            conn.execute('''CREATE TABLE papers
+                            (id TEXT PRIMARY KEY,
+                             title TEXT,
+                             summary TEXT,
+                             link TEXT,
+                             arxivId TEXT,
+                             addedAt REAL)''')
+            conn.execute("CREATE INDEX papers_arxivId ON papers (arxivId)")
+            conn.execute("CREATE INDEX papers_addedAt ON papers (addedAt, id)")
+            conn.execute("CREATE INDEX papers_title ON papers (title COLLATE NOCASE, id)")
+            for facet in FACETS:
+                conn.execute(f'''CREATE TABLE paper_{facet}
+                                 (paperId TEXT REFERENCES papers (id) ON DELETE CASCADE,
+                                  position INTEGER,
+                                  value TEXT COLLATE NOCASE,
+                                  PRIMARY KEY (paperId, position)) WITHOUT ROWID''')
+                conn.execute(f"CREATE INDEX paper_{facet}_value ON paper_{facet} (value, paperId)")
+
+            # Copy the existing papers over, keeping the order they were added in
+            rows = conn.execute("SELECT rowid, * FROM metadata ORDER BY rowid").fetchall()
+            start = time.time() - len(rows)
+            legacy = {}
+            for i, row in enumerate(rows):
+                arxivLink = re.match(r"https?://arxiv\.org/abs/(.+?)(v\d+)?$", row["link"] or "") # Scraped papers from before v1 only kept their link
+                arxivId = row["arxivId"] or (arxivLink.group(1) if arxivLink else None)
+                conn.execute(UPSERT_PAPER, (row["id"], row["title"], row["summary"], row["link"], arxivId, start + i))
+                legacy[row["id"]] = {facet: json.loads(row[facet] or "[]") for facet in FACETS}
+            _writeFacets(conn, legacy)
+            conn.execute("DROP TABLE metadata")
+            conn.execute("PRAGMA user_version = 2")
+
+        if version < 3: # v3: FTS5 keyword indexes over the paper metadata and the chunk texts
+            conn.execute("CREATE TABLE settings (key TEXT PRIMARY KEY, value TEXT)")
+            conn.execute(f"CREATE VIRTUAL TABLE papers_fts USING fts5({', '.join(FTS_FIELDS)}, tokenize='porter unicode61')")
+            conn.execute('''CREATE TABLE chunks
+                            (id INTEGER PRIMARY KEY,
+                             paperId TEXT REFERENCES papers (id) ON DELETE CASCADE,
+                             chunkIndex INTEGER,
+                             page INTEGER)''')
+            conn.execute("CREATE INDEX chunks_paperId ON chunks (paperId)")
+            conn.execute("CREATE VIRTUAL TABLE chunks_fts USING fts5(content, tokenize='porter unicode61')")
+
+            papers = _assemblePapers(conn.execute(SELECT_ALL_PAPERS).fetchall(), conn.execute(SELECT_ALL_FACETS).fetchall())
+            _writePapersFts(conn, {paper["id"]: paper for paper in papers})
+            if papers: # The chunk texts only live in Chroma, so database.initDatabases copies them over once
+                conn.execute("INSERT INTO settings VALUES ('chunkIndexBackfill', 'pending')")
+            conn.execute("PRAGMA user_version = 3")
+
+    def insertPapers(self, papers: list[tuple[str, dict, str | None]], chunks: dict[str, list[tuple[int, str]]] = None):
+        ''' Inserts (or replaces) several papers given as (paperId, metadata, arxivId) in one transaction, along with
+        the (page, text) of their chunks for the keyword index '''
+        with self.pool.transaction() as conn:
+            self.writePapers(conn, papers, chunks)
+
+    def writePapers(self, conn: sqlite3.Connection, papers: list[tuple[str, dict, str | None]], chunks: dict[str, list[tuple[int, str]]] = None):
+        ''' Same as insertPapers, inside a transaction the caller holds so its other writes commit together with them '''
+        now = time.time()
+        conn.executemany(UPSERT_PAPER, [(paperId, metadata.get('title', ''), metadata.get('summary', ''), metadata.get('link', ''), arxivId, now)
+                                        for paperId, metadata, arxivId in papers])
+        _writeFacets(conn, {paperId: metadata for paperId, metadata, _ in papers})
+        _writePapersFts(conn, {paperId: metadata for paperId, metadata, _ in papers})
+        if chunks:
+            _writeChunks(conn, chunks)
+
+    def replaceChunks(self, chunks: dict[str, list[tuple[int, str]]]):
+        ''' Replaces the indexed chunk texts of several papers (paperId -> [(page, text), ...]) in one transaction '''
+        with self.pool.transaction() as conn:
+            _writeChunks(conn, chunks)
+
+    def updatePapers(self, updates: dict[str, dict]):
+        ''' Updates the metadata of several papers (paperId -> metadata) in one transaction '''
+        with self.pool.transaction() as conn:
+            conn.executemany(UPDATE_PAPER, [(metadata.get('title', ''), metadata.get('summary', ''), metadata.get('link', ''), paperId)
+                                            for paperId, metadata in updates.items()])
+            _writeFacets(conn, updates)
+            _writePapersFts(conn, updates)
+
+    def deletePapers(self, paperIds: list[str]):
+        ''' Deletes several papers in one transaction '''
+        ids = json.dumps(paperIds)
+        with self.pool.transaction() as conn:
+            conn.execute(DELETE_CHUNKS_FTS, (ids,)) # The index entries are found through the rows they belong to, so they go first
+            conn.execute(DELETE_PAPERS_FTS, (ids,))
+            conn.execute(DELETE_PAPERS, (ids,))
+
+    def deleteAllPapers(self):
+        ''' Deletes every paper '''
+        with self.pool.transaction() as conn:
+            conn.execute("DELETE FROM chunks_fts")
+            conn.execute("DELETE FROM papers_fts")
+            conn.execute(DELETE_ALL_PAPERS)
+
+    def getChunks(self, paperIds: list[str]) -> dict[str, list[tuple[int, int, str]]]:
+        ''' Gets the indexed chunks of several papers as paperId -> [(chunkIndex, page, text), ...] '''
+        chunks = {}
+        with self.pool.connection() as conn:
+            for row in conn.execute(SELECT_CHUNKS, (json.dumps(paperIds),)):
+                chunks.setdefault(row["paperId"], []).append((row["chunkIndex"], row["page"], row["content"]))
+        return chunks
+
+    def countChunks(self, paperIds: list[str]) -> dict[str, int]:
+        ''' Counts the indexed chunks of several papers, papers that are not stored are left out '''
+        with self.pool.connection() as conn:
+            return {row["id"]: row["chunks"] for row in conn.execute(COUNT_CHUNKS, (json.dumps(paperIds),))}
+
+    def listPaperIds(self, after: str = "", limit: int = 1000) -> list[str]:
+        ''' Gets the next page of paper IDs in ID order, for walking the whole library in batches '''
+        with self.pool.connection() as conn:
+            return [row["id"] for row in conn.execute("SELECT id FROM papers WHERE id>? ORDER BY id LIMIT ?", (after, limit))]
+
+    def getPapersByIds(self, paperIds: list[str]) -> list[dict]:
+        ''' Gets the papers with the given IDs, in the same order as the IDs '''
+        ids = json.dumps(paperIds)
+        with self.pool.connection() as conn:
+            papers = _assemblePapers(conn.execute(SELECT_PAPERS_BY_IDS, (ids,)).fetchall(), conn.execute(SELECT_FACETS_BY_IDS, (ids,)).fetchall())
+        order = {paperId: i for i, paperId in enumerate(paperIds)}
+        return sorted(papers, key=lambda paper: order[paper["id"]])
+
+    def getAllPapers(self) -> list[dict]:
+        ''' Gets every stored paper '''
+        with self.pool.connection() as conn:
+            return _assemblePapers(conn.execute(SELECT_ALL_PAPERS).fetchall(), conn.execute(SELECT_ALL_FACETS).fetchall())
+
+    def findExistingPaper(self, paperId: str = None, arxivId: str = None) -> str | None:
+        ''' Finds an already stored paper by its content hash or arXiv ID and returns its ID '''
+        with self.pool.connection() as conn:
+            row = conn.execute(SELECT_EXISTING_PAPER, (paperId, arxivId)).fetchone()
+        return row["id"] if row else None
+
+    def filterPapers(self, filters: dict[str, list[str]], limit: int = -1, offset: int = 0) -> list[str]:
+        ''' Gets the IDs of the papers that match every facet filter (facet -> values), newest first '''
+        where, params = _facetFilterSql(filters)
+        with self.pool.connection() as conn:
+            rows = conn.execute(f"SELECT id FROM papers WHERE {where} ORDER BY addedAt DESC LIMIT ? OFFSET ?", (*params, limit, offset))
+            return [row["id"] for row in rows]
+
+    def listPapers(self, filters: dict[str, list[str]] = None, text: str = None, sort: str = "addedAt", descending: bool = True,
+                   after: tuple = None, limit: int = 20) -> tuple[list[dict], tuple | None]:
+        ''' Gets one page of the summary columns (id, title, link, addedAt) of the papers matching the facet filters
+        and text, sorted by title or date added. Pages are keyset paginated: pass the returned cursor as `after` to get
+        the next page, which is as fast deep into the library as on the first page. The cursor is None on the last page '''
+        if sort not in LIST_SORTS:
+            raise Exception(f"Unknown sort: {sort}")
+        where, params = _facetFilterSql(filters, text)
+        column, direction = LIST_SORTS[sort], "DESC" if descending else "ASC"
+        if after is not None:
+            where += f" AND ({column}, id) {'<' if descending else '>'} (?, ?)"
+            params += list(after)
+        with self.pool.connection() as conn:
+            rows = conn.execute(f"SELECT {LIST_COLUMNS} FROM papers WHERE {where} ORDER BY {column} {direction}, id {direction} LIMIT ?",
+                                (*params, limit + 1)).fetchall() # One extra row tells whether there is a next page
+        papers = [dict(row) for row in rows[:limit]]
+        cursor = (papers[-1][sort], papers[-1]["id"]) if len(rows) > limit else None
+        return papers, cursor
+
+    def countPapers(self, filters: dict[str, list[str]] = None, text: str = None) -> int:
+        ''' Counts the papers matching the facet filters and text '''
+        where, params = _facetFilterSql(filters, text)
+        with self.pool.connection() as conn:
+            return conn.execute(f"SELECT COUNT(*) FROM papers WHERE {where}", params).fetchone()[0]
+
+    def getFacetCounts(self, facet: str, filters: dict[str, list[str]] = None, limit: int = 20) -> list[tuple[str, int]]:
+        ''' Gets the most common values of a facet and how many papers have them, within the papers matching the filters '''
+        _checkFacet(facet)
+        where, params = _facetFilterSql(filters)
+        sql = f"SELECT value, COUNT(*) AS papers FROM paper_{facet}"
+        if params:
+            sql += f" WHERE paperId IN (SELECT id FROM papers WHERE {where})"
+        with self.pool.connection() as conn:
+            rows = conn.execute(sql + " GROUP BY value ORDER BY papers DESC, value LIMIT ?", (*params, limit))
+            return [(row["value"], row["papers"]) for row in rows]
+
+    def searchLexical(self, query: str, limit: int = 50) -> tuple[list[tuple[str, float]], list[tuple[str, float, str]]]:
+        ''' Keyword (BM25) search over the paper metadata and over the chunk texts. Returns the (paperId, score) of the
+        matching papers and the (paperId, score, snippet) of the best matching chunk of each paper, best first '''
+        match = ftsQuery(query)
+        if not match:
+            return [], []
+        with self.pool.connection() as conn:
+            paperHits = [(row["id"], -row["score"]) for row in conn.execute(SEARCH_PAPERS_FTS, (match, limit))]
+            chunkHits = [(row["paperId"], -row["score"], row["snippet"]) for row in conn.execute(SEARCH_CHUNKS_FTS, (match, limit * 5))]
+        return paperHits, chunkHits[:limit]
+
+    def getSetting(self, key: str, default: str = None) -> str | None:
+        ''' Gets a value from the settings table '''
+        with self.pool.connection() as conn:
+            row = conn.execute("SELECT value FROM settings WHERE key=?", (key,)).fetchone()
+        return row["value"] if row else default
+
+    def setSetting(self, key: str, value: str):
+        ''' Stores a value in the settings table '''
+        with self.pool.transaction() as conn:
+            conn.execute("INSERT OR REPLACE INTO settings VALUES (?,?)", (key, value))
+
+    def getGeneration(self) -> int:
+        ''' Gets the library generation, a counter that changes whenever a paper is added, edited or removed '''
+        return int(self.getSetting("generation", "0"))
+
+    def bumpGeneration(self) -> int:
+        ''' Increments the library generation so every process drops the search results it has cached '''
+        with self.pool.transaction() as conn:
+            conn.execute("INSERT INTO settings VALUES ('generation', '1') ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1")
+            return int(conn.execute("SELECT value FROM settings WHERE key='generation'").fetchone()["value"])
@@ -0,0 +1,114 @@
+from cache import TTLCache
+from config import RESULT_CACHE_SIZE, RESULT_CACHE_TTL
+from database import repository, storage, searchChunks, getPapersByIds
+from embeddings import queryCache, normalizeQuery, embedQuery
+
+RRF_K = 60 # Standard reciprocal rank fusion constant, damps the difference between the very top ranks
+AGGREGATIONS = ["max", "mean", "topk"]
+
+def aggregateChunks(distances: list[float], aggregation: str = "max", topN: int = 3) -> float:
+    ''' Combines the distances of the matching chunks of one paper into a single paper distance (lower is closer)
+
+    Args:
+        aggregation: str - "max" uses the closest chunk, "mean" averages every matching chunk and "topk" averages the topN closest '''
+    distances = sorted(distances)
+    if aggregation == "max":
+        return distances[0]
+    if aggregation == "mean":
+        return sum(distances) / len(distances)
+    if aggregation == "topk":
+        return sum(distances[:topN]) / len(distances[:topN])
+    raise Exception(f"Unknown aggregation: {aggregation}")
+
+def rankPapersByVector(query: str, nPapers: int, aggregation: str = "max", topN: int = 3, overfetch: int = 4, maxChunks: int = 2000) -> list[dict]:
+    ''' Ranks papers by the vector distance of their chunks to the query. Chunks are overfetched and the fetch is doubled
+    until at least nPapers distinct papers are found (or the collection runs out), so several matching chunks from one
+    paper never leave fewer papers than asked for. Returns [{paperId, distance, snippet, page}] closest first '''
+    nChunks = max(nPapers * overfetch, 10)
+    index = storage.activeIndex()
+    queryEmbedding = embedQuery(query, index[0]) # Once, not for every deeper fetch, so a search is one query cache lookup
+    while True:
+        chunks = searchChunks(query, nChunks, index, queryEmbedding)
+        byPaper = {}
+        for chunk in chunks: # Chunks come back closest first, so the first one seen of a paper is its best match
+            byPaper.setdefault(chunk["paperId"], []).append(chunk)
+        if len(byPaper) >= nPapers or len(chunks) < nChunks or nChunks >= maxChunks:
+            break
+        nChunks = min(nChunks * 2, maxChunks)
+
+    ranked = [{
+        "paperId": paperId,
+        "distance": aggregateChunks([chunk["distance"] for chunk in paperChunks], aggregation, topN),
+        "snippet": paperChunks[0]["text"],
+        "page": paperChunks[0]["page"],
+    } for paperId, paperChunks in byPaper.items()]
+    return sorted(ranked, key=lambda hit: hit["distance"])
+
+def vectorSearch(query: str, k: int = 5, page: int = 0, aggregation: str = "max", topN: int = 3) -> list[dict]:
+    ''' Gets exactly k distinct papers (fewer only if the library runs out) for one page of vector search results,
+    in similarity order, each with its "score" (higher is closer), best matching "snippet" and its "page" number '''
+    hits = rankPapersByVector(query, (page + 1) * k, aggregation, topN)[page * k:(page + 1) * k]
+    papers = {paper["id"]: paper for paper in getPapersByIds([hit["paperId"] for hit in hits])}
+    return [{**papers[hit["paperId"]], "score": 1 / (1 + hit["distance"]), "snippet": hit["snippet"], "snippetPage": hit["page"]}
+            for hit in hits if hit["paperId"] in papers]
+
+def reciprocalRankFusion(rankings: list[tuple[list[str], float]], k: int = RRF_K) -> dict[str, float]:
+    ''' Fuses several rankings of paper IDs, each with a weight, into one score per paper (higher is better) '''
+    scores = {}
+    for ranking, weight in rankings:
+        for rank, paperId in enumerate(ranking):
+            scores[paperId] = scores.get(paperId, 0.0) + weight / (k + rank + 1)
+    return scores
+
+resultCache = TTLCache(RESULT_CACHE_SIZE, RESULT_CACHE_TTL)
+
+def getCacheStats() -> dict:
+    ''' Gets the hit/miss counters of the query embedding and search result caches '''
+    return {"queryEmbeddings": queryCache.stats(), "results": resultCache.stats()}
+
+def hybridSearch(query: str, k: int = 5, lexicalWeight: float = 1.0, vectorWeight: float = 1.0, mode: str = "hybrid",
+                 page: int = 0, aggregation: str = "max") -> list[dict]:
+    ''' Cached front of _hybridSearch. Result pages are keyed by the normalized query and every search option and are
+    only served while the library generation they were computed at is current, so any paper being stored, edited or
+    removed (by this process or a worker) invalidates them '''
+    key = (repository.getGeneration(), storage.activeModel, normalizeQuery(query), k, lexicalWeight, vectorWeight, mode, page, aggregation)
+    results = resultCache.get(key)
+    if results is None:
+        results = _hybridSearch(query, k, lexicalWeight, vectorWeight, mode, page, aggregation)
+        resultCache.put(key, results)
+    return [dict(result) for result in results] # Copies so callers cannot modify the cached results
+
+def _hybridSearch(query: str, k: int = 5, lexicalWeight: float = 1.0, vectorWeight: float = 1.0, mode: str = "hybrid",
+                  page: int = 0, aggregation: str = "max") -> list[dict]:
+    ''' Searches the papers with BM25 keyword search over the metadata and chunk texts, vector search over the chunk
+    embeddings, or both fused with reciprocal rank fusion. Returns one page of up to k papers, best first, each with
+    its "score" and a "snippet" of its best matching chunk. Lexical only searches never call Ollama to embed the query
+
+    Args:
+        mode: str - "hybrid", "lexical" or "vector"
+        lexicalWeight: float - Weight of the keyword rankings in the fused score
+        vectorWeight: float - Weight of the vector ranking in the fused score
+        aggregation: str - How the chunk distances of a paper are combined, see aggregateChunks '''
+    if mode not in ("hybrid", "lexical", "vector"):
+        raise Exception(f"Unknown search mode: {mode}")
+    if mode == "vector":
+        return vectorSearch(query, k, page, aggregation)
+
+    nPapers = (page + 1) * k
+    rankings, snippets = [], {}
+    if lexicalWeight > 0:
+        paperHits, chunkHits = repository.searchLexical(query, limit=nPapers * 4)
+        rankings.append(([paperId for paperId, _ in paperHits], lexicalWeight))
+        rankings.append(([paperId for paperId, _, _ in chunkHits], lexicalWeight))
+        for paperId, _, snippet in chunkHits:
+            snippets.setdefault(paperId, snippet)
+
+    if mode == "hybrid" and vectorWeight > 0:
+        vectorHits = rankPapersByVector(query, nPapers * 2, aggregation) # Deeper than the page so fusion can promote papers
+        rankings.append(([hit["paperId"] for hit in vectorHits], vectorWeight))
+        for hit in vectorHits:
+            snippets.setdefault(hit["paperId"], hit["snippet"])
+
+    scores = reciprocalRankFusion(rankings)
+    pageIds = sorted(scores, key=scores.get, reverse=True)[page * k:nPapers]
+    return [{**paper, "score": scores[paper["id"]], "snippet": snippets.get(paper["id"], "")} for paper in getPapersByIds(pageIds)]
@@ -0,0 +1,384 @@
+''' Paper level vectors for finding similar papers and grouping the library into topics. The vector of a paper is the
+mean of its chunk embeddings, computed when the paper is stored and kept in a float32 matrix file per index (one row
+per paper) that is memory mapped for reading, so "more like this" is one matrix-vector product and the neighbours of
+every paper are a few blocked matrix products on the CPU. Topics are spherical k-means clusters, stored papers join
+the closest topic straight away and the workers cluster the library again once it has changed enough:
+
+    python app/similarity.py --build                        # Compute the vectors of papers stored before they existed
+    python app/similarity.py --cluster                      # Cluster the library again now (--cluster 50 for 50 topics)
+    python app/similarity.py --neighbours 10 > similar.tsv  # The 10 most similar papers of every paper
+'''
+import argparse
+import math
+import os
+import sys
+import time
+
+import numpy as np
+
+from config import VECTORS_DIR, SIMILARITY_BLOCK_SIZE, TOPIC_COUNT, TOPIC_MIN_PAPERS, TOPIC_RECLUSTER_GROWTH
+
+INITIAL_CAPACITY = 1024 # Rows a matrix file starts with, it doubles whenever it is full
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    ''' Scales vectors to unit length so their dot products are cosine similarities '''
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+def _topK(scores: np.ndarray, k: int) -> np.ndarray:
+    ''' Gets the indices of the k highest scores (of every row), highest first, without sorting the whole row '''
+    k = min(k, scores.shape[-1])
+    top = np.argpartition(scores, -k, axis=-1)[..., -k:]
+    return np.take_along_axis(top, np.argsort(-np.take_along_axis(scores, top, axis=-1), axis=-1), axis=-1)
+
+def _groupSums(labels: np.ndarray, vectors: np.ndarray, k: int) -> np.ndarray:
+    ''' Sums the vectors of every label (0 to k-1) in one pass over the vectors sorted by label '''
+    sums = np.zeros((k, vectors.shape[1]), dtype=np.float64)
+    if len(labels):
+        order = np.argsort(labels, kind="stable")
+        sortedLabels = labels[order]
+        starts = np.flatnonzero(np.r_[True, sortedLabels[1:] != sortedLabels[:-1]])
+        sums[sortedLabels[starts]] = np.add.reduceat(vectors[order].astype(np.float64), starts, axis=0)
+    return sums
+
+def _seedCentroids(sample: np.ndarray, k: int, rng: np.random.Generator) -> np.ndarray:
+    ''' Picks k spread out starting centroids from a sample of the vectors (k-means++ with cosine distances) '''
+    centroids = [sample[rng.integers(len(sample))]]
+    distances = np.maximum(1 - sample @ centroids[0], 0).astype(np.float64)
+    for _ in range(1, k):
+        total = distances.sum()
+        centroid = sample[rng.choice(len(sample), p=distances / total) if total > 0 else rng.integers(len(sample))]
+        centroids.append(centroid)
+        distances = np.minimum(distances, np.maximum(1 - sample @ centroid, 0))
+    return np.array(centroids, dtype=np.float32)
+
+def _assign(matrix: np.ndarray, positions: np.ndarray, centroids: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    ''' Gets the closest centroid of every vector with its similarity, and the sum of the vectors closest to every
+    centroid. Goes over the matrix a block of vectors at a time, so it is never copied as a whole '''
+    labels, scores = np.empty(len(positions), dtype=np.int64), np.empty(len(positions), dtype=np.float32)
+    sums = np.zeros((len(centroids), matrix.shape[1]), dtype=np.float64)
+    for start in range(0, len(positions), SIMILARITY_BLOCK_SIZE):
+        block = matrix[positions[start:start+SIMILARITY_BLOCK_SIZE]]
+        blockScores = block @ centroids.T
+        labels[start:start+SIMILARITY_BLOCK_SIZE] = blockLabels = blockScores.argmax(axis=1)
+        scores[start:start+SIMILARITY_BLOCK_SIZE] = blockScores.max(axis=1)
+        sums += _groupSums(blockLabels, block, len(centroids))
+    return labels, scores, sums
+
+class PaperVectors:
+    ''' The paper vectors and topics of every index, the rows of the matrix files are mapped to papers in SQLite
+
+    Args:
+        pool: ConnectionPool - The metadata database, it keeps the row of every paper and the topics
+        path: str - Directory of the matrix files '''
+    def __init__(self, pool, path: str = VECTORS_DIR):
+        self.pool = pool
+        self.path = path
+        self._snapshots = {}
+        self.initSchema()
+
+    def initSchema(self):
+        ''' Creates the tables of the matrix files, the rows of their papers and their topics '''
+        with self.pool.transaction() as conn:
+            conn.execute('''CREATE TABLE IF NOT EXISTS vector_indexes
+                            (collection TEXT PRIMARY KEY,
+                             dim INTEGER,
+                             capacity INTEGER,
+                             version INTEGER DEFAULT 0,
+                             clusteredVersion INTEGER DEFAULT 0,
+                             clusteredPapers INTEGER DEFAULT 0)''')
+            conn.execute('''CREATE TABLE IF NOT EXISTS paper_vectors
+                            (collection TEXT,
+                             row INTEGER,
+                             paperId TEXT,
+                             topic INTEGER,
+                             PRIMARY KEY (collection, row))''')
+            conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS paper_vectors_paperId ON paper_vectors (collection, paperId)") # Rows of deleted papers (NULL) are reused
+            conn.execute('''CREATE TABLE IF NOT EXISTS topics
+                            (collection TEXT,
+                             topic INTEGER,
+                             size INTEGER,
+                             centroid BLOB,
+                             exemplarId TEXT,
+                             PRIMARY KEY (collection, topic))''')
+
+    def _file(self, collection: str) -> str:
+        ''' Gets the path of the matrix file of an index '''
+        return os.path.join(self.path, f"{collection}.f32")
+
+    def _readRows(self, collection: str, dim: int, rows: list[int]) -> np.ndarray:
+        ''' Reads rows of a matrix file '''
+        return np.array(np.memmap(self._file(collection), dtype=np.float32, mode="r").reshape(-1, dim)[rows])
+
+    def _index(self, conn, collection: str, dim: int) -> dict:
+        ''' Gets the matrix file of an index, which is created with the dimensions of the first vector written to it '''
+        index = conn.execute("SELECT * FROM vector_indexes WHERE collection=?", (collection,)).fetchone()
+        if index is None:
+            conn.execute("INSERT INTO vector_indexes (collection, dim, capacity) VALUES (?,?,0)", (collection, dim))
+            return {"dim": dim, "capacity": 0}
+        if index["dim"] != dim:
+            raise Exception(f"The paper vectors of {collection} have {index['dim']} dimensions, not {dim}")
+        return dict(index)
+
+    def _reserve(self, conn, collection: str, index: dict, row: int):
+        ''' Grows the matrix file (doubling it) until it has the row. Only done under the write lock, so two processes
+        never resize the file at the same time '''
+        if row < index["capacity"]:
+            return
+        capacity = max(INITIAL_CAPACITY, index["capacity"])
+        while capacity <= row:
+            capacity *= 2
+        os.makedirs(self.path, exist_ok=True)
+        with open(self._file(collection), "ab") as f:
+            f.truncate(capacity * index["dim"] * 4)
+        conn.execute("UPDATE vector_indexes SET capacity=? WHERE collection=?", (capacity, collection))
+        index["capacity"] = capacity
+
+    def _centroids(self, conn, collection: str, dim: int) -> tuple[np.ndarray, np.ndarray]:
+        ''' Gets the sizes and centroids (the mean vector of their papers) of the topics of an index '''
+        rows = conn.execute("SELECT size, centroid FROM topics WHERE collection=? ORDER BY topic", (collection,)).fetchall()
+        sizes = np.array([row["size"] for row in rows], dtype=np.int64)
+        return sizes, np.array([np.frombuffer(row["centroid"], dtype=np.float32) for row in rows], dtype=np.float64).reshape(len(rows), dim)
+
+    def _moveTopics(self, conn, collection: str, sizes: np.ndarray, centroids: np.ndarray, topics: np.ndarray, vectors: np.ndarray, sign: int):
+        ''' Adds papers to (sign 1) or removes papers from (sign -1) their topics, the centroids are updated in place so
+        they stay the mean of their papers without going over the other papers again '''
+        counts, sums = np.bincount(topics, minlength=len(sizes)), _groupSums(topics, vectors, len(sizes))
+        for topic in np.flatnonzero(counts):
+            size = sizes[topic] + sign * counts[topic]
+            if size > 0:
+                centroids[topic] = (centroids[topic] * sizes[topic] + sign * sums[topic]) / size
+            sizes[topic] = max(size, 0)
+            conn.execute("UPDATE topics SET size=?, centroid=? WHERE collection=? AND topic=?",
+                         (int(sizes[topic]), centroids[topic].astype(np.float32).tobytes(), collection, int(topic)))
+
+    def put(self, collection: str, paperId: str, embeddings: list[list[float]]):
+        ''' Stores the vector of a paper (the mean of its chunk embeddings) in an index and adds it to the closest topic,
+        a previous version of the paper is replaced '''
+        if len(embeddings) == 0:
+            return
+        vector = _normalize(np.asarray(embeddings, dtype=np.float32).mean(axis=0))
+        with self.pool.transaction() as conn:
+            index = self._index(conn, collection, len(vector))
+            sizes, centroids = self._centroids(conn, collection, len(vector))
+            previous = conn.execute("SELECT row, topic FROM paper_vectors WHERE collection=? AND paperId=?", (collection, paperId)).fetchone()
+            if previous:
+                row = previous["row"]
+                if previous["topic"] is not None:
+                    self._moveTopics(conn, collection, sizes, centroids, np.array([previous["topic"]]), self._readRows(collection, len(vector), [row]), -1)
+            else:
+                free = conn.execute("SELECT row FROM paper_vectors WHERE collection=? AND paperId IS NULL LIMIT 1", (collection,)).fetchone()
+                row = free["row"] if free else conn.execute("SELECT COALESCE(MAX(row) + 1, 0) FROM paper_vectors WHERE collection=?", (collection,)).fetchone()[0]
+                self._reserve(conn, collection, index, row)
+
+            with open(self._file(collection), "r+b") as f:
+                f.seek(row * len(vector) * 4)
+                f.write(vector.astype(np.float32).tobytes())
+            topic = None
+            if len(sizes):
+                topic = int(np.argmax(_normalize(centroids) @ vector))
+                self._moveTopics(conn, collection, sizes, centroids, np.array([topic]), vector[None], 1)
+            conn.execute("INSERT OR REPLACE INTO paper_vectors VALUES (?,?,?,?)", (collection, row, paperId, topic))
+            conn.execute("UPDATE vector_indexes SET version=version + 1 WHERE collection=?", (collection,))
+
+    def delete(self, collection: str, paperIds: list[str]):
+        ''' Removes the vectors of papers from an index and from their topics, their rows are reused by the next papers '''
+        if not paperIds:
+            return
+        with self.pool.transaction() as conn:
+            index = conn.execute("SELECT dim FROM vector_indexes WHERE collection=?", (collection,)).fetchone()
+            rows = conn.execute(f"SELECT row, topic FROM paper_vectors WHERE collection=? AND paperId IN ({','.join('?' * len(paperIds))})",
+                                (collection, *paperIds)).fetchall()
+            if index is None or not rows:
+                return
+            inTopics = [row for row in rows if row["topic"] is not None]
+            if inTopics:
+                sizes, centroids = self._centroids(conn, collection, index["dim"])
+                self._moveTopics(conn, collection, sizes, centroids, np.array([row["topic"] for row in inTopics]),
+                                 self._readRows(collection, index["dim"], [row["row"] for row in inTopics]), -1)
+            conn.executemany("UPDATE paper_vectors SET paperId=NULL, topic=NULL WHERE collection=? AND row=?", [(collection, row["row"]) for row in rows])
+            conn.execute("UPDATE vector_indexes SET version=version + 1 WHERE collection=?", (collection,))
+
+    def drop(self, collection: str):
+        ''' Removes every vector and topic of an index '''
+        self._snapshots.pop(collection, None)
+        with self.pool.transaction() as conn:
+            for table in ("vector_indexes", "paper_vectors", "topics"):
+                conn.execute(f"DELETE FROM {table} WHERE collection=?", (collection,))
+            try: # Under the write lock, so no process is growing the file meanwhile
+                os.remove(self._file(collection))
+            except FileNotFoundError:
+                pass
+
+    def dropAll(self):
+        ''' Removes the vectors and topics of every index '''
+        with self.pool.connection() as conn:
+            collections = [row["collection"] for row in conn.execute("SELECT collection FROM vector_indexes")]
+        for collection in collections:
+            self.drop(collection)
+
+    def stored(self, collection: str, paperIds: list[str]) -> set[str]:
+        ''' Gets which of the papers have a vector in an index '''
+        if not paperIds:
+            return set()
+        with self.pool.connection() as conn:
+            return {row["paperId"] for row in conn.execute(f"SELECT paperId FROM paper_vectors WHERE collection=? AND paperId IN ({','.join('?' * len(paperIds))})",
+                                                           (collection, *paperIds))}
+
+    def paperIds(self, collection: str) -> list[str]:
+        ''' Gets the IDs of every paper with a vector in an index '''
+        with self.pool.connection() as conn:
+            return [row["paperId"] for row in conn.execute("SELECT paperId FROM paper_vectors WHERE collection=? AND paperId IS NOT NULL", (collection,))]
+
+    def _snapshot(self, collection: str) -> dict | None:
+        ''' Gets the matrix of an index memory mapped for reading with the paper of every row, only read again from
+        SQLite when a vector was stored or deleted since '''
+        with self.pool.connection() as conn:
+            index = conn.execute("SELECT dim, version FROM vector_indexes WHERE collection=?", (collection,)).fetchone()
+            snapshot = self._snapshots.get(collection)
+            if index is None or (snapshot and snapshot["version"] == index["version"]):
+                return snapshot if index else None
+            rows = conn.execute("SELECT row, paperId FROM paper_vectors WHERE collection=? AND paperId IS NOT NULL", (collection,)).fetchall()
+        if not rows:
+            return None
+
+        paperIds = np.full(max(row["row"] for row in rows) + 1, None, dtype=object) # Rows of deleted papers stay None
+        for row in rows:
+            paperIds[row["row"]] = row["paperId"]
+        snapshot = {
+            "version": index["version"],
+            "matrix": np.memmap(self._file(collection), dtype=np.float32, mode="r", shape=(len(paperIds), index["dim"])),
+            "paperIds": paperIds,
+            "valid": np.array([paperId is not None for paperId in paperIds]),
+            "rows": {row["paperId"]: row["row"] for row in rows},
+        }
+        self._snapshots[collection] = snapshot
+        return snapshot
+
+    def similar(self, collection: str, paperId: str, n: int = 5) -> list[tuple[str, float]]:
+        ''' Gets the n papers most similar to a paper with their cosine similarity, most similar first '''
+        snapshot = self._snapshot(collection)
+        if snapshot is None or paperId not in snapshot["rows"] or n <= 0:
+            return []
+        row = snapshot["rows"][paperId]
+        scores = snapshot["matrix"] @ snapshot["matrix"][row]
+        scores[~snapshot["valid"]] = -np.inf
+        scores[row] = -np.inf
+        return [(snapshot["paperIds"][i], float(scores[i])) for i in _topK(scores, n) if np.isfinite(scores[i])]
+
+    def allPairs(self, collection: str, k: int = 10, blockSize: int = SIMILARITY_BLOCK_SIZE):
+        ''' Yields the k most similar papers of every paper as (paperId, [(paperId, similarity), ...]). The matrix is
+        multiplied with itself a block of papers at a time, so only blockSize rows of scores are held at once '''
+        snapshot = self._snapshot(collection)
+        if snapshot is None or k <= 0:
+            return
+        matrix, valid, paperIds = snapshot["matrix"], snapshot["valid"], snapshot["paperIds"]
+        positions = np.flatnonzero(valid)
+        for start in range(0, len(positions), blockSize):
+            block = positions[start:start+blockSize]
+            scores = matrix[block] @ matrix.T
+            scores[:, ~valid] = -np.inf
+            scores[np.arange(len(block)), block] = -np.inf
+            for i, top in enumerate(_topK(scores, k)):
+                yield paperIds[block[i]], [(paperIds[j], float(scores[i, j])) for j in top if np.isfinite(scores[i, j])]
+
+    def cluster(self, collection: str, k: int = None, iterations: int = 20, seed: int = 0) -> int:
+        ''' Clusters the papers of an index into k topics (TOPIC_COUNT, or sqrt(papers / 2) when it is 0) with spherical
+        k-means and replaces the topics of every paper, returns the number of topics. Papers stored or deleted while
+        it runs are accounted for before the topics are saved '''
+        snapshot = self._snapshot(collection)
+        positions = np.flatnonzero(snapshot["valid"]) if snapshot else np.array([], dtype=np.int64)
+        k = min(k or TOPIC_COUNT or max(2, round(math.sqrt(len(positions) / 2))), len(positions))
+        if k < 2:
+            with self.pool.transaction() as conn:
+                conn.execute("DELETE FROM topics WHERE collection=?", (collection,))
+                conn.execute("UPDATE paper_vectors SET topic=NULL WHERE collection=?", (collection,))
+                conn.execute("UPDATE vector_indexes SET clusteredVersion=version, clusteredPapers=0 WHERE collection=?", (collection,))
+            return 0
+
+        matrix, paperIds = snapshot["matrix"], snapshot["paperIds"]
+        rng = np.random.default_rng(seed)
+        centroids = _seedCentroids(np.array(matrix[np.sort(rng.choice(positions, min(len(positions), 32 * k), replace=False))]), k, rng)
+        labels = np.full(len(positions), -1)
+        for _ in range(iterations):
+            newLabels, scores, sums = _assign(matrix, positions, centroids)
+            counts = np.bincount(newLabels, minlength=k)
+            centroids = _normalize(sums / np.maximum(counts, 1)[:, None]).astype(np.float32)
+            empty = np.flatnonzero(counts == 0)
+            centroids[empty] = matrix[positions[np.argsort(scores)[:len(empty)]]] # Restart empty topics from the papers that fit their topic worst
+            converged = len(empty) == 0 and np.mean(newLabels != labels) < 0.001
+            labels = newLabels
+            if converged:
+                break
+        labels, scores, sums = _assign(matrix, positions, centroids)
+        counts = np.bincount(labels, minlength=k)
+        order = np.lexsort((-scores, labels))
+        exemplars = {int(labels[i]): paperIds[positions[i]] for i in order[np.r_[True, labels[order][1:] != labels[order][:-1]]]}
+
+        with self.pool.transaction() as conn:
+            current = dict(conn.execute("SELECT row, paperId FROM paper_vectors WHERE collection=? AND paperId IS NOT NULL", (collection,)).fetchall())
+            kept = np.array([current.get(int(row)) == paperIds[row] for row in positions], dtype=bool)
+            added = [row for row, paperId in current.items() if row >= len(paperIds) or paperIds[row] != paperId]
+            if not kept.all(): # Deleted or replaced while clustering
+                sums -= _groupSums(labels[~kept], matrix[positions[~kept]], k)
+                counts -= np.bincount(labels[~kept], minlength=k)
+            addedLabels = np.array([], dtype=np.int64)
+            if added:
+                addedVectors = self._readRows(collection, matrix.shape[1], added)
+                addedLabels = (addedVectors @ centroids.T).argmax(axis=1)
+                sums += _groupSums(addedLabels, addedVectors, k)
+                counts += np.bincount(addedLabels, minlength=k)
+
+            conn.execute("DELETE FROM topics WHERE collection=?", (collection,))
+            conn.executemany("INSERT INTO topics VALUES (?,?,?,?,?)",
+                             [(collection, topic, int(counts[topic]), (sums[topic] / max(counts[topic], 1)).astype(np.float32).tobytes(), exemplars.get(topic))
+                              for topic in range(k)])
+            conn.executemany("UPDATE paper_vectors SET topic=? WHERE collection=? AND row=?",
+                             [(int(label), collection, int(row)) for label, row in zip(labels[kept], positions[kept])] +
+                             [(int(label), collection, row) for label, row in zip(addedLabels, added)])
+            conn.execute("UPDATE vector_indexes SET clusteredVersion=version, clusteredPapers=? WHERE collection=?", (len(current), collection))
+        return k
+
+    def needsClustering(self, collection: str) -> bool:
+        ''' Checks whether an index that was never clustered has enough papers to be, or whether its papers changed by
+        more than TOPIC_RECLUSTER_GROWTH since it was last clustered '''
+        with self.pool.connection() as conn:
+            index = conn.execute("SELECT version, clusteredVersion, clusteredPapers FROM vector_indexes WHERE collection=?", (collection,)).fetchone()
+            if index is None or index["version"] == index["clusteredVersion"]:
+                return False
+            if index["clusteredPapers"]:
+                return index["version"] - index["clusteredVersion"] > TOPIC_RECLUSTER_GROWTH * index["clusteredPapers"]
+            return conn.execute("SELECT COUNT(*) FROM paper_vectors WHERE collection=? AND paperId IS NOT NULL", (collection,)).fetchone()[0] >= TOPIC_MIN_PAPERS
+
+    def getTopic(self, collection: str, paperId: str) -> dict | None:
+        ''' Gets the topic of a paper with its number of papers and the paper closest to its centre '''
+        with self.pool.connection() as conn:
+            row = conn.execute('''SELECT topics.topic, topics.size, topics.exemplarId FROM paper_vectors
+                                  JOIN topics ON topics.collection=paper_vectors.collection AND topics.topic=paper_vectors.topic
+                                  WHERE paper_vectors.collection=? AND paper_vectors.paperId=?''', (collection, paperId)).fetchone()
+        return dict(row) if row else None
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintain the paper vectors and topics of the active index")
+    parser.add_argument("--build", action="store_true", help="Compute the vectors of papers stored before they existed")
+    parser.add_argument("--cluster", nargs="?", type=int, const=0, metavar="TOPICS", help="Cluster the library into TOPICS topics (default: sqrt(papers / 2))")
+    parser.add_argument("--neighbours", type=int, metavar="K", help="Print the K most similar papers of every paper as tab separated values")
+    args = parser.parse_args()
+
+    from database import initDatabases, storage
+    initDatabases()
+    collection = storage.activeIndex()[1]
+    if args.build:
+        print(f"Computed the vectors of {storage.fillPaperVectors()} paper(s)", file=sys.stderr)
+    if args.cluster is not None:
+        start = time.time()
+        topics = storage.vectors.cluster(collection, args.cluster or None)
+        storage.repository.bumpGeneration() # The topics shown in the app are cached per generation
+        print(f"Clustered the library into {topics} topics in {time.time() - start:.1f}s", file=sys.stderr)
+    if args.neighbours:
+        for paperId, neighbours in storage.vectors.allPairs(collection, args.neighbours):
+            for rank, (neighbourId, similarity) in enumerate(neighbours, 1):
+                print(f"{paperId}\t{rank}\t{neighbourId}\t{similarity:.4f}")
+
+if __name__ == "__main__":
+    main()
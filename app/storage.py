@@ -0,0 +1,620 @@
+''' Storage coordinator that owns both stores of the library, the paper metadata and chunk texts in SQLite and the
+chunk embeddings in ChromaDB. Every write that touches both stores is recorded in an intent log first, so a process
+that dies between the two writes leaves an intent behind that the next startup repairs. The finished intents double
+as a change log, which lets the consistency checker only look at the papers changed since it last ran.
+
+Every embedding model has its own collection and search uses the active one. Switching models rebuilds the index in
+the background from the chunk texts kept in SQLite (no PDF is parsed and no metadata is generated again) and search
+moves over to the new index in one step once it is complete. Every index also keeps a vector per paper (see
+similarity.py) that is written and deleted together with its chunk vectors:
+
+    python app/storage.py --check                       # Check the papers changed since the last check, fix what can be fixed
+    python app/storage.py --check --full                # Check the whole library
+    python app/storage.py --reembed                     # Re-embed every chunk with the active model (resumes if interrupted)
+    python app/storage.py --reembed mxbai-embed-large   # Rebuild the index with another model and switch to it
+
+ChromaDB is only safe to write to from a single process, the store lane of worker.py. The app never writes to it, it
+queues removals as jobs and rebuilds in the intent log for the store lane to run and leaves repairs to the workers.
+Stop the workers before checking or re-embedding from the command line
+'''
+import argparse
+import json
+import os
+import re
+import threading
+import time
+from typing import TYPE_CHECKING
+
+from repository import PaperRepository
+from metrics import span
+from config import CHROMA_DIR, OLLAMA_HOST, DEFAULT_EMBED_MODEL, STORAGE_BATCH_SIZE
+
+COLLECTION = "papers" # Collection of DEFAULT_EMBED_MODEL, other models get papers_<model>
+CHROMA_MAX_BATCH = 5000 # Chroma caps the number of records in a single add/delete
+REBUILDING = "('queued', 'pending', 'interrupted')" # Statuses of the rebuilds that have not finished yet
+STORAGE_LOG = '''CREATE TABLE IF NOT EXISTS {table}
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  op TEXT,
+                  paperIds TEXT,
+                  cursor TEXT,
+                  pid INTEGER,
+                  status TEXT,
+                  createdAt REAL,
+                  model TEXT,
+                  target TEXT)''' # AUTOINCREMENT so the IDs of pruned rows are never handed out again below the check watermark
+
+if TYPE_CHECKING: # Only imported for the type hints, chromadb and langchain are imported when first used
+    from langchain_core.documents import Document
+
+def collectionName(model: str) -> str:
+    ''' Gets the name of the collection holding the vectors of an embedding model, the default model keeps the
+    original "papers" collection so existing libraries need no migration '''
+    if model == DEFAULT_EMBED_MODEL:
+        return COLLECTION
+    return f"{COLLECTION}_{re.sub(r'[^a-zA-Z0-9]+', '_', model).strip('_')}"[:55].rstrip("_") # Chroma allows at most 63 characters
+
+def _processAlive(pid: int) -> bool:
+    ''' Checks whether a process is still running, so the intents of live processes are never repaired from under them '''
+    try:
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError: # Running, but owned by another user
+        return True
+
+def _batches(items: list, size: int):
+    ''' Splits a list into consecutive batches of at most size items '''
+    for start in range(0, len(items), size):
+        yield items[start:start+size]
+
+class Storage:
+    ''' Coordinates the writes to SQLite and ChromaDB so the two stores stay in step
+
+    Args:
+        repository: PaperRepository - The SQLite side, its database also holds the intent log
+        path: str - Directory of the ChromaDB database '''
+    def __init__(self, repository: PaperRepository, path: str = CHROMA_DIR):
+        self.repository = repository
+        self.pool = repository.pool
+        self.path = path
+        self._client, self._pid, self._generation, self.embeddingFunction = None, None, None, None
+        self._lock = threading.Lock() # Streamlit sessions share the client from several threads
+        self._collections, self._epoch = {}, None
+        self._vectors = None
+        self._inFlight = set() # Intents of this process that are still running
+
+    def initStorage(self, repair: bool = True):
+        ''' Creates the intent log and repairs the writes that a crashed process left half done, unless this process
+        does not write to ChromaDB (repair off) '''
+        with self.pool.transaction() as conn:
+            conn.execute(STORAGE_LOG.format(table="storage_log"))
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(storage_log)")]
+            for column in ("model", "target"): # Rebuilds keep the model they embed with and the collection they fill
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE storage_log ADD COLUMN {column} TEXT")
+            if "AUTOINCREMENT" not in conn.execute("SELECT sql FROM sqlite_master WHERE name='storage_log'").fetchone()[0]:
+                self._migrateLog(conn)
+            conn.execute("CREATE INDEX IF NOT EXISTS storage_log_status ON storage_log (status, id)")
+        if repair:
+            self.recover()
+
+    def _migrateLog(self, conn):
+        ''' Recreates an intent log made before its IDs were AUTOINCREMENT. Those reused the IDs of pruned rows, which
+        fall at or below the check watermark so the incremental check skipped them. Every row still in the log is
+        newer than the last check (checked rows are pruned), so the watermark is lowered to take them in again '''
+        conn.execute(STORAGE_LOG.format(table="storage_log_new"))
+        conn.execute('''INSERT INTO storage_log_new (id, op, paperIds, cursor, pid, status, createdAt, model, target)
+                        SELECT id, op, paperIds, cursor, pid, status, createdAt, model, target FROM storage_log''')
+        conn.execute("DROP TABLE storage_log")
+        conn.execute("ALTER TABLE storage_log_new RENAME TO storage_log")
+
+        watermark = int((conn.execute("SELECT value FROM settings WHERE key='checkWatermark'").fetchone() or ["0"])[0])
+        oldest = conn.execute("SELECT MIN(id) FROM storage_log").fetchone()[0]
+        if oldest is not None and oldest <= watermark:
+            conn.execute("INSERT OR REPLACE INTO settings VALUES ('checkWatermark', ?)", (str(oldest - 1),))
+        if conn.execute("UPDATE sqlite_sequence SET seq=MAX(seq, ?) WHERE name='storage_log'", (watermark,)).rowcount == 0:
+            conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('storage_log', ?)", (watermark,)) # New IDs start above every checked one
+
+    @property
+    def client(self):
+        ''' Gets the ChromaDB client, opened on first use (so importing the module stays cheap) and again in forked
+        worker processes. The persistent client searches the index it loaded into memory and never sees the vectors
+        another process (the store worker) writes after that, so it is also opened again whenever the library
+        generation moved on since it was opened, unless this process made the change '''
+        generation = self.repository.getGeneration()
+        if self._client is not None and self._pid == os.getpid() and generation == self._generation:
+            return self._client
+        with self._lock:
+            if self._client is None or self._pid != os.getpid() or generation != self._generation:
+                import chromadb
+                import chromadb.utils.embedding_functions.ollama_embedding_function as ollama_ef
+
+                if self._client is not None and self._pid == os.getpid(): # The client of a parent process is left to it
+                    self._client.close()
+                self.embeddingFunction = ollama_ef.OllamaEmbeddingFunction( # Only kept so the existing collection opens with the same settings
+                    url=f"{OLLAMA_HOST}/api/embeddings",
+                    model_name=DEFAULT_EMBED_MODEL,
+                )
+                self._client, self._pid, self._generation, self._collections = chromadb.PersistentClient(self.path), os.getpid(), generation, {}
+            return self._client
+
+    @property
+    def vectors(self):
+        ''' Gets the paper vectors of the indexes, numpy is only imported once they are first used '''
+        if self._vectors is None:
+            from similarity import PaperVectors
+            self._vectors = PaperVectors(self.pool)
+        return self._vectors
+
+    def getCollection(self, name: str):
+        ''' Gets a ChromaDB collection by name. Handles are reopened whenever a collection was replaced (by a reset or a
+        rebuild, possibly in another process), so a handle to a deleted collection is never used '''
+        client = self.client
+        epoch = self.repository.getSetting("collectionEpoch", "0")
+        if epoch != self._epoch:
+            self._collections, self._epoch = {}, epoch
+        if name not in self._collections:
+            self._collections[name] = client.get_or_create_collection(name, embedding_function=self.embeddingFunction)
+        return self._collections[name]
+
+    def activeIndex(self) -> tuple[str, str]:
+        ''' Gets the embedding model search uses and the name of the collection holding its vectors, both are read
+        together so a search never pairs a query embedding with the vectors of another model '''
+        with self.pool.connection() as conn:
+            settings = dict(conn.execute("SELECT key, value FROM settings WHERE key IN ('activeEmbedModel', 'activeCollection')").fetchall())
+        return settings.get("activeEmbedModel", DEFAULT_EMBED_MODEL), settings.get("activeCollection", COLLECTION)
+
+    @property
+    def activeModel(self) -> str:
+        ''' Gets the embedding model of the index search uses, new papers should be embedded with it '''
+        return self.activeIndex()[0]
+
+    @property
+    def collection(self):
+        ''' Gets the collection of the index search uses '''
+        return self.getCollection(self.activeIndex()[1])
+
+    def _replacedCollection(self):
+        ''' Marks the collections as replaced so every process reopens them '''
+        with self.pool.transaction() as conn:
+            conn.execute("INSERT INTO settings VALUES ('collectionEpoch', '1') ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1")
+        self._collections = {}
+
+    def _bumpGeneration(self):
+        ''' Moves the library generation on after a change made by this process, which its client has already seen '''
+        generation = self.repository.bumpGeneration()
+        if self._generation is not None and self._pid == os.getpid():
+            self._generation = generation
+
+    def _collectionNames(self) -> list[str]:
+        ''' Gets the names of every collection of the library '''
+        names = [getattr(collection, "name", collection) for collection in self.client.list_collections()] # Names only in newer Chroma versions
+        return [name for name in names if name == COLLECTION or name.startswith(f"{COLLECTION}_")]
+
+    def _dropCollection(self, name: str):
+        ''' Deletes a collection if it exists '''
+        if name in self._collectionNames():
+            self.client.delete_collection(name)
+            self._replacedCollection()
+        self.vectors.drop(name)
+
+    def _writeTargets(self) -> list[tuple[str, str]]:
+        ''' Gets the (collection, model) of every index that writes go to, the active one and every one being rebuilt '''
+        model, name = self.activeIndex()
+        with self.pool.connection() as conn:
+            rebuilds = conn.execute(f"SELECT target, model FROM storage_log WHERE op='reembed' AND status IN {REBUILDING}").fetchall()
+        return list(dict.fromkeys([(name, model), *[(row["target"], row["model"]) for row in rebuilds]]))
+
+    # Intent log
+
+    def _begin(self, op: str, paperIds: list[str] = None, cursor: str = None) -> int:
+        ''' Records the intent to change both stores before anything is written, returns its ID '''
+        with self.pool.transaction() as conn:
+            intentId = conn.execute("INSERT INTO storage_log (op, paperIds, cursor, pid, status, createdAt) VALUES (?,?,?,?,'pending',?)",
+                                    (op, json.dumps(paperIds or []), cursor, os.getpid(), time.time())).lastrowid
+        self._inFlight.add(intentId)
+        return intentId
+
+    def _advance(self, intentId: int, cursor: str):
+        ''' Saves how far a long running intent got, so it can be resumed from there. Raises if it was cancelled '''
+        with self.pool.transaction() as conn:
+            if conn.execute("UPDATE storage_log SET cursor=? WHERE id=? AND status='pending'", (cursor, intentId)).rowcount == 0:
+                raise Exception(f"Intent #{intentId} was cancelled")
+
+    def _finish(self, intentId: int):
+        ''' Marks an intent as applied to both stores, it stays in the log as a change for the consistency checker '''
+        with self.pool.transaction() as conn:
+            conn.execute("UPDATE storage_log SET status='done' WHERE id=? AND status='pending'", (intentId,))
+        self._inFlight.discard(intentId)
+        self._bumpGeneration() # Only after both stores are written, so no cached search result can miss the change
+
+    def _repair(self, intent: dict):
+        ''' Brings both stores to a consistent state after an intent was interrupted. Deletes and resets are simply
+        applied again. A store is rolled back to the previous version of the paper (if there was one) unless its rows
+        were already swapped in, then it is rolled forward to the new version '''
+        paperIds = json.loads(intent["paperIds"])
+        if intent["op"] == "store":
+            swapped = intent["cursor"] == "swapped"
+            for name, _ in self._writeTargets():
+                collection = self.getCollection(name)
+                self._dropVersions(collection, paperIds[0], intent["id"], keep=swapped)
+                if swapped: # Its paper vector may not have been written yet
+                    self._paperVectorsFromIndex(collection, paperIds)
+        elif intent["op"] == "delete":
+            self._deleteEverywhere(paperIds)
+        elif intent["op"] == "reset":
+            self._resetEverywhere()
+        self._finish(intent["id"])
+
+    def recover(self) -> int:
+        ''' Repairs the pending intents of processes that are no longer running, returns how many were repaired. An
+        interrupted rebuild leaves the active index untouched, so it is only finished here if it got as far as the
+        switch, otherwise it is handed back to the store worker to resume instead of holding up the startup '''
+        with self.pool.connection() as conn:
+            intents = [dict(row) for row in conn.execute("SELECT * FROM storage_log WHERE status='pending' ORDER BY id")]
+        repaired = 0
+        for intent in intents:
+            if intent["id"] in self._inFlight or (intent["pid"] != os.getpid() and _processAlive(intent["pid"])):
+                continue
+            print(f"Repairing interrupted {intent['op']} #{intent['id']}")
+            if intent["op"] != "reembed":
+                self._repair(intent)
+            elif intent["cursor"] == "switch":
+                self._switch(intent)
+                self._finish(intent["id"])
+            else:
+                with self.pool.transaction() as conn:
+                    conn.execute("UPDATE storage_log SET status='interrupted' WHERE id=?", (intent["id"],))
+            repaired += 1
+        return repaired
+
+    def _run(self, op: str, paperIds: list[str], write):
+        ''' Runs a write to both stores under an intent, if the write fails the stores are repaired before raising '''
+        intentId = self._begin(op, paperIds)
+        try:
+            write(intentId)
+        except Exception as e:
+            try:
+                with self.pool.connection() as conn:
+                    self._repair(dict(conn.execute("SELECT * FROM storage_log WHERE id=?", (intentId,)).fetchone()))
+            except Exception as repairError: # Left pending, the next startup tries again
+                print(f"Failed to repair {op} #{intentId}: {str(repairError)}")
+            raise Exception(f"Failed to {op} {len(paperIds)} paper(s): {str(e)}")
+        self._finish(intentId)
+
+    # Writes
+
+    def _embedTexts(self, texts: list[str], model: str) -> list[list[float]]:
+        ''' Embeds chunk texts with a model through the batched (and cached) embedding client '''
+        from embeddings import getEmbeddingClient
+
+        with span("embed", model=model, chunks=len(texts)):
+            return getEmbeddingClient(model).embed(texts)
+
+    def _addVectors(self, collection, paperId: str, texts: list[str], embeddings: list[list[float]], metadatas: list[dict], version: int = None):
+        ''' Replaces the vectors of a paper in a collection and its paper vector. With a version (the ID of a store
+        intent) the vectors are added next to the ones of the previous version instead, under IDs and metadata of
+        their own, and are swapped in later by dropping the other versions '''
+        if version is None:
+            collection.delete(where={"paperId": paperId}) # Drop the chunks of a previous version of this paper so none are left behind
+        else:
+            metadatas = [{**chunkMetadata, "version": version} for chunkMetadata in metadatas]
+        prefix = paperId if version is None else f"{paperId}_{version}"
+        for start in range(0, len(texts), CHROMA_MAX_BATCH):
+            collection.add(
+                ids=[f"{prefix}_{i}" for i in range(start, min(start + CHROMA_MAX_BATCH, len(texts)))],
+                documents=texts[start:start+CHROMA_MAX_BATCH],
+                embeddings=embeddings[start:start+CHROMA_MAX_BATCH], # Precomputed so Chroma never calls the one text per request /api/embeddings endpoint
+                metadatas=metadatas[start:start+CHROMA_MAX_BATCH],
+            )
+        if version is None:
+            self.vectors.put(collection.name, paperId, embeddings)
+
+    def _dropVersions(self, collection, paperId: str, version: int, keep: bool):
+        ''' Deletes the vectors of a paper that are not of a version (keep) or only the ones of that version '''
+        chunks = collection.get(where={"paperId": paperId}, include=["metadatas"])
+        stale = [chunkId for chunkId, chunkMetadata in zip(chunks["ids"], chunks["metadatas"]) if (chunkMetadata.get("version") == version) != keep]
+        for batch in _batches(stale, CHROMA_MAX_BATCH):
+            collection.delete(ids=batch)
+
+    def storePaper(self, paperId: str, metadata: dict, documents: list["Document"], embeddings: list[list[float]], arxivId: str = None,
+                   model: str = None):
+        ''' Stores the metadata and chunk texts of a paper in SQLite and its embedded chunks in ChromaDB. The embeddings
+        are written to the index of the model they were made with (the active one by default), while an index is
+        being rebuilt the chunks are also embedded with its model and written to it.
+        A previous version of the paper stays whole until the new one is: the new vectors are added next to the old
+        ones, the rows are replaced in the transaction that marks the intent as swapped and only then are the old
+        vectors dropped, so a store that fails leaves the previous version in place '''
+        def write(intentId: int):
+            # ChromaDB to store the embeddings of the paper text
+            texts, metadatas = [doc.page_content for doc in documents], [{**doc.metadata, "paperId": paperId} for doc in documents]
+            targets = {}
+            with span("store.chroma", paperId, chunks=len(documents)):
+                for name, targetModel in self._writeTargets():
+                    targets[name] = embeddings if targetModel == (model or self.activeModel) else self._embedTexts(texts, targetModel)
+                    self._addVectors(self.getCollection(name), paperId, texts, targets[name], metadatas, version=intentId)
+
+            # SQLite to store the metadata of paper (and the chunk texts for keyword search)
+            with span("store.sqlite", paperId, chunks=len(documents)):
+                with self.pool.transaction() as conn:
+                    self.repository.writePapers(conn, [(paperId, metadata, arxivId)], {paperId: [(doc.metadata.get("page", 0), doc.page_content) for doc in documents]})
+                    conn.execute("UPDATE storage_log SET cursor='swapped' WHERE id=?", (intentId,))
+
+            for name, vectors in targets.items():
+                self._dropVersions(self.getCollection(name), paperId, intentId, keep=True)
+                self.vectors.put(name, paperId, vectors)
+        self._run("store", [paperId], write)
+
+    def _deleteEverywhere(self, paperIds: list[str]):
+        ''' Deletes papers from both stores (and every index being rebuilt) in batches, deleting papers that are
+        already gone is a no-op '''
+        for batch in _batches(paperIds, min(STORAGE_BATCH_SIZE, CHROMA_MAX_BATCH)):
+            self.repository.deletePapers(batch)
+            for name, _ in self._writeTargets():
+                self.getCollection(name).delete(where={"paperId": {"$in": batch}})
+                self.vectors.delete(name, batch)
+
+    def deletePapers(self, paperIds: list[str]):
+        ''' Deletes several papers from both stores '''
+        if paperIds:
+            self._run("delete", paperIds, lambda intentId: self._deleteEverywhere(paperIds))
+
+    def deleteWhere(self, filters: dict[str, list[str]]) -> int:
+        ''' Deletes every paper matching the facet filters (e.g. {"datasets": ["MNIST"]}), returns how many were deleted '''
+        paperIds = self.repository.filterPapers(filters)
+        self.deletePapers(paperIds)
+        return len(paperIds)
+
+    def _resetEverywhere(self):
+        ''' Empties both stores, every collection is dropped as a whole instead of deleting its vectors one by one. An
+        empty library needs no rebuild, so a model switch still in progress takes effect straight away '''
+        self.repository.deleteAllPapers()
+        with self.pool.transaction() as conn:
+            latest = conn.execute(f"SELECT model, target FROM storage_log WHERE op='reembed' AND status IN {REBUILDING} ORDER BY id DESC LIMIT 1").fetchone()
+            if latest:
+                conn.execute("INSERT OR REPLACE INTO settings VALUES ('activeEmbedModel', ?), ('activeCollection', ?)", (latest["model"], latest["target"]))
+            conn.execute(f"UPDATE storage_log SET status='cancelled' WHERE op='reembed' AND status IN {REBUILDING}")
+        for name in self._collectionNames():
+            self.client.delete_collection(name)
+        self.vectors.dropAll()
+        self._replacedCollection()
+
+    def reset(self):
+        ''' Removes every paper from both stores '''
+        self._run("reset", [], lambda intentId: self._resetEverywhere())
+
+    # Index rebuilds
+
+    def _embedChunks(self, collection, paperIds: list[str], model: str):
+        ''' Embeds the chunk texts of papers from the keyword index again and replaces their vectors in a collection '''
+        if not paperIds:
+            return
+        chunks = self.repository.getChunks(paperIds)
+        vectors = iter(self._embedTexts([text for paperChunks in chunks.values() for _, _, text in paperChunks], model))
+        collection.delete(where={"paperId": {"$in": paperIds}})
+        for paperId, paperChunks in chunks.items():
+            self._addVectors(collection, paperId, [text for _, _, text in paperChunks], [next(vectors) for _ in paperChunks],
+                             [{"paperId": paperId, "page": page} for _, page, _ in paperChunks])
+
+    def requestRebuild(self, model: str) -> int:
+        ''' Queues a rebuild of the index with an embedding model, returns its ID. The rebuild fills a collection that
+        search does not use (papers_<model>, or papers_<model>_rebuild when re-embedding with the active model) and
+        search is switched over to it when it is complete. A rebuild already queued for the model is reused. Only the
+        log is written, so it can be called from any process '''
+        with self.pool.connection() as conn:
+            queued = conn.execute(f"SELECT id FROM storage_log WHERE op='reembed' AND model=? AND status IN {REBUILDING}", (model,)).fetchone()
+        if queued:
+            return queued["id"]
+
+        target = collectionName(model)
+        if target == self.activeIndex()[1]:
+            target = f"{target[:55]}_rebuild"
+        with self.pool.transaction() as conn:
+            return conn.execute("INSERT INTO storage_log (op, paperIds, model, target, status, createdAt) VALUES ('reembed', '[]', ?, ?, 'queued', ?)",
+                                (model, target, time.time())).lastrowid
+
+    def claimRebuild(self, intentId: int = None) -> dict | None:
+        ''' Claims the oldest queued or interrupted rebuild (or the given one) for this process. A rebuild that has not
+        started yet first drops what is left in its collection '''
+        with self.pool.transaction() as conn:
+            row = conn.execute("SELECT * FROM storage_log WHERE op='reembed' AND status IN ('queued', 'interrupted') AND id=COALESCE(?, id) ORDER BY id LIMIT 1",
+                               (intentId,)).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE storage_log SET status='pending', pid=? WHERE id=?", (os.getpid(), row["id"]))
+        self._inFlight.add(row["id"])
+        if row["status"] == "queued":
+            try:
+                self._dropCollection(row["target"]) # Left over from an earlier rebuild, or from when the model was last used, so out of date
+            except Exception:
+                self._inFlight.discard(row["id"])
+                with self.pool.transaction() as conn: # Handed back to start over
+                    conn.execute("UPDATE storage_log SET status='queued' WHERE id=? AND status='pending'", (row["id"],))
+                raise
+        return dict(row)
+
+    def _switch(self, intent: dict):
+        ''' Points search at the rebuilt index in one transaction and drops the index it replaces '''
+        with self.pool.transaction() as conn:
+            replaced = dict(conn.execute("SELECT key, value FROM settings WHERE key='activeCollection'").fetchall()).get("activeCollection", COLLECTION)
+            conn.execute("INSERT OR REPLACE INTO settings VALUES ('activeEmbedModel', ?), ('activeCollection', ?)", (intent["model"], intent["target"]))
+        if replaced != intent["target"]:
+            self._dropCollection(replaced) # No longer written to, so it would only go out of date
+        self._replacedCollection()
+
+    def rebuildBatch(self, intent: dict) -> bool:
+        ''' Re-embeds the next batch of papers into the rebuild's collection and moves its cursor past them, a batch
+        at a time so memory stays bounded whatever the size of the library and other writes can run in between. Once
+        every paper is done search is switched over to it. Returns whether the rebuild is finished. Papers stored or
+        deleted meanwhile are written to both indexes, and an interrupted rebuild resumes after the last finished batch '''
+        try:
+            if intent["cursor"] != "switch":
+                paperIds = self.repository.listPaperIds(intent["cursor"] or "", STORAGE_BATCH_SIZE)
+                self._embedChunks(self.getCollection(intent["target"]), paperIds, intent["model"])
+                intent["cursor"] = paperIds[-1] if paperIds else "switch"
+                self._advance(intent["id"], intent["cursor"])
+                if paperIds:
+                    return False
+            self._switch(intent)
+        except Exception:
+            self._inFlight.discard(intent["id"])
+            with self.pool.transaction() as conn: # Handed back to be resumed, unless it was cancelled
+                conn.execute("UPDATE storage_log SET status='interrupted' WHERE id=? AND status='pending'", (intent["id"],))
+            raise
+        self._finish(intent["id"])
+        return True
+
+    def runRebuild(self, intent: dict):
+        ''' Runs a rebuild to the end in this process '''
+        while not self.rebuildBatch(intent):
+            pass
+
+    def getRebuilds(self) -> list[dict]:
+        ''' Gets the unfinished rebuilds with how many papers they have embedded so far '''
+        with self.pool.connection() as conn:
+            rows = conn.execute(f"SELECT id, model, target, cursor, status FROM storage_log WHERE op='reembed' AND status IN {REBUILDING} ORDER BY id").fetchall()
+            total = conn.execute("SELECT COUNT(*) FROM papers").fetchone()[0]
+            return [{**dict(row), "total": total,
+                     "done": total if row["cursor"] == "switch" else conn.execute("SELECT COUNT(*) FROM papers WHERE id<=?", (row["cursor"] or "",)).fetchone()[0]}
+                    for row in rows]
+
+    def reembedAll(self, model: str = None):
+        ''' Rebuilds the index with a model (by default re-embeds with the active one, e.g. after it was updated) in
+        this process. Searches keep using the current index until every paper is done '''
+        intentId = self.requestRebuild(model or self.activeModel)
+        intent = self.claimRebuild(intentId)
+        if intent is None:
+            raise Exception(f"The rebuild #{intentId} is already running in another process")
+        self.runRebuild(intent)
+
+    # Consistency checks
+
+    def _vectorCounts(self, collection, paperIds: list[str]) -> dict[str, int]:
+        ''' Counts the vectors of several papers in a collection '''
+        counts = {}
+        if not paperIds:
+            return counts
+        for chunkMetadata in collection.get(where={"paperId": {"$in": paperIds}}, include=["metadatas"])["metadatas"]:
+            counts[chunkMetadata["paperId"]] = counts.get(chunkMetadata["paperId"], 0) + 1
+        return counts
+
+    def _paperVectorsFromIndex(self, collection, paperIds: list[str]) -> int:
+        ''' Computes the paper vectors of papers from their chunk vectors already in a collection (nothing is embedded),
+        returns how many papers had chunk vectors '''
+        if not paperIds:
+            return 0
+        chunks = collection.get(where={"paperId": {"$in": paperIds}}, include=["embeddings", "metadatas"])
+        embeddings = {}
+        for embedding, chunkMetadata in zip(chunks["embeddings"], chunks["metadatas"]):
+            embeddings.setdefault(chunkMetadata["paperId"], []).append(embedding)
+        for paperId, paperEmbeddings in embeddings.items():
+            self.vectors.put(collection.name, paperId, paperEmbeddings)
+        return len(embeddings)
+
+    def fillPaperVectors(self) -> int:
+        ''' Computes the paper vectors missing from the active index (of papers stored before they existed) from their
+        chunk vectors, returns how many were computed '''
+        name, computed, after = self.activeIndex()[1], 0, ""
+        collection = self.getCollection(name)
+        while paperIds := self.repository.listPaperIds(after, STORAGE_BATCH_SIZE):
+            stored = self.vectors.stored(name, paperIds)
+            computed += self._paperVectorsFromIndex(collection, [paperId for paperId in paperIds if paperId not in stored])
+            after = paperIds[-1]
+        if computed:
+            self._bumpGeneration()
+        return computed
+
+    def maintainPaperVectors(self):
+        ''' Fills in the paper vectors of the active index once (libraries stored before they existed) and clusters its
+        papers into topics again when they changed enough since the last time '''
+        name = self.activeIndex()[1]
+        if self.repository.getSetting("paperVectorsFilled") != name:
+            self.fillPaperVectors()
+            self.repository.setSetting("paperVectorsFilled", name)
+        if self.vectors.needsClustering(name):
+            self.vectors.cluster(name)
+            self._bumpGeneration() # The topics shown in the app are cached per generation
+
+    def _checkPapers(self, paperIds: list[str], report: dict, repair: bool):
+        ''' Compares the chunk counts of papers in SQLite and the active index, vectors without a paper are deleted and
+        papers with missing or extra vectors are embedded again from their chunk texts. Papers whose chunk vectors are
+        complete but that have no paper vector get one computed from them '''
+        model, name = self.activeIndex()
+        collection = self.getCollection(name)
+        for batch in _batches(paperIds, STORAGE_BATCH_SIZE):
+            rows, vectors, paperVectors = self.repository.countChunks(batch), self._vectorCounts(collection, batch), self.vectors.stored(name, batch)
+            orphanVectors = [paperId for paperId in dict.fromkeys([*vectors, *paperVectors]) if paperId not in rows]
+            orphanRows = [paperId for paperId, chunks in rows.items() if vectors.get(paperId, 0) != chunks]
+            missingPaperVectors = [paperId for paperId, chunks in rows.items() if chunks and vectors.get(paperId) == chunks and paperId not in paperVectors]
+            report["checked"] += len(batch)
+            report["orphanVectors"] += orphanVectors
+            report["orphanRows"] += orphanRows
+            report["missingPaperVectors"] += missingPaperVectors
+            if repair and orphanVectors:
+                collection.delete(where={"paperId": {"$in": orphanVectors}})
+                self.vectors.delete(name, orphanVectors)
+            if repair and orphanRows:
+                self._embedChunks(collection, orphanRows, model)
+            if repair and missingPaperVectors:
+                self._paperVectorsFromIndex(collection, missingPaperVectors)
+
+    def check(self, full: bool = False, repair: bool = True) -> dict:
+        ''' Finds papers whose vectors and rows disagree (vectors left after the paper was deleted, or papers whose
+        vectors are missing) and fixes them unless repair is off. Only the papers changed since the last check are
+        looked at, up to the watermark of the intent log, unless a full check of the library is asked for '''
+        report = {"checked": 0, "orphanVectors": [], "orphanRows": [], "missingPaperVectors": []}
+        watermark = int(self.repository.getSetting("checkWatermark", "0"))
+        with self.pool.connection() as conn:
+            oldestPending = conn.execute("SELECT MIN(id) FROM storage_log WHERE status='pending' AND op!='reembed'").fetchone()[0]
+            latest = conn.execute("SELECT COALESCE(MAX(id), 0) FROM storage_log").fetchone()[0]
+        end = oldestPending - 1 if oldestPending else latest # Writes still in flight are checked once they are done
+
+        if full:
+            seen, offset = set(), 0
+            while True: # Every paper with vectors, which also finds vectors whose paper is gone
+                batch = self.collection.get(include=["metadatas"], limit=CHROMA_MAX_BATCH, offset=offset)["metadatas"]
+                if not batch:
+                    break
+                seen.update(chunkMetadata["paperId"] for chunkMetadata in batch)
+                offset += len(batch)
+            after = ""
+            while paperIds := self.repository.listPaperIds(after, CHROMA_MAX_BATCH):
+                seen.update(paperIds)
+                after = paperIds[-1]
+            seen.update(self.vectors.paperIds(self.activeIndex()[1]))
+            self._checkPapers(sorted(seen), report, repair)
+        else:
+            with self.pool.connection() as conn:
+                rows = conn.execute("SELECT paperIds FROM storage_log WHERE id>? AND id<=? AND status='done'", (watermark, end)).fetchall()
+            self._checkPapers(list(dict.fromkeys(paperId for row in rows for paperId in json.loads(row["paperIds"]))), report, repair)
+
+        with self.pool.transaction() as conn:
+            conn.execute("INSERT OR REPLACE INTO settings VALUES ('checkWatermark', ?)", (str(end),))
+            conn.execute("DELETE FROM storage_log WHERE id<=? AND status NOT IN " + REBUILDING, (end,)) # Checked, so no longer needed
+        if repair and (report["orphanVectors"] or report["orphanRows"] or report["missingPaperVectors"]):
+            self._bumpGeneration()
+        return report
+
+def main():
+    parser = argparse.ArgumentParser(description="Check and maintain the consistency of the SQLite and ChromaDB stores")
+    parser.add_argument("--check", action="store_true", help="Check the papers changed since the last check")
+    parser.add_argument("--full", action="store_true", help="With --check, check every paper")
+    parser.add_argument("--dry-run", action="store_true", help="With --check, only report the problems")
+    parser.add_argument("--reembed", nargs="?", const="", metavar="MODEL", help="Rebuild the index with MODEL (default: the active model)")
+    args = parser.parse_args()
+
+    from database import initDatabases, storage
+    initDatabases()
+    if args.reembed is not None:
+        start = time.time()
+        storage.reembedAll(args.reembed or None)
+        print(f"Rebuilt the index with {storage.activeModel} in {time.time() - start:.1f}s")
+    if args.check or args.reembed is None:
+        report = storage.check(full=args.full, repair=not args.dry_run)
+        print(f"Checked {report['checked']} paper(s): {len(report['orphanVectors'])} with orphan vectors, "
+              f"{len(report['orphanRows'])} with missing vectors, {len(report['missingPaperVectors'])} without a paper vector"
+              f"{'' if args.dry_run else ' (repaired)'}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,298 @@
+''' Background ingest worker pool. Run it alongside the Streamlit app so queued papers (and arXiv harvests) are
+processed even after the browser tab is closed:
+
+    python app/worker.py --cpu-workers 2 --llm-workers 2 --metadata-concurrency 4
+'''
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import socket
+import time
+import traceback
+
+from jobQueue import (initJobQueue, claimJob, completeStep, failStep, finishJob, getArtifacts, setProgress,
+                      requeueStaleJobs, releaseWorkerJobs, STEP_LANES)
+from metrics import paperContext
+from harvester import initHarvester, runHarvestWorker, releaseWorkerHarvests, pdfPath
+from ingestCache import hashFile, getCached, putCached
+from config import (PAPERS_DIR, WORKER_POLL_INTERVAL, DEFAULT_EMBED_MODEL, METADATA_MAX_CTX, OLLAMA_CONCURRENCY, HARVEST_CONCURRENCY,
+                    METADATA_STREAM)
+
+class DuplicatePaper(Exception):
+    ''' Raised by a step when the paper is already stored, which ends the job without doing any more work '''
+
+def downloadStep(job: dict, artifacts: dict) -> dict:
+    ''' Downloads an arXiv paper and keeps the real title, authors and link to overwrite the generated ones '''
+    import arxiv
+    from database import findExistingPaper, arxivBaseId
+
+    if findExistingPaper(arxivId=arxivBaseId(job["source"])):
+        raise DuplicatePaper(f"arXiv paper {job['source']} is already in the database")
+
+    client = arxiv.Client()
+    paper = next(client.results(arxiv.Search(id_list=[job["source"]], max_results=1)))
+    os.makedirs(PAPERS_DIR, exist_ok=True)
+    path = pdfPath(job["source"])
+    if not os.path.exists(path): # Downloaded before, e.g. by a harvest
+        paper.download_pdf(PAPERS_DIR, os.path.basename(path))
+    return {
+        "path": path,
+        "overrides": {
+            "title": paper.title,
+            "authors": [a.name for a in paper.authors], # TODO: Need to find a way to make this consistent between scraped and uploaded papers
+            "link": "https://arxiv.org/abs/" + paper.get_short_id(),
+        }
+    }
+
+def _pdfPath(job: dict, artifacts: dict) -> str:
+    ''' Gets the path of the PDF a job is working on '''
+    return artifacts["download"]["path"] if "download" in artifacts else job["source"]
+
+def parseStep(job: dict, artifacts: dict) -> dict:
+    ''' Hashes the PDF and extracts the text of each page, this is the only time the PDF is parsed '''
+    from extractText import extractPages
+    from database import findExistingPaper
+
+    path = _pdfPath(job, artifacts)
+    paperHash = hashFile(path)
+    if findExistingPaper(paperId=paperHash):
+        raise DuplicatePaper(f"{job['label']} is already in the database")
+
+    pages = getCached(paperHash, "pages")
+    if pages is None:
+        with paperContext(paperHash):
+            pages = extractPages(path)
+        putCached(paperHash, "pages", pages)
+    return {"hash": paperHash, "pages": pages}
+
+def chunkStep(job: dict, artifacts: dict) -> list[dict]:
+    ''' Chunks the extracted pages into smaller parts for embedding '''
+    from extractText import chunkPages, CHUNK_SIZE, CHUNK_OVERLAP
+
+    paperHash, key = artifacts["parse"]["hash"], f"{CHUNK_SIZE}/{CHUNK_OVERLAP}"
+    chunks = getCached(paperHash, "chunks", key)
+    if chunks is None:
+        chunks = [{"page_content": doc.page_content, "metadata": doc.metadata} for doc in chunkPages(artifacts["parse"]["pages"], _pdfPath(job, artifacts))]
+        putCached(paperHash, "chunks", chunks, key)
+    return chunks
+
+def describePartial(partial: dict) -> str:
+    ''' Describes the metadata fields generated so far in a short line for the job status '''
+    parts = [f"'{partial['title']}'" if isinstance(partial.get("title"), str) else None,
+             f"summary {len(partial['summary'])} chars" if isinstance(partial.get("summary"), str) else None]
+    parts += [f"{len(value)} {name}" for name, value in partial.items() if isinstance(value, list)]
+    return ", ".join(part for part in parts if part)
+
+def partialProgress(jobId: str, interval: float = 1.0):
+    ''' Builds an onPartial callback that shows the streamed metadata in the job progress, at most once per interval '''
+    last = 0.0
+    def onPartial(window: int, partial: dict):
+        nonlocal last
+        if time.monotonic() - last >= interval:
+            last = time.monotonic()
+            setProgress(jobId, f"Generating metadata (part {window + 1}): {describePartial(partial)}")
+    return onPartial
+
+async def metadataStep(job: dict, artifacts: dict, client) -> dict:
+    ''' Generates the metadata of the paper with the selected LLM '''
+    from processPaper import generateMetadataAsync
+
+    paperHash, key = artifacts["parse"]["hash"], f"{job['options']['genModel']}/{METADATA_MAX_CTX}" # The windowing depends on the context size
+    metadata = getCached(paperHash, "metadata", key)
+    if metadata is None:
+        stats, pages = [], artifacts["parse"]["pages"]
+        metadata = await generateMetadataAsync("".join(pages), job["options"]["genModel"], pages, stats, client,
+                                               partialProgress(job["id"]) if METADATA_STREAM else None)
+        putCached(paperHash, "metadata", metadata, key)
+        setProgress(job["id"], f"Generated metadata from {len(stats)} request(s) in {sum(s['seconds'] for s in stats):.1f}s "
+                               f"({sum(s['promptTokens'] or 0 for s in stats)} prompt / {sum(s['evalTokens'] or 0 for s in stats)} generated tokens)")
+    metadata.update(artifacts.get("download", {}).get("overrides", {})) # Overwrite the generated fields with the real ones from arXiv
+    return metadata
+
+def embedStep(job: dict, artifacts: dict) -> dict:
+    ''' Embeds the chunks of the paper with the active embedding model, chunks that were embedded before are served
+    from the embedding cache '''
+    from embeddings import getEmbeddingClient
+    from database import getActiveEmbedModel
+
+    model = getActiveEmbedModel()
+    client = getEmbeddingClient(model)
+    embeddings = client.embed([chunk["page_content"] for chunk in artifacts["chunk"]])
+    setProgress(job["id"], f"Embedded {len(embeddings)} chunks with {model} ({client.stats['chunksPerSecond']:.1f} chunks/sec)")
+    return {"model": model, "embeddings": embeddings}
+
+def storeStep(job: dict, artifacts: dict) -> dict:
+    ''' Stores the metadata and the embedded chunks in the databases, keyed by the content hash of the PDF '''
+    from langchain_core.documents import Document
+    from database import storePaper, arxivBaseId
+
+    arxivId = arxivBaseId(job["source"]) if job["kind"] == "arxiv" else None
+    embedded = artifacts["embed"] if isinstance(artifacts["embed"], dict) else {"model": DEFAULT_EMBED_MODEL, "embeddings": artifacts["embed"]} # Jobs embedded before indexes were per model
+    storePaper(artifacts["metadata"], [Document(**chunk) for chunk in artifacts["chunk"]], embedded["embeddings"],
+               paperId=artifacts["parse"]["hash"], arxivId=arxivId, embedModel=embedded["model"])
+    if job["kind"] == "upload" and os.path.exists(job["source"]):
+        os.remove(job["source"]) # Remove the uploaded file now that it has been processed
+    return {"title": artifacts["metadata"].get("title", "")}
+
+def deleteStep(job: dict, artifacts: dict) -> dict:
+    ''' Removes papers from both databases '''
+    from database import storage
+
+    paperIds = json.loads(job["source"])
+    storage.deletePapers(paperIds)
+    return {"removed": len(paperIds)}
+
+def resetStep(job: dict, artifacts: dict) -> dict:
+    ''' Removes every paper from both databases '''
+    from database import storage
+
+    storage.reset()
+    return {}
+
+STEP_HANDLERS = {
+    "download": downloadStep,
+    "parse": parseStep,
+    "chunk": chunkStep,
+    "embed": embedStep,
+    "store": storeStep,
+    "delete": deleteStep,
+    "reset": resetStep,
+}
+
+def runStep(job: dict):
+    ''' Runs the step a job was claimed for and records its outcome '''
+    step = job["step"]
+    setProgress(job["id"], f"Running step: {step}")
+    try:
+        artifacts = getArtifacts(job["id"])
+        with paperContext(artifacts.get("parse", {}).get("hash")): # Spans of the steps after parsing belong to the paper's hash
+            artifact = STEP_HANDLERS[step](job, artifacts)
+        completeStep(job["id"], step, artifact)
+    except DuplicatePaper as e:
+        finishJob(job["id"], "skipped", str(e))
+        if job["kind"] == "upload" and os.path.exists(job["source"]):
+            os.remove(job["source"])
+    except Exception as e:
+        traceback.print_exc()
+        failStep(job["id"], f"{step} failed: {str(e)}")
+
+def runWorker(workerId: str, steps: list[str]):
+    ''' Worker loop that keeps claiming and running job steps from the given lane '''
+    while True:
+        job = claimJob(workerId, steps)
+        if job is None:
+            time.sleep(WORKER_POLL_INTERVAL)
+            continue
+        runStep(job)
+
+def runStoreWorker(workerId: str):
+    ''' Worker loop of the store lane, the only process that writes to ChromaDB. Stores and removals come first, a
+    queued index rebuild advances a batch at a time whenever none is waiting, and the paper vectors and topics of the
+    active index are kept up to date while there is nothing else to do '''
+    from database import storage
+
+    rebuild = None
+    while True:
+        job = claimJob(workerId, STEP_LANES["store"])
+        if job is not None:
+            runStep(job)
+            continue
+        try:
+            rebuild = rebuild or storage.claimRebuild()
+            if rebuild is not None:
+                if storage.rebuildBatch(rebuild):
+                    rebuild = None
+                continue
+            storage.maintainPaperVectors()
+        except Exception:
+            rebuild = None # Handed back as interrupted, so it is claimed again and resumes from its cursor
+            traceback.print_exc()
+        time.sleep(WORKER_POLL_INTERVAL)
+
+async def _runMetadataJob(job: dict, client):
+    ''' Runs the metadata step of a single job '''
+    setProgress(job["id"], "Running step: metadata")
+    try:
+        artifacts = getArtifacts(job["id"])
+        with paperContext(artifacts["parse"]["hash"]): # Every job runs in its own task, so the context stays with it
+            completeStep(job["id"], "metadata", await metadataStep(job, artifacts, client))
+    except Exception as e:
+        traceback.print_exc()
+        failStep(job["id"], f"metadata failed: {str(e)}")
+
+async def _metadataLoop(workerId: str, concurrency: int):
+    ''' Keeps the metadata steps of up to `concurrency` papers in flight at once, claiming a new one as soon as one finishes '''
+    from ollamaClient import AsyncOllama
+
+    client = AsyncOllama(concurrency=concurrency) # Shared so the limit also covers the windows of long papers
+    inFlight = set()
+    while True:
+        while len(inFlight) < concurrency and (job := claimJob(workerId, STEP_LANES["metadata"])) is not None:
+            inFlight.add(asyncio.create_task(_runMetadataJob(job, client)))
+
+        if inFlight:
+            _, inFlight = await asyncio.wait(inFlight, timeout=WORKER_POLL_INTERVAL, return_when=asyncio.FIRST_COMPLETED)
+        else:
+            await asyncio.sleep(WORKER_POLL_INTERVAL)
+
+def runMetadataWorker(workerId: str, concurrency: int):
+    ''' Worker that pipelines the LLM metadata requests of several papers over one async Ollama client '''
+    asyncio.run(_metadataLoop(workerId, concurrency))
+
+def main():
+    parser = argparse.ArgumentParser(description="Background worker pool for ingesting queued papers")
+    parser.add_argument("--cpu-workers", type=int, default=max(1, (os.cpu_count() or 2) // 2), help="Processes for PDF parsing and chunking")
+    parser.add_argument("--llm-workers", type=int, default=2, help="Processes for downloads and embedding")
+    parser.add_argument("--metadata-concurrency", type=int, default=OLLAMA_CONCURRENCY, help="Papers whose metadata is generated at once")
+    parser.add_argument("--harvest-concurrency", type=int, default=HARVEST_CONCURRENCY, help="arXiv PDF downloads in flight at once")
+    args = parser.parse_args()
+
+    from database import initDatabases
+
+    initJobQueue()
+    initHarvester()
+    initDatabases() # Also repairs the stores if a previous worker died in the middle of storing a paper
+    requeued = requeueStaleJobs()
+    if requeued:
+        print(f"Requeued {requeued} job(s) left running by a previous worker")
+
+    poolId = f"{socket.gethostname()}-{os.getpid()}"
+    lanes = [("cpu", args.cpu_workers), ("llm", args.llm_workers)]
+    processes = []
+    for lane, count in lanes:
+        for i in range(count):
+            workerId = f"{poolId}-{lane}-{i}"
+            process = multiprocessing.Process(target=runWorker, args=(workerId, STEP_LANES[lane]), name=workerId, daemon=True)
+            process.start()
+            processes.append(process)
+
+    workerId = f"{poolId}-store-0" # A single process, it is the only one that writes to ChromaDB (also for index rebuilds)
+    process = multiprocessing.Process(target=runStoreWorker, args=(workerId,), name=workerId, daemon=True)
+    process.start()
+    processes.append(process)
+
+    workerId = f"{poolId}-metadata-0"
+    process = multiprocessing.Process(target=runMetadataWorker, args=(workerId, args.metadata_concurrency), name=workerId, daemon=True)
+    process.start()
+    processes.append(process)
+
+    workerId = f"{poolId}-harvest-0" # Produces download artifacts for the queue, so it overlaps with the steps above
+    process = multiprocessing.Process(target=runHarvestWorker, args=(workerId, args.harvest_concurrency), name=workerId, daemon=True)
+    process.start()
+    processes.append(process)
+
+    print(f"Started {len(processes)} worker(s), press Ctrl+C to stop")
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        print("Stopping workers...")
+        for process in processes:
+            process.terminate()
+        releaseWorkerJobs(poolId) # Hand the interrupted steps back to the queue so the next pool picks them up straight away
+        releaseWorkerHarvests(poolId)
+
+if __name__ == "__main__":
+    main()
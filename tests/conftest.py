@@ -0,0 +1,9 @@
+import os
+import sys
+import tempfile
+
+# The modules read their settings (and open their databases) on import, so point them at a throwaway data directory
+# before anything from app/ is imported
+os.environ["RESEARCH_DATA_DIR"] = tempfile.mkdtemp(prefix="research-tests-")
+os.environ["METRICS_ENABLED"] = "0"
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app"))
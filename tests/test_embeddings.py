@@ -0,0 +1,33 @@
+from embeddings import EmbeddingClient
+
+def makeClient(tmp_path, monkeypatch) -> tuple[EmbeddingClient, list]:
+    ''' Embedding client with a local cache whose requests are recorded instead of sent to Ollama '''
+    client = EmbeddingClient("test-model", batchSize=8, cachePath=str(tmp_path / "embeddings.db"))
+    requests = []
+    def embedBatch(texts):
+        requests.append(texts)
+        return [[float(len(text)), 1.0] for text in texts]
+    monkeypatch.setattr(client, "_embedBatch", embedBatch)
+    return client, requests
+
+def testDuplicatesAreNotCacheHits(tmp_path, monkeypatch):
+    client, requests = makeClient(tmp_path, monkeypatch)
+    texts = ["a", "bb", "ccc"] * 26 + ["a", "bb"]
+
+    vectors = client.embed(texts)
+
+    assert [vector[0] for vector in vectors] == [float(len(text)) for text in texts]
+    assert sum(len(batch) for batch in requests) == 3 # Every unique text is embedded once
+    assert client.stats["cached"] == 0
+    assert client.stats["duplicates"] == 77
+
+def testCachedTextsAreCountedOnce(tmp_path, monkeypatch):
+    client, requests = makeClient(tmp_path, monkeypatch)
+    client.embed(["a", "bb"])
+    requests.clear()
+
+    client.embed(["a", "a", "bb", "dddd"])
+
+    assert requests == [["dddd"]]
+    assert client.stats["cached"] == 2
+    assert client.stats["duplicates"] == 1
@@ -0,0 +1,201 @@
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import arxiv
+import pytest
+
+from config import PAPERS_DIR
+from database import repository
+from harvester import initHarvester, createHarvest, claimHarvest, retryHarvest, runHarvest, pdfPath
+from jobQueue import pool, initJobQueue
+
+ENTRY = '''<entry>
+  <id>http://arxiv.org/abs/{id}</id>
+  <updated>2024-01-01T00:00:00Z</updated>
+  <published>2024-01-01T00:00:00Z</published>
+  <title>Paper {id}</title>
+  <summary>Abstract of {id}</summary>
+  <author><name>Ada Lovelace</name></author>
+  <link href="{host}/pdf/{id}" rel="related" title="pdf" type="application/pdf"/>
+</entry>'''
+
+FEED = '''<?xml version="1.0" encoding="UTF-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom" xmlns:opensearch="http://a9.com/-/spec/opensearch/1.1/" xmlns:arxiv="http://arxiv.org/schemas/atom">
+  <opensearch:totalResults>{total}</opensearch:totalResults>
+  <opensearch:startIndex>{start}</opensearch:startIndex>
+  <opensearch:itemsPerPage>{count}</opensearch:itemsPerPage>
+  {entries}
+</feed>'''
+
+class FakeArxiv:
+    ''' Local stand-in for the arXiv API (/api/query) and the server its PDF links point to (/pdf/<id>), recording
+    when each request arrived '''
+    def __init__(self, ids: list[str]):
+        self.ids = ids
+        self.failFrom = None # API pages starting at or past this result answer with an error
+        self.pages, self.downloads = [], []
+        self._lock = threading.Lock()
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path == "/api/query":
+                    fake._page(self, parse_qs(url.query))
+                elif url.path.startswith("/pdf/"):
+                    fake._pdf(self, url.path[len("/pdf/"):])
+                else:
+                    self.send_error(404)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.host = f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def start(self) -> "FakeArxiv":
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def client(self, delay: float = 0.0, retries: int = 0) -> arxiv.Client:
+        ''' An arXiv client that pages through this server 50 results at a time '''
+        client = arxiv.Client(page_size=50, delay_seconds=delay, num_retries=retries)
+        client.query_url_format = self.host + "/api/query?{}"
+        return client
+
+    def _page(self, handler: BaseHTTPRequestHandler, query: dict):
+        start, count = int(query["start"][0]), int(query["max_results"][0])
+        with self._lock:
+            self.pages.append((time.monotonic(), start))
+        if self.failFrom is not None and start >= self.failFrom:
+            handler.send_error(503)
+            return
+
+        entries = "".join(ENTRY.format(id=shortId, host=self.host) for shortId in self.ids[start:start + count])
+        body = FEED.format(total=len(self.ids), start=start, count=count, entries=entries).encode()
+        self._send(handler, body, "application/atom+xml")
+
+    def _pdf(self, handler: BaseHTTPRequestHandler, shortId: str):
+        with self._lock:
+            self.downloads.append((time.monotonic(), shortId))
+        self._send(handler, b"%PDF-1.4 " + shortId.encode(), "application/pdf")
+
+    def _send(self, handler: BaseHTTPRequestHandler, body: bytes, contentType: str):
+        handler.send_response(200)
+        handler.send_header("Content-Type", contentType)
+        handler.send_header("Content-Length", str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+@pytest.fixture(scope="module", autouse=True)
+def tables():
+    repository.initSchema()
+    initJobQueue()
+    initHarvester()
+
+def fake(prefix: str, count: int) -> FakeArxiv:
+    ''' A started server with `count` results, the prefix keeps the PDFs of each test apart in the shared data directory '''
+    return FakeArxiv([f"{prefix}.{i:05d}v1" for i in range(count)]).start()
+
+def harvest(server: FakeArxiv, options: dict = None, **kwargs) -> dict:
+    ''' Creates a harvest of every result and runs it to completion, returning its row '''
+    harvestId = createHarvest("all:test", len(server.ids), options or {})
+    runHarvest(claim(harvestId), **{"rate": 1000, "maxPending": 10_000, "client": server.client(), **kwargs})
+    return row(harvestId)
+
+def claim(harvestId: str) -> dict:
+    harvest = claimHarvest("test-worker")
+    assert harvest["id"] == harvestId
+    return harvest
+
+def row(harvestId: str) -> dict:
+    with pool.connection() as conn:
+        return dict(conn.execute("SELECT * FROM harvests WHERE id=?", (harvestId,)).fetchone())
+
+def items(harvestId: str) -> dict[str, tuple[str, str]]:
+    with pool.connection() as conn:
+        rows = conn.execute("SELECT arxivId, status, detail FROM harvest_items WHERE harvestId=?", (harvestId,))
+        return {r["arxivId"]: (r["status"], r["detail"]) for r in rows}
+
+def testPagesPastThePageSize():
+    server = fake("2401", 120)
+    try:
+        result = harvest(server)
+    finally:
+        server.stop()
+
+    assert [start for _, start in server.pages] == [0, 50, 100]
+    assert result["status"] == "done" and result["cursor"] == 120 and result["downloaded"] == 120
+    assert sorted(shortId for _, shortId in server.downloads) == server.ids
+    assert all(os.path.getsize(pdfPath(shortId)) > 0 for shortId in server.ids)
+
+def testApiRequestsAreDelayed():
+    server = fake("2402", 120)
+    try:
+        harvest(server, client=server.client(delay=0.3))
+    finally:
+        server.stop()
+
+    times = [at for at, _ in server.pages]
+    assert len(times) == 3
+    assert all(b - a >= 0.28 for a, b in zip(times, times[1:])) # arXiv's own client keeps its delay between pages
+
+def testDownloadsAreRateLimited():
+    server = fake("2403", 12)
+    try:
+        start = time.monotonic()
+        harvest(server, concurrency=4, rate=20)
+    finally:
+        server.stop()
+
+    times = sorted(at for at, _ in server.downloads)
+    assert len(times) == 12
+    assert times[-1] - start >= 11 / 20 - 0.02 # Four threads, but still no more than 20 downloads a second
+    assert all(b - a >= 0.03 for a, b in zip(times, times[1:]))
+
+def testResumesFromTheCursor():
+    server = fake("2404", 120)
+    server.failFrom = 50 # The second page fails, as if the harvest was interrupted there
+    harvestId = createHarvest("all:test", 120, {})
+    try:
+        with pytest.raises(arxiv.HTTPError):
+            runHarvest(claim(harvestId), rate=1000, maxPending=10_000, client=server.client())
+        interrupted = row(harvestId)
+        assert interrupted["status"] == "failed" and interrupted["cursor"] <= 50
+
+        server.failFrom, server.pages = None, []
+        retryHarvest(harvestId)
+        runHarvest(claim(harvestId), rate=1000, maxPending=10_000, client=server.client())
+    finally:
+        server.stop()
+
+    result = row(harvestId)
+    assert server.pages[0][1] == interrupted["cursor"] # Paging picked up at the saved cursor, not at the first result
+    assert result["status"] == "done" and result["cursor"] == 120
+    assert len(items(harvestId)) == 120
+    assert sorted(shortId for _, shortId in server.downloads) == server.ids # Every PDF was downloaded exactly once
+
+def testSkipsStoredPapersAndDownloadedPdfs():
+    server = fake("2405", 6)
+    stored, cached = server.ids[1], server.ids[4]
+    repository.insertPapers([("stored-paper", {"title": "Stored"}, stored[:-2])]) # Stored from an earlier version of it
+    os.makedirs(PAPERS_DIR, exist_ok=True)
+    with open(pdfPath(cached), "wb") as f:
+        f.write(b"%PDF-1.4 cached")
+    try:
+        result = harvest(server)
+    finally:
+        server.stop()
+
+    outcomes = items(result["id"])
+    assert outcomes[stored] == ("skipped", "Already in the database")
+    assert outcomes[cached] == ("downloaded", "PDF already on disk")
+    assert result["skipped"] == 1 and result["downloaded"] == 5
+    assert {shortId for _, shortId in server.downloads} == set(server.ids) - {stored, cached}
@@ -0,0 +1,86 @@
+import os
+import time
+
+import pytest
+
+import database
+import extractText
+import ingestCache
+from ingestCache import hashBytes, hashFile, getCached, putCached, evictCache
+from repository import PaperRepository
+from worker import parseStep, DuplicatePaper
+
+@pytest.fixture(autouse=True)
+def cacheDir(tmp_path, monkeypatch) -> str:
+    ''' An ingest cache of its own per test '''
+    monkeypatch.setattr(ingestCache, "INGEST_CACHE_DIR", str(tmp_path / "ingest"))
+    return str(tmp_path / "ingest")
+
+@pytest.fixture
+def repository(tmp_path, monkeypatch) -> PaperRepository:
+    repository = PaperRepository(str(tmp_path / "metadata.db"))
+    repository.initSchema()
+    monkeypatch.setattr(database, "repository", repository)
+    return repository
+
+def pdf(tmp_path, name: str, content: bytes) -> str:
+    path = str(tmp_path / name)
+    with open(path, "wb") as f:
+        f.write(content)
+    return path
+
+def testFileAndBytesHashTheSame(tmp_path):
+    content = os.urandom(3 << 20) # Read in several blocks
+    path = pdf(tmp_path, "a.pdf", content)
+
+    assert hashFile(path) == hashBytes(content)
+    assert hashBytes(content) != hashBytes(content + b" ")
+
+def testStagesAreCachedPerKey():
+    putCached("paper", "chunks", [{"page_content": "text"}], "1000/100")
+
+    assert getCached("paper", "chunks", "1000/100") == [{"page_content": "text"}]
+    assert getCached("paper", "chunks", "500/50") is None # Chunked with other settings
+    assert getCached("paper", "pages") is None and getCached("other", "chunks", "1000/100") is None
+
+def testBrokenEntriesAreMisses(cacheDir):
+    putCached("paper", "pages", ["page"])
+    path = ingestCache._entryPath("paper", "pages", "")
+    with open(path, "w") as f:
+        f.write('["pa')
+
+    assert getCached("paper", "pages") is None
+    assert not [name for name in os.listdir(os.path.dirname(path)) if name.endswith(".tmp")]
+
+def testLeastRecentlyUsedPapersAreEvicted(cacheDir):
+    for paperHash in ("old", "used", "new"):
+        putCached(paperHash, "pages", ["x" * 1000])
+    past = time.time() - 100
+    for i, paperHash in enumerate(("old", "used", "new")):
+        os.utime(os.path.join(cacheDir, paperHash), (past + i, past + i))
+    getCached("old", "pages") # Reading marks it as recently used
+
+    evictCache(maxBytes=2500)
+
+    assert sorted(os.listdir(cacheDir)) == ["new", "old"]
+
+def testStoredPapersAreFoundByHashOrArxivId(repository):
+    repository.insertPapers([(hashBytes(b"pdf"), {"title": "Stored"}, database.arxivBaseId("2310.11453v2"))])
+
+    assert database.findExistingPaper(paperId=hashBytes(b"pdf")) == hashBytes(b"pdf")
+    assert database.findExistingPaper(arxivId=database.arxivBaseId("2310.11453v1")) == hashBytes(b"pdf") # Any version of it
+    assert database.findExistingPaper(paperId=hashBytes(b"other"), arxivId=None) is None
+
+def testParseStepSkipsStoredPapersAndReusesPages(tmp_path, repository, monkeypatch):
+    parsed = []
+    monkeypatch.setattr(extractText, "extractPages", lambda path: parsed.append(path) or ["page one", "page two"])
+    first, copy = pdf(tmp_path, "a.pdf", b"%PDF-1.4 a"), pdf(tmp_path, "copy.pdf", b"%PDF-1.4 a")
+    job = lambda path: {"source": path, "label": os.path.basename(path)}
+
+    assert parseStep(job(first), {}) == {"hash": hashBytes(b"%PDF-1.4 a"), "pages": ["page one", "page two"]}
+    assert parseStep(job(copy), {})["pages"] == ["page one", "page two"] # Same bytes, so the pages come from the cache
+    assert parsed == [first]
+
+    repository.insertPapers([(hashBytes(b"%PDF-1.4 a"), {"title": "A"}, None)])
+    with pytest.raises(DuplicatePaper):
+        parseStep(job(copy), {})
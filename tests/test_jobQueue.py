@@ -0,0 +1,94 @@
+import time
+
+import pytest
+
+import jobQueue
+from jobQueue import (initJobQueue, enqueueJob, enqueueJobs, claimJob, completeStep, failStep, retryJob, getArtifacts,
+                      requeueStaleJobs, releaseWorkerJobs, JOB_STEPS)
+from repository import ConnectionPool
+
+@pytest.fixture(autouse=True)
+def queue(tmp_path, monkeypatch):
+    ''' A queue of its own per test, so jobs left by other tests are never claimed '''
+    monkeypatch.setattr(jobQueue, "pool", ConnectionPool(str(tmp_path / "jobs.db"), size=2))
+    monkeypatch.setattr(jobQueue, "JOB_RETRY_DELAY", 0.2)
+    initJobQueue()
+
+def job(jobId: str) -> dict:
+    with jobQueue.pool.connection() as conn:
+        return dict(conn.execute("SELECT * FROM jobs WHERE id=?", (jobId,)).fetchone())
+
+def testJobsAreClaimedOldestFirstFromTheirLane():
+    first, second = enqueueJobs("upload", [("a.pdf", "A"), ("b.pdf", "B")], {"genModel": "llm"})
+
+    assert claimJob("cpu-0", ["download", "embed"]) is None # Uploads start at parsing
+    claimed = claimJob("cpu-0", ["parse", "chunk"])
+    assert claimed["id"] == first and claimed["options"] == {"genModel": "llm"}
+    assert claimJob("cpu-1", ["parse", "chunk"])["id"] == second
+    assert claimJob("cpu-2", ["parse", "chunk"]) is None # Both are running now
+    assert job(first)["status"] == "running" and job(first)["workerId"] == "cpu-0"
+
+def testStepsAdvanceUntilTheJobIsDone():
+    jobId = enqueueJob("upload", "a.pdf", "A", {})
+    for step in JOB_STEPS["upload"]:
+        claimed = claimJob("worker", [step])
+        assert claimed["id"] == jobId and claimed["step"] == step
+        completeStep(jobId, step, {"output": step})
+
+    assert job(jobId)["status"] == "done"
+    assert getArtifacts(jobId) == {step: {"output": step} for step in JOB_STEPS["upload"]}
+
+def testJobsStartAfterTheStepsAlreadyDone():
+    jobId = enqueueJob("arxiv", "2310.11453", "Paper", {}, {"download": {"path": "2310.11453.pdf"}})
+
+    assert job(jobId)["step"] == "parse"
+    assert getArtifacts(jobId) == {"download": {"path": "2310.11453.pdf"}}
+
+def testJobWithEveryStepDoneIsAddedAsDone():
+    artifacts = {step: {} for step in JOB_STEPS["upload"]}
+    jobId = enqueueJob("upload", "a.pdf", "A", {}, artifacts)
+
+    assert job(jobId)["status"] == "done"
+    assert claimJob("worker", JOB_STEPS["upload"]) is None
+
+def testFailedStepsBackOffThenFail(monkeypatch):
+    monkeypatch.setattr(jobQueue, "JOB_MAX_ATTEMPTS", 2)
+    jobId = enqueueJob("upload", "a.pdf", "A", {})
+    claimJob("worker", ["parse"])
+    failStep(jobId, "parse failed: broken PDF")
+
+    assert job(jobId)["status"] == "queued" and job(jobId)["attempts"] == 1
+    assert claimJob("worker", ["parse"]) is None # Not before its retry delay
+    time.sleep(0.25)
+    assert claimJob("worker", ["parse"])["id"] == jobId
+
+    failStep(jobId, "parse failed: broken PDF")
+    assert job(jobId)["status"] == "failed" and job(jobId)["error"] == "parse failed: broken PDF"
+    assert claimJob("worker", ["parse"]) is None
+
+def testRetryResumesAtTheFailedStep(monkeypatch):
+    monkeypatch.setattr(jobQueue, "JOB_MAX_ATTEMPTS", 1)
+    jobId = enqueueJob("upload", "a.pdf", "A", {})
+    claimJob("worker", ["parse"])
+    completeStep(jobId, "parse", {"hash": "h"})
+    claimJob("worker", ["chunk"])
+    failStep(jobId, "chunk failed")
+    assert job(jobId)["status"] == "failed"
+
+    retryJob(jobId)
+    claimed = claimJob("worker", ["parse", "chunk"])
+    assert claimed["id"] == jobId and claimed["step"] == "chunk" and claimed["attempts"] == 0
+    assert getArtifacts(jobId) == {"parse": {"hash": "h"}}
+
+def testStepsOfDeadWorkersAreRequeued():
+    stale, released, kept = enqueueJobs("upload", [("a.pdf", "A"), ("b.pdf", "B"), ("c.pdf", "C")], {})
+    claimJob("old-pool-cpu-0", ["parse"])
+    claimJob("pool-cpu-0", ["parse"])
+    claimJob("other-pool-cpu-0", ["parse"])
+    with jobQueue.pool.transaction() as conn:
+        conn.execute("UPDATE jobs SET updatedAt=0 WHERE id=?", (stale,))
+
+    assert requeueStaleJobs(staleAfter=60) == 1
+    releaseWorkerJobs("pool-")
+
+    assert [job(jobId)["status"] for jobId in (stale, released, kept)] == ["queued", "queued", "running"]
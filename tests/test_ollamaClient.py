@@ -0,0 +1,78 @@
+import asyncio
+import time
+
+import httpx
+import ollama
+import pytest
+
+from fakeOllama import FakeOllama
+from ollamaClient import AsyncOllama
+
+@pytest.fixture
+def server():
+    server = FakeOllama(dim=8).start()
+    yield server
+    server.stop()
+
+def run(server: FakeOllama, requests, **options):
+    ''' Runs the requests (a function of the client returning a coroutine) with a client pointed at the stub server '''
+    async def main():
+        return await requests(AsyncOllama(host=server.host, **{"backoff": 0.01, **options}))
+    return asyncio.run(main())
+
+def testTransientErrorsAreRetried(server):
+    server.failures = 2
+    response = run(server, lambda client: client.generate(model="fake-llm", prompt="paper"), retries=3)
+
+    assert response.response
+    assert server.requests["generate"] == 3
+
+def testRetriesGiveUp(server):
+    server.failures = 10
+    with pytest.raises(ollama.ResponseError) as error:
+        run(server, lambda client: client.generate(model="fake-llm", prompt="paper"), retries=2)
+
+    assert error.value.status_code == 503
+    assert server.requests["generate"] == 3 # The first attempt and two retries
+
+def testClientErrorsAreNotRetried(server):
+    server.failures, server.failStatus = 1, 400
+    with pytest.raises(ollama.ResponseError):
+        run(server, lambda client: client.generate(model="fake-llm", prompt="paper"), retries=3)
+
+    assert server.requests["generate"] == 1
+
+def testBackoffDoublesBetweenRetries(server):
+    server.failures = 2
+    start = time.perf_counter()
+    run(server, lambda client: client.embed("fake-embed", ["chunk"]), retries=2, backoff=0.2)
+
+    assert time.perf_counter() - start >= 0.2 + 0.4
+    assert server.requests["embed"] == 3
+
+def testTimeoutRaises(server):
+    server.latency = 2.0
+    start = time.perf_counter()
+    with pytest.raises((asyncio.TimeoutError, httpx.TimeoutException)): # Whichever of the two equal timeouts fires first
+        run(server, lambda client: client.generate(model="fake-llm", prompt="paper"), timeout=0.2, retries=1)
+
+    assert time.perf_counter() - start < 1.5 # Both attempts were abandoned instead of waiting for the server
+    assert server.requests["generate"] == 2
+
+def testConcurrencyLimit(server):
+    server.latency = 0.1
+    async def requests(client):
+        return await asyncio.gather(*[client.embed("fake-embed", [f"chunk {i}"]) for i in range(12)])
+    vectors = run(server, requests, concurrency=3)
+
+    assert len(vectors) == 12 and all(len(vector[0]) == 8 for vector in vectors)
+    assert server.maxInFlight == 3 # Requests overlap, but never more than the limit
+
+def testStreamIsRetriedBeforeItsFirstChunk(server):
+    server.failures = 1
+    async def requests(client):
+        return "".join([chunk.response async for chunk in client.generateStream(model="fake-llm", prompt="paper")])
+    text = run(server, requests, retries=1)
+
+    assert text.startswith("{") and text.endswith("}")
+    assert server.requests["generate"] == 2
@@ -0,0 +1,83 @@
+import asyncio
+import json
+import re
+from types import SimpleNamespace
+
+import pytest
+
+import processPaper
+from processPaper import _request, splitIntoWindows, mergeMetadata, generateMetadataAsync, PROMPT_RESERVE_TOKENS
+
+class EmptyStreamClient:
+    ''' Client whose streamed responses end before the first chunk '''
+    async def generateStream(self, **kwargs):
+        return
+        yield
+
+def testEmptyStreamRaises():
+    with pytest.raises(Exception, match="empty stream"):
+        asyncio.run(_request(EmptyStreamClient(), "prompt", {}, "test-model", 2048, onPartial=lambda window, partial: None))
+
+class FakeClient:
+    ''' Client that fills in every field of the requested schema from the content of the prompt, and fails the parts
+    whose content starts with FAIL '''
+    def __init__(self):
+        self.schemas, self.prompts = [], []
+
+    async def show(self, model):
+        raise Exception("Not running")
+
+    async def generate(self, **request):
+        properties = request["format"]["properties"]
+        self.schemas.append(sorted(properties))
+        self.prompts.append(request["prompt"])
+        content = request["prompt"].split("CONTENT: ")[-1].strip(". ")
+        if content.startswith("FAIL"):
+            raise Exception("Model crashed")
+        words = re.findall(r"[a-z]+", content.lower())
+        generated = {name: (f"About {' '.join(words[:2])}" if field.get("type") == "string" else words) for name, field in properties.items()}
+        return SimpleNamespace(response=json.dumps(generated), prompt_eval_count=1, eval_count=1)
+
+@pytest.fixture
+def client(monkeypatch) -> FakeClient:
+    ''' A fake client for a model with a context of 400 characters of paper '''
+    monkeypatch.setattr(processPaper, "_contextLengths", {"test-model": PROMPT_RESERVE_TOKENS + 100})
+    return FakeClient()
+
+def testPagesArePackedIntoWindows():
+    assert splitIntoWindows(["aaaa", "bb", "cccc"], 6) == ["aaaabb", "cccc"]
+    assert splitIntoWindows(["a" * 13], 5) == ["aaaaa", "aaaaa", "aaa"] # Too long on its own
+    assert splitIntoWindows(["", "  ", "dd"], 5) == ["  dd"]
+    assert splitIntoWindows([], 5) == []
+
+def testMergedListsAreDeduplicatedInOrder():
+    merged = mergeMetadata([
+        {"title": " ", "summary": "First part.", "methods": ["GNN", "Graph  attention"]},
+        {"title": "Graph networks", "summary": "", "methods": ["gnn", "graph attention", "CNN"], "datasets": ["Cora"]},
+        {"title": "Part three", "summary": "Third part.", "methods": ["  "]},
+    ])
+
+    assert merged["title"] == "Graph networks" # The first title that was found
+    assert merged["summary"] == "First part. Third part."
+    assert merged["methods"] == ["GNN", "Graph  attention", "CNN"]
+    assert merged["datasets"] == ["Cora"] and merged["limitations"] == []
+
+def generate(client: FakeClient, pages: list[str], stats: list = None) -> dict:
+    return asyncio.run(generateMetadataAsync("".join(pages), "test-model", pages, stats, client))
+
+def testLongPapersAreMergedWithASummaryOnlyReduce(client):
+    stats = []
+    metadata = generate(client, ["graph networks " * 20, "vision models " * 22], stats)
+
+    assert len(stats) == 3 # Two parts and the reduce
+    assert client.schemas[-1] == ["summary"]
+    assert "CONTENT: About graph networks About vision models" in client.prompts[-1]
+    assert metadata["summary"] == "About about graph"
+    assert metadata["methods"] == ["graph", "networks", "vision", "models"]
+
+def testFailedPartsAreLeftOutOfTheMerge(client):
+    metadata = generate(client, ["graph networks " * 20, "FAIL model crash " * 18, "vision models " * 22])
+    assert metadata["methods"] == ["graph", "networks", "vision", "models"]
+
+    with pytest.raises(Exception, match="Model crashed"):
+        generate(client, ["FAIL one part " * 22, "FAIL two part " * 22])
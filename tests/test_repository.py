@@ -0,0 +1,116 @@
+import json
+import sqlite3
+
+import pytest
+
+from repository import PaperRepository
+
+def legacyDatabase(path: str, papers: list[tuple], arxivColumn: bool = False):
+    ''' Writes a metadata database as it was before the schema was versioned, with the list fields stored as JSON '''
+    conn = sqlite3.connect(path)
+    conn.execute('''CREATE TABLE metadata (id TEXT PRIMARY KEY, title TEXT, summary TEXT, authors TEXT, link TEXT, datasets TEXT,
+                    metrics TEXT, methods TEXT, applications TEXT, limitations TEXT, areasOfImprovement TEXT)''')
+    if arxivColumn:
+        conn.execute("ALTER TABLE metadata ADD COLUMN arxivId TEXT")
+        conn.execute("PRAGMA user_version = 1")
+    for paperId, title, link, authors, methods, *arxivId in papers:
+        conn.execute("INSERT INTO metadata (id, title, summary, authors, link, methods, datasets) VALUES (?,?,?,?,?,?,?)",
+                     (paperId, title, f"Summary of {title}", json.dumps(authors), link, json.dumps(methods), "{}")) # Older rows stored empty fields as {}
+        if arxivId:
+            conn.execute("UPDATE metadata SET arxivId=? WHERE id=?", (arxivId[0], paperId))
+    conn.commit()
+    conn.close()
+
+def testMigratesUnversionedDatabase(tmp_path):
+    path = str(tmp_path / "metadata.db")
+    legacyDatabase(path, [("hash-a", "Graph networks", "https://arxiv.org/abs/2310.11453v2", ["Ada Lovelace", "Alan Turing"], ["GNN"]),
+                          ("hash-b", "Speech models", "http://arxiv.org/abs/2401.00001", ["Grace Hopper"], []),
+                          ("hash-c", "Uploaded", "", [], ["CNN"])])
+    repository = PaperRepository(path)
+
+    repository.initSchema()
+
+    with repository.pool.connection() as conn:
+        assert conn.execute("PRAGMA user_version").fetchone()[0] == 3
+        assert not conn.execute("SELECT name FROM sqlite_master WHERE name='metadata'").fetchone()
+    papers = {paper["id"]: paper for paper in repository.getAllPapers()}
+    assert [paper["id"] for paper in repository.getAllPapers()] == ["hash-a", "hash-b", "hash-c"] # Still in the order they were added
+    assert {paperId: paper["arxivId"] for paperId, paper in papers.items()} == {"hash-a": "2310.11453", "hash-b": "2401.00001", "hash-c": None}
+    assert papers["hash-a"]["authors"] == ["Ada Lovelace", "Alan Turing"] and papers["hash-a"]["methods"] == ["GNN"]
+    assert papers["hash-b"]["datasets"] == []
+    assert repository.findExistingPaper(arxivId="2310.11453") == "hash-a"
+    assert repository.getSetting("chunkIndexBackfill") == "pending" # The chunk texts still have to be copied from Chroma
+    assert [paperId for paperId, _ in repository.searchLexical("turing")[0]] == ["hash-a"]
+    assert repository.listPapers({"methods": ["gnn"]})[0][0]["id"] == "hash-a"
+
+def testKeepsTheArxivIdsOfVersionOne(tmp_path):
+    path = str(tmp_path / "metadata.db")
+    legacyDatabase(path, [("hash-a", "Graph networks", "https://example.org/graphs", [], [], "2310.11453")], arxivColumn=True)
+    repository = PaperRepository(path)
+
+    repository.initSchema()
+    repository.initSchema() # Migrating again does nothing
+
+    assert [paper["arxivId"] for paper in repository.getAllPapers()] == ["2310.11453"]
+
+def testNewDatabaseNeedsNoBackfill(tmp_path):
+    repository = PaperRepository(str(tmp_path / "metadata.db"))
+    repository.initSchema()
+
+    assert repository.getSetting("chunkIndexBackfill") is None
+    assert repository.getAllPapers() == []
+
+@pytest.fixture
+def library(tmp_path) -> PaperRepository:
+    ''' Twelve papers, added a second apart, with titles in a different order than they were added and two titles equal '''
+    repository = PaperRepository(str(tmp_path / "metadata.db"))
+    repository.initSchema()
+    titles = ["Kappa", "alpha", "Lambda", "beta", "Mu", "gamma", "Nu", "delta", "Xi", "Delta", "Omicron", "epsilon"]
+    repository.insertPapers([(f"p{i:02d}", {"title": title, "methods": ["GNN" if i % 3 == 0 else "CNN"],
+                                           "summary": "graph networks" if i % 2 == 0 else "vision"}, None)
+                             for i, title in enumerate(titles)])
+    with repository.pool.transaction() as conn:
+        conn.execute("UPDATE papers SET addedAt = CAST(substr(id, 2) AS REAL)")
+    return repository
+
+def walk(repository: PaperRepository, limit: int = 5, **kwargs) -> list[list[str]]:
+    ''' Follows the cursor from the first page to the last, returning the IDs on every page '''
+    pages, cursor = [], None
+    while True:
+        papers, cursor = repository.listPapers(after=cursor, limit=limit, **kwargs)
+        pages.append([paper["id"] for paper in papers])
+        if cursor is None:
+            return pages
+
+@pytest.mark.parametrize("sort", ["title", "addedAt"])
+@pytest.mark.parametrize("descending", [False, True])
+def testCursorWalksEveryPaperOnce(library, sort, descending):
+    papers = library.getAllPapers()
+    key = (lambda paper: (paper["title"].lower(), paper["id"])) if sort == "title" else (lambda paper: (paper["addedAt"], paper["id"]))
+    expected = [paper["id"] for paper in sorted(papers, key=key, reverse=descending)]
+
+    pages = walk(library, sort=sort, descending=descending)
+
+    assert [len(page) for page in pages] == [5, 5, 2]
+    assert [paperId for page in pages for paperId in page] == expected
+
+def testTitlesAreSortedIgnoringCase(library):
+    papers, _ = library.listPapers(sort="title", descending=False, limit=5)
+
+    assert [paper["title"] for paper in papers] == ["alpha", "beta", "delta", "Delta", "epsilon"]
+    assert set(papers[0]) == {"id", "title", "link", "addedAt"} # Only the summary columns
+
+def testLastPageHasNoCursor(library):
+    assert library.listPapers(limit=12)[1] is None
+    assert library.listPapers(limit=11)[1] == (1.0, "p01")
+    assert library.listPapers(after=(0.0, "p00")) == ([], None)
+
+def testFiltersAndTextNarrowThePages(library):
+    assert walk(library, 2, filters={"methods": ["gnn"]}) == [["p09", "p06"], ["p03", "p00"]]
+    assert walk(library, 2, filters={"methods": ["gnn"]}, text="graph") == [["p06", "p00"]]
+    assert library.countPapers({"methods": ["GNN"]}, "graph") == 2
+
+    with pytest.raises(Exception, match="Unknown sort"):
+        library.listPapers(sort="summary")
+    with pytest.raises(Exception, match="Unknown facet"):
+        library.listPapers({"venue": ["NeurIPS"]})
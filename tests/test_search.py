@@ -0,0 +1,178 @@
+import pytest
+from langchain_core.documents import Document
+
+import database
+import embeddings
+import search
+from cache import TTLCache
+from repository import PaperRepository, ftsQuery
+from similarity import PaperVectors
+from storage import Storage
+
+VOCABULARY = ["graph", "vision", "language", "speech", "robot"]
+
+def embed(texts: list[str], model: str = None) -> list[list[float]]:
+    ''' Deterministic stand-in for the Ollama embeddings, texts sharing words end up close together '''
+    return [[float(text.lower().split().count(word)) for word in VOCABULARY] + [1.0] for text in texts]
+
+class FakeEmbeddingClient:
+    ''' Records the query embedding requests of one model instead of sending them to Ollama '''
+    def __init__(self, model: str):
+        self.model = model
+        self.requests = []
+
+    def _embedBatch(self, texts: list[str]) -> list[list[float]]:
+        self.requests.append(texts)
+        return embed(texts)
+
+@pytest.fixture
+def library(tmp_path, monkeypatch) -> Storage:
+    ''' The search functions running against a library of their own with a fresh query and result cache '''
+    repository = PaperRepository(str(tmp_path / "metadata.db"))
+    repository.initSchema()
+    storage = Storage(repository, str(tmp_path / "chroma"))
+    storage._vectors = PaperVectors(storage.pool, str(tmp_path / "vectors"))
+    storage.initStorage()
+    monkeypatch.setattr(storage, "_embedTexts", embed)
+    for module in (database, search):
+        monkeypatch.setattr(module, "repository", repository)
+        monkeypatch.setattr(module, "storage", storage)
+
+    clients = {}
+    monkeypatch.setattr(embeddings, "getEmbeddingClient", lambda model: clients.setdefault(model, FakeEmbeddingClient(model)))
+    queryCache = TTLCache(16, 60)
+    monkeypatch.setattr(embeddings, "queryCache", queryCache)
+    monkeypatch.setattr(search, "queryCache", queryCache)
+    monkeypatch.setattr(search, "resultCache", TTLCache(16, 60))
+    storage.clients = clients # Kept on the fixture so tests can look at the requests
+    return storage
+
+def add(storage: Storage, paperId: str, title: str, chunks: list[str], **metadata):
+    ''' Stores a paper whose chunks have the given texts '''
+    documents = [Document(page_content=text, metadata={"page": i}) for i, text in enumerate(chunks)]
+    storage.storePaper(paperId, {"title": title, **metadata}, documents, embed(chunks))
+
+def testQueryIsEmbeddedAsWritten(library):
+    vector = embeddings.embedQuery("Graph  Networks", "model-a")
+    assert embeddings.embedQuery("graph networks", "model-a") == vector # Served from the cache under the normalized query
+
+    assert library.clients["model-a"].requests == [["Graph  Networks"]]
+    assert embeddings.queryCache.stats()["hits"] == 1
+
+def testQueryCacheIsPerModel(library):
+    embeddings.embedQuery("graph networks", "model-a")
+    embeddings.embedQuery("graph networks", "model-b")
+
+    assert library.clients["model-a"].requests == [["graph networks"]]
+    assert library.clients["model-b"].requests == [["graph networks"]]
+    assert embeddings.queryCache.stats()["misses"] == 2
+
+def testSearchEmbedsItsQueryOnce(library, monkeypatch):
+    add(library, "graphs", "Graphs", ["graph graph graph"] * 30) # Fills every early fetch, so deeper fetches are needed
+    add(library, "vision", "Vision", ["vision"])
+    fetches = []
+    def searchChunks(*args):
+        fetches.append(args[1])
+        return database.searchChunks(*args)
+    monkeypatch.setattr(search, "searchChunks", searchChunks)
+
+    results = search.hybridSearch("graph", k=2, mode="vector")
+
+    assert [paper["id"] for paper in results] == ["graphs", "vision"]
+    assert len(fetches) > 1
+    assert library.clients[library.activeModel].requests == [["graph"]]
+    assert embeddings.queryCache.stats()["hits"] == 0 and embeddings.queryCache.stats()["misses"] == 1
+
+def testResultsAreDroppedWhenTheLibraryChanges(library):
+    add(library, "a", "Graph networks", ["graph"])
+    assert [paper["id"] for paper in search.hybridSearch("graph", mode="lexical")] == ["a"]
+    assert [paper["id"] for paper in search.hybridSearch("Graph", mode="lexical")] == ["a"]
+    assert search.resultCache.stats()["hits"] == 1
+
+    add(library, "b", "More graph networks", ["graph graph"])
+
+    assert {paper["id"] for paper in search.hybridSearch("graph", mode="lexical")} == {"a", "b"}
+    assert search.resultCache.stats()["misses"] == 2
+
+def testResultsAreDroppedWhenTheModelChanges(library):
+    add(library, "a", "Graph networks", ["graph"])
+    search.hybridSearch("graph", mode="lexical")
+    library.repository.setSetting("activeEmbedModel", "other-embed")
+    search.hybridSearch("graph", mode="lexical")
+
+    assert search.resultCache.stats()["misses"] == 2
+    assert search.resultCache.stats()["hits"] == 0
+
+def testFtsQueryKeepsTermsAsWritten():
+    assert ftsQuery('GPT-4 "vision" (robot') == '"GPT 4" OR "vision" OR "robot"'
+    assert ftsQuery("graph networks", "AND") == '"graph" AND "networks"'
+    assert ftsQuery("-- ()") == ""
+
+def testLexicalSearchWeighsTheTitleOverTheSummary(library):
+    add(library, "summary", "Networks", ["nothing here"], summary="A study of graph structure")
+    add(library, "title", "Graph networks", ["nothing here"], summary="A study of structure")
+    add(library, "chunk", "Networks", ["the graph of every robot"])
+
+    paperHits, chunkHits = library.repository.searchLexical("graphs") # Stemmed, so graphs finds graph
+
+    assert [paperId for paperId, _ in paperHits] == ["title", "summary"]
+    assert [(paperId, snippet) for paperId, _, snippet in chunkHits] == [("chunk", "the **graph** of every robot")]
+    assert library.repository.searchLexical('"(') == ([], [])
+
+def testReciprocalRankFusion():
+    scores = search.reciprocalRankFusion([(["a", "b"], 1.0), (["b", "c"], 1.0)], k=60)
+
+    assert scores["b"] == pytest.approx(1 / 62 + 1 / 61)
+    assert sorted(scores, key=scores.get, reverse=True) == ["b", "a", "c"]
+    assert search.reciprocalRankFusion([(["a"], 0.0), (["b"], 1.0)])["a"] == 0.0
+
+def testHybridSearchFusesKeywordAndVectorRankings(library):
+    add(library, "both", "Graph networks", ["graph graph"])
+    add(library, "keyword", "Graph", ["speech"])
+    add(library, "chunk", "Untitled", ["graph"]) # Only its chunk matches
+    add(library, "neither", "Speech", ["speech speech"])
+
+    hybrid = [paper["id"] for paper in search.hybridSearch("graph", k=3)]
+    lexical = [paper["id"] for paper in search.hybridSearch("graph", k=3, mode="lexical")]
+
+    assert hybrid[0] == "both"
+    assert set(hybrid) == {"both", "keyword", "chunk"}
+    assert library.clients[library.activeModel].requests == [["graph"]] # The lexical search never embedded the query
+    assert "neither" not in lexical
+
+def testAggregateChunks():
+    distances = [4.0, 1.0, 3.0, 8.0]
+
+    assert search.aggregateChunks(distances, "max") == 1.0
+    assert search.aggregateChunks(distances, "mean") == 4.0
+    assert search.aggregateChunks(distances, "topk", topN=2) == 2.0
+    with pytest.raises(Exception, match="Unknown aggregation"):
+        search.aggregateChunks(distances, "median")
+
+def testAggregationDecidesBetweenOneCloseChunkAndManyGoodOnes(library):
+    add(library, "spiky", "Spiky", ["graph", "vision vision vision"])
+    add(library, "steady", "Steady", ["graph graph", "graph graph"])
+
+    assert [hit["paperId"] for hit in search.rankPapersByVector("graph", 2, "max")] == ["spiky", "steady"]
+    assert [hit["paperId"] for hit in search.rankPapersByVector("graph", 2, "mean")] == ["steady", "spiky"]
+    assert search.rankPapersByVector("graph", 2, "max")[0]["snippet"] == "graph" # The best matching chunk of the paper
+
+def testRankingFetchesDeeperUntilEnoughPapers(library):
+    add(library, "crowded", "Crowded", ["graph"] * 40)
+    for i in range(3):
+        add(library, f"other{i}", "Other", ["vision " * (i + 1)])
+
+    hits = search.rankPapersByVector("graph", 4, overfetch=2)
+
+    assert [hit["paperId"] for hit in hits] == ["crowded", "other0", "other1", "other2"]
+    assert len(search.rankPapersByVector("graph", 10)) == 4 # The library runs out
+
+def testVectorSearchPagesAreDistinctAndInOrder(library):
+    for i in range(5):
+        add(library, f"p{i}", f"Paper {i}", ["graph " + "vision " * i] * 3) # p0 is the closest, p4 the furthest
+
+    pages = [[paper["id"] for paper in search.vectorSearch("graph", k=2, page=page)] for page in range(3)]
+
+    assert pages == [["p0", "p1"], ["p2", "p3"], ["p4"]]
+    first = search.vectorSearch("graph", k=2)
+    assert first[0]["score"] > first[1]["score"] and first[0]["snippet"].startswith("graph")
@@ -0,0 +1,99 @@
+import numpy as np
+import pytest
+
+import similarity
+from repository import ConnectionPool
+from similarity import PaperVectors
+
+@pytest.fixture
+def vectors(tmp_path) -> PaperVectors:
+    return PaperVectors(ConnectionPool(str(tmp_path / "metadata.db"), size=2), str(tmp_path / "vectors"))
+
+def group(vectors: PaperVectors, prefix: str, axis: int, count: int, dim: int = 4):
+    ''' Stores papers whose vectors lean towards one axis, the first paper of the group leaning the most '''
+    for i in range(count):
+        vector = np.full(dim, 0.05 * (i + 1))
+        vector[axis] = 1.0
+        vectors.put("index", f"{prefix}{i}", [vector.tolist()])
+
+def testSimilarPapersByCosineOfTheirMeanChunk(vectors):
+    vectors.put("index", "a", [[1, 0, 0], [1, 0.2, 0]]) # The paper vector is the mean of its chunks
+    vectors.put("index", "b", [[2, 0.2, 0]]) # Twice as long, but the same direction
+    vectors.put("index", "c", [[0, 0, 1]])
+    vectors.put("index", "empty", [])
+
+    similar = vectors.similar("index", "a", 5)
+
+    assert [paperId for paperId, _ in similar] == ["b", "c"] # Never the paper itself
+    assert similar[0][1] == pytest.approx(1.0, abs=1e-5) and similar[1][1] == pytest.approx(0.0, abs=1e-6)
+    assert vectors.similar("index", "empty") == [] and vectors.similar("other", "a") == []
+    assert vectors.stored("index", ["a", "b", "empty"]) == {"a", "b"}
+
+def testDeletedRowsAreReused(vectors, monkeypatch):
+    monkeypatch.setattr(similarity, "INITIAL_CAPACITY", 2) # So the matrix file has to grow
+    for i in range(5):
+        vectors.put("index", f"p{i}", [[1, i, 0]])
+    vectors.delete("index", ["p1", "p3"])
+
+    assert "p1" not in [paperId for paperId, _ in vectors.similar("index", "p0", 10)]
+    vectors.put("index", "new", [[1, 0, 1]])
+    with vectors.pool.connection() as conn:
+        assert conn.execute("SELECT row FROM paper_vectors WHERE paperId='new'").fetchone()[0] in (1, 3)
+    assert sorted(vectors.paperIds("index")) == ["new", "p0", "p2", "p4"]
+    assert vectors.similar("index", "new", 1)[0][0] == "p0" # The only other paper without a second component
+    with pytest.raises(Exception, match="dimensions"):
+        vectors.put("index", "wide", [[1, 0, 0, 0]])
+
+def testAllPairsMatchesSimilarBlockByBlock(vectors):
+    rng = np.random.default_rng(1)
+    for i in range(7):
+        vectors.put("index", f"p{i}", rng.normal(size=(2, 5)).tolist())
+
+    pairs = dict(vectors.allPairs("index", k=3, blockSize=2))
+
+    assert sorted(pairs) == [f"p{i}" for i in range(7)]
+    for paperId, neighbours in pairs.items():
+        expected = vectors.similar("index", paperId, 3)
+        assert [n for n, _ in neighbours] == [n for n, _ in expected]
+        assert [s for _, s in neighbours] == pytest.approx([s for _, s in expected], abs=1e-5)
+
+def testClustersSeparateTopicsWithTheirCentralPaperAsExemplar(vectors):
+    group(vectors, "graph", 0, 6)
+    group(vectors, "vision", 1, 4)
+
+    assert vectors.cluster("index", 2) == 2
+
+    graph, vision = vectors.getTopic("index", "graph3"), vectors.getTopic("index", "vision3")
+    assert graph["topic"] != vision["topic"]
+    assert {vectors.getTopic("index", f"graph{i}")["topic"] for i in range(6)} == {graph["topic"]}
+    assert (graph["size"], vision["size"]) == (6, 4)
+    assert (graph["exemplarId"], vision["exemplarId"]) == ("graph2", "vision1") # The middle of each group is closest to its mean
+
+def testPapersJoinAndLeaveTopicsWithoutClustering(vectors, monkeypatch):
+    monkeypatch.setattr(similarity, "TOPIC_MIN_PAPERS", 10)
+    monkeypatch.setattr(similarity, "TOPIC_RECLUSTER_GROWTH", 0.2)
+    group(vectors, "graph", 0, 5)
+    assert not vectors.needsClustering("index") # Too few papers
+    group(vectors, "vision", 1, 5)
+    assert vectors.needsClustering("index")
+    vectors.cluster("index", 2)
+    assert not vectors.needsClustering("index")
+
+    group(vectors, "late", 1, 1)
+    vectors.delete("index", ["graph0"])
+
+    assert vectors.getTopic("index", "late0")["topic"] == vectors.getTopic("index", "vision0")["topic"]
+    assert vectors.getTopic("index", "late0")["size"] == 6
+    assert vectors.getTopic("index", "graph1")["size"] == 4
+    assert vectors.getTopic("index", "graph0") is None
+    assert not vectors.needsClustering("index") # Two changes in ten papers
+    group(vectors, "later", 0, 1)
+    assert vectors.needsClustering("index")
+
+def testTooFewPapersHaveNoTopics(vectors):
+    vectors.put("index", "a", [[1, 0]])
+
+    assert vectors.cluster("index") == 0
+    assert vectors.getTopic("index", "a") is None
+    vectors.drop("index")
+    assert vectors.paperIds("index") == [] and vectors.similar("index", "a") == []
@@ -0,0 +1,133 @@
+import sqlite3
+import subprocess
+import sys
+
+import pytest
+from langchain_core.documents import Document
+
+from repository import PaperRepository
+from similarity import PaperVectors
+from storage import Storage
+
+def embed(texts: list[str], model: str = None) -> list[list[float]]:
+    ''' Deterministic stand-in for the Ollama embeddings '''
+    return [[float(len(text)), float(sum(map(ord, text)) % 97), 1.0] for text in texts]
+
+@pytest.fixture
+def storage(tmp_path, monkeypatch) -> Storage:
+    repository = PaperRepository(str(tmp_path / "metadata.db"))
+    repository.initSchema()
+    storage = Storage(repository, str(tmp_path / "chroma"))
+    storage._vectors = PaperVectors(storage.pool, str(tmp_path / "vectors"))
+    storage.initStorage()
+    monkeypatch.setattr(storage, "_embedTexts", embed)
+    return storage
+
+def store(storage: Storage, paperId: str, title: str, chunks: int = 3):
+    documents = [Document(page_content=f"{title} chunk {i}", metadata={"page": i}) for i in range(chunks)]
+    storage.storePaper(paperId, {"title": title}, documents, embed([doc.page_content for doc in documents]))
+
+def vectorIds(storage: Storage, paperId: str) -> list[str]:
+    return sorted(storage.collection.get(where={"paperId": paperId})["ids"])
+
+def vectorTexts(storage: Storage, paperId: str) -> list[str]:
+    return sorted(storage.collection.get(where={"paperId": paperId})["documents"])
+
+def testIncrementalCheckSeesPapersStoredAfterPruning(storage):
+    store(storage, "a", "first")
+    assert storage.check()["checked"] == 1 # Prunes the log
+
+    store(storage, "b", "second")
+    store(storage, "c", "third")
+    storage.collection.delete(where={"paperId": "c"})
+    report = storage.check()
+
+    assert report["checked"] == 2
+    assert report["orphanRows"] == ["c"]
+    assert len(vectorIds(storage, "c")) == 3 # Embedded again from its chunk texts
+
+def testOldLogIsMigratedAboveTheWatermark(tmp_path):
+    repository = PaperRepository(str(tmp_path / "metadata.db"))
+    repository.initSchema()
+    with repository.pool.transaction() as conn: # Log made before its IDs were AUTOINCREMENT, pruned by an earlier check
+        conn.execute("CREATE TABLE storage_log (id INTEGER PRIMARY KEY, op TEXT, paperIds TEXT, cursor TEXT, pid INTEGER, status TEXT, createdAt REAL)")
+        conn.execute("INSERT INTO storage_log (id, op, paperIds, status) VALUES (2, 'store', '[\"late\"]', 'done')") # Reused an ID below the watermark
+        conn.execute("INSERT INTO settings VALUES ('checkWatermark', '5')")
+    storage = Storage(repository, str(tmp_path / "chroma"))
+    storage.initStorage()
+
+    with repository.pool.connection() as conn:
+        assert "AUTOINCREMENT" in conn.execute("SELECT sql FROM sqlite_master WHERE name='storage_log'").fetchone()[0]
+    assert repository.getSetting("checkWatermark") == "1"
+    assert storage._begin("delete", ["x"]) > 5
+
+def testFailedRestoreKeepsThePreviousVersion(storage, monkeypatch):
+    store(storage, "a", "old")
+    def fail(*args, **kwargs):
+        raise sqlite3.OperationalError("database is locked")
+    monkeypatch.setattr(storage.repository, "writePapers", fail)
+
+    with pytest.raises(Exception, match="database is locked"):
+        store(storage, "a", "new", chunks=5)
+
+    assert storage.repository.getPapersByIds(["a"])[0]["title"] == "old"
+    assert vectorTexts(storage, "a") == ["old chunk 0", "old chunk 1", "old chunk 2"]
+    assert storage.vectors.stored("papers", ["a"]) == {"a"}
+
+def testStoreSwappedBeforeFailingIsRolledForward(storage, monkeypatch):
+    store(storage, "a", "old")
+    def fail(*args, **kwargs):
+        raise OSError("disk full")
+    monkeypatch.setattr(storage.vectors, "put", fail)
+
+    with pytest.raises(Exception, match="disk full"):
+        store(storage, "a", "new", chunks=5)
+    monkeypatch.undo()
+
+    assert storage.repository.getPapersByIds(["a"])[0]["title"] == "new"
+    assert vectorTexts(storage, "a") == [f"new chunk {i}" for i in range(5)]
+    assert storage.vectors.stored("papers", ["a"]) == {"a"}
+    assert storage.check(full=True)["orphanRows"] == []
+
+def testRebuildRunsABatchAtATime(storage, monkeypatch):
+    monkeypatch.setattr("storage.STORAGE_BATCH_SIZE", 1)
+    for paperId in "abc":
+        store(storage, paperId, paperId * 3)
+    intent = storage.claimRebuild(storage.requestRebuild("other-embed"))
+
+    assert storage.rebuildBatch(intent) is False and intent["cursor"] == "a"
+    store(storage, "0", "stored while rebuilding") # Behind the cursor, so only the write to both indexes puts it in the new one
+    batches = 1
+    while not storage.rebuildBatch(intent):
+        batches += 1
+
+    assert batches == 3 # b and c, then the end of the library is found
+    assert storage.activeIndex() == ("other-embed", intent["target"])
+    assert [len(vectorIds(storage, paperId)) for paperId in "0abc"] == [3, 3, 3, 3]
+    assert storage.getRebuilds() == []
+
+def testRebuildCollectionIsOnlyDroppedByTheProcessRunningIt(storage):
+    leftover = storage.getCollection("papers_other_embed") # From when the model was last used
+    leftover.add(ids=["gone_0"], documents=["gone"], embeddings=embed(["gone"]), metadatas=[{"paperId": "gone"}])
+
+    intentId = storage.requestRebuild("other-embed")
+    assert storage.getCollection("papers_other_embed").count() == 1 # Only queued, so nothing was written to ChromaDB
+
+    storage.runRebuild(storage.claimRebuild(intentId))
+    assert storage.getCollection("papers_other_embed").count() == 0
+
+def testOnlyWritingProcessesRepair(storage, tmp_path):
+    store(storage, "a", "deleted")
+    dead = subprocess.Popen([sys.executable, "-c", "pass"])
+    dead.wait()
+    with storage.pool.transaction() as conn: # Left by a delete whose process died before it got to ChromaDB
+        conn.execute("INSERT INTO storage_log (op, paperIds, pid, status, createdAt) VALUES ('delete', '[\"a\"]', ?, 'pending', 0)", (dead.pid,))
+    def status() -> list[str]:
+        with storage.pool.connection() as conn:
+            return [row["status"] for row in conn.execute("SELECT status FROM storage_log WHERE op='delete'")]
+
+    Storage(storage.repository, str(tmp_path / "chroma")).initStorage(repair=False) # As the app does
+    assert status() == ["pending"] and len(vectorIds(storage, "a")) == 3
+
+    Storage(storage.repository, str(tmp_path / "chroma")).initStorage() # As the workers do
+    assert status() == ["done"] and vectorIds(storage, "a") == []
@@ -0,0 +1,91 @@
+import multiprocessing
+
+import pytest
+from langchain_core.documents import Document
+
+import database
+import jobQueue
+from jobQueue import initJobQueue, claimJob, STEP_LANES
+from repository import ConnectionPool, PaperRepository
+from similarity import PaperVectors
+from storage import Storage
+from worker import runStep
+
+def embed(texts: list[str], model: str = None) -> list[list[float]]:
+    ''' Deterministic stand-in for the Ollama embeddings '''
+    return [[float(len(text)), float(sum(map(ord, text)) % 97), 1.0] for text in texts]
+
+@pytest.fixture
+def storage(tmp_path, monkeypatch) -> Storage:
+    ''' A library and a job queue of their own, used by the app functions and the worker steps alike '''
+    repository = PaperRepository(str(tmp_path / "metadata.db"))
+    repository.initSchema()
+    storage = Storage(repository, str(tmp_path / "chroma"))
+    storage._vectors = PaperVectors(storage.pool, str(tmp_path / "vectors"))
+    storage.initStorage()
+    monkeypatch.setattr(storage, "_embedTexts", embed)
+    monkeypatch.setattr(database, "repository", repository)
+    monkeypatch.setattr(database, "storage", storage)
+    monkeypatch.setattr(jobQueue, "pool", ConnectionPool(str(tmp_path / "jobs.db"), size=2))
+    initJobQueue()
+    return storage
+
+def storeInAnotherProcess(path, paperId: str, title: str):
+    ''' Stores a paper into the library in a directory from a fresh process, as the store worker does '''
+    storage = Storage(PaperRepository(str(path / "metadata.db")), str(path / "chroma"))
+    storage._vectors = PaperVectors(storage.pool, str(path / "vectors"))
+    storage._embedTexts = embed
+    storage.initStorage()
+    store(storage, paperId, title)
+
+def store(storage: Storage, paperId: str, title: str):
+    documents = [Document(page_content=f"{title} chunk {i}", metadata={"page": i}) for i in range(3)]
+    storage.storePaper(paperId, {"title": title}, documents, embed([doc.page_content for doc in documents]))
+
+def vectorCount(storage: Storage) -> int:
+    return storage.collection.count()
+
+def runStoreLane():
+    ''' Runs every queued step of the store lane, as the store worker would '''
+    while (job := claimJob("store-0", STEP_LANES["store"])) is not None:
+        runStep(job)
+
+def testRemovalsAreLeftToTheStoreLane(storage):
+    store(storage, "a", "First")
+    store(storage, "b", "Second")
+
+    database.removePaper("a")
+    assert vectorCount(storage) == 6 and len(storage.repository.getAllPapers()) == 2 # Nothing removed by the app itself
+    assert claimJob("cpu-0", STEP_LANES["cpu"] + STEP_LANES["llm"]) is None
+
+    runStoreLane()
+    assert [paper["id"] for paper in storage.repository.getAllPapers()] == ["b"] and vectorCount(storage) == 3
+    assert jobQueue.getJobs()[0]["label"] == "Remove First" and jobQueue.getJobs()[0]["status"] == "done"
+
+    database.removeAllPapers()
+    runStoreLane()
+    assert storage.repository.getAllPapers() == [] and vectorCount(storage) == 0
+
+def testRemovingByFilterQueuesOneJob(storage):
+    store(storage, "a", "First")
+    storage.repository.updatePapers({"a": {"title": "First", "methods": ["GNN"]}})
+
+    assert database.removePapersWhere({"methods": ["GNN"]}) == 1
+    assert database.removePapersWhere({"methods": ["CNN"]}) == 0
+    runStoreLane()
+
+    assert storage.repository.getAllPapers() == [] and vectorCount(storage) == 0
+    assert len(jobQueue.getJobs()) == 1
+
+def testSearchSeesPapersStoredByTheWorker(storage, tmp_path):
+    store(storage, "a", "First")
+    search = lambda text: [chunk["paperId"] for chunk in database.searchChunks(text, 6, storage.activeIndex(), embed([text])[0])]
+    assert set(search("Second chunk 0")) == {"a"} # Loads the index into this process's client
+
+    worker = multiprocessing.get_context("spawn").Process(target=storeInAnotherProcess, args=(tmp_path, "b", "Second"))
+    worker.start()
+    worker.join()
+    assert worker.exitcode == 0
+
+    assert search("Second chunk 0")[0] == "b"
+    assert set(search("Second chunk 0")) == {"a", "b"}